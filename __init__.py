@@ -1,25 +1,30 @@
 import re
 import json
+import time
 from datetime import datetime
 from json import JSONDecodeError
-from typing import Dict, List, Any, Type
+from typing import Dict, List, Any, Type, Optional
 
 from nonebot.adapters.onebot.v11.utils import unescape
 from nonebot.adapters.onebot.v11.permission import GROUP
 from nonebot.adapters.onebot.v11 import (Bot, MessageEvent,
                                          GroupMessageEvent, PrivateMessageEvent,
-                                         GROUP_ADMIN, GROUP_OWNER, MessageSegment, Message)
+                                         GROUP_ADMIN, GROUP_OWNER, MessageSegment)
 from nonebot.internal.matcher import Matcher
 from nonebot.log import logger
-from nonebot.plugin import on_regex
-from nonebot.params import ArgPlainText, RegexDict, EventMessage
+from nonebot.rule import Rule
+from nonebot.plugin import on_message
+from nonebot.message import run_preprocessor, event_preprocessor
+from nonebot.typing import T_State
 from nonebot.permission import SUPERUSER, Permission
 from nonebot.plugin import PluginMetadata
 
 from .config import Config, plugin_config, APIKeyPool
-from .loadpresets import presets_str
-from .custom_errors import NeedCreatSession
-from .sessions import session_container, Session, get_group_id
+from . import loadpresets
+from .custom_errors import NeedCreatSession, SessionStateError, BusyError
+from .sessions import session_container, turn_scheduler, dispatcher, Session, get_group_id
+from .tracing import tracer, Trace
+from .router import CommandRouter, FOLLOW_UP_KEY
 
 customize_prefix: str = plugin_config.customize_prefix
 customize_talk_cmd: str = plugin_config.customize_talk_cmd
@@ -58,7 +63,9 @@ __usage__: str = (
     f"    {menu_chat_str} list <@user> 获取当前群查看@的用户创建的会话\n"
     f"    {menu_chat_str} prompt 查看当前会话的prompt\n"
     f"    {menu_chat_str} dump 导出当前会话json字符串格式的上下文信息，可以用于{menu_chat_str} json导入\n"
-    f"    {menu_chat_str} keys 脱敏显示当前失效api key，仅主人"
+    f"    {menu_chat_str} keys 脱敏显示当前失效api key，仅主人\n"
+    f"    {menu_chat_str} migrate 将会话文件夹中的会话导入sqlite存储，仅主人\n"
+    f"    {menu_chat_str} trace 查看最慢的几次对话的耗时，{menu_chat_str} trace <id> 查看详细耗时，仅主人"
 
 )
 __plugin_meta__ = PluginMetadata(
@@ -81,6 +88,7 @@ model: str = plugin_config.model_name
 max_tokens: int = plugin_config.max_tokens
 auto_create_preset_info: bool = plugin_config.auto_create_preset_info
 at_sender: bool = plugin_config.at_sender
+stream: bool = plugin_config.stream
 
 
 async def _allow_private_checker(event: MessageEvent) -> bool:
@@ -89,42 +97,89 @@ async def _allow_private_checker(event: MessageEvent) -> bool:
 
 ALLOW_PRIVATE = Permission(_allow_private_checker)
 
-Chat = on_regex(rf"^{prefix_str}{talk_cmd_str}\s+(?P<content>.+)", flags=re.S, permission=ALLOW_PRIVATE)  # 聊天
-CallMenu = on_regex(rf"^{pattern_str}\s+help$", permission=ALLOW_PRIVATE)  # 呼出菜单
-ShowList = on_regex(rf"^{pattern_str}\s+list\s*$", permission=ALLOW_PRIVATE)  # 展示群聊天列表
-Join = on_regex(rf"^{pattern_str}\s+join\s+(?P<id>\d+)", permission=ALLOW_PRIVATE)  # 加入会话
-Delete = on_regex(rf"^{pattern_str}\s+del\s+(?P<id>\d+)", permission=ALLOW_PRIVATE)  # 删除会话
-DelSelf = on_regex(rf"^{pattern_str}\s+del\s*$", permission=ALLOW_PRIVATE)  # 删除当前会话
-Dump = on_regex(rf"^{pattern_str}\s+dump$", permission=ALLOW_PRIVATE)  # 导出json
-CreateConversationWithPrompt = on_regex(rf"^{pattern_str}\s+new\s+(?P<prompt>.+)$", flags=re.S,
-                                        permission=ALLOW_PRIVATE)  # 利用自定义prompt创建会话
-CreateConversationWithTemplate = on_regex(rf"^{pattern_str}\s+new$", permission=ALLOW_PRIVATE)  # 利用模板创建会话
-CreateConversationWithJson = on_regex(rf"^{pattern_str}\s+json$", permission=ALLOW_PRIVATE)  # 利用json创建会话
-ChatCopy = on_regex(rf"^{pattern_str}\s+cp\s+(?P<id>\d+)$", permission=ALLOW_PRIVATE)
-ChatCP = on_regex(rf"^{pattern_str}\s+cp$", permission=ALLOW_PRIVATE)
-ChatWho = on_regex(rf'^{pattern_str}\s+who$', permission=ALLOW_PRIVATE)
-ChatUserList = on_regex(rf"^{pattern_str}\s+list\s*\S+$", permission=ALLOW_PRIVATE)  # 展示群聊天列表
-ReName = on_regex(rf"^{pattern_str}\s+rename\s+(?P<name>.+)$", permission=ALLOW_PRIVATE)  # 重命名当前会话
-ChatPrompt = on_regex(rf"^{pattern_str}\s+prompt$", permission=ALLOW_PRIVATE)
-ChatClear = on_regex(rf"{pattern_str}\s+clear$", permission=ALLOW_PRIVATE)
-ChatClearAt = on_regex(rf"{pattern_str}\s+clear\s*\S+$", permission=ALLOW_PRIVATE)
-SetAuthOn = on_regex(rf'^{pattern_str}\s+auth on$', permission=GROUP)
-SetAuthOff = on_regex(rf'^{pattern_str}\s+auth off$', permission=GROUP)
-ShowAuth = on_regex(rf'^{pattern_str}\s+auth$', permission=GROUP)
-ShowFailKey = on_regex(rf'^{pattern_str}\s+keys$', permission=SUPERUSER)
-
-
-@ShowFailKey.handle()
-async def _(event: MessageEvent):
-    await ShowFailKey.finish(api_keys.show_fail_keys(), at_sender=True)
-
-
-@ShowAuth.handle()
-async def _(event: GroupMessageEvent):
+
+@event_preprocessor
+async def _record_received(state: T_State):
+    # 记录收到事件的时间，trace 中匹配指令与排队的耗时从这里算起
+    if tracer.enabled:
+        state['_chatgpt_received_ns'] = time.time_ns()
+
+
+@run_preprocessor
+async def _prepare_sessions(matcher: Matcher, event: MessageEvent):
+    # 启动时会话与预设在后台加载，加载完成前本插件的指令排队等待
+    if matcher.module_name != __name__:
+        return
+    if not (session_container.loaded and loadpresets.presets_loaded.is_set()):
+        logger.info('会话或预设尚未加载完成，指令将在加载完成后处理')
+    await loadpresets.presets_loaded.wait()
+    await session_container.wait_loaded()
+    # 多个进程共用状态后端时，先同步本群其他进程修改过的会话
+    group_id: str = get_group_id(event)
+    try:
+        await session_container.sync(group_id)
+    except Exception as e:
+        logger.error(f'同步群 {group_id} 的会话状态失败，使用本地状态\n{type(e)}:{e}')
+
+router: CommandRouter = CommandRouter({'chat': pattern_str, 'talk': prefix_str + talk_cmd_str})
+# 全部指令共用一个 matcher，由 router 判断是哪条指令并检查该指令的权限
+# on_message 默认 block=True，与之前的 on_regex 一样不阻止消息继续传给其他插件
+Router = on_message(rule=Rule(router), priority=1, block=False)
+
+
+@Router.handle()
+async def _(bot: Bot, event: MessageEvent, state: T_State):
+    await router.dispatch(bot, event, state)
+
+
+@Router.handle()
+async def _(bot: Bot, event: MessageEvent, state: T_State):
+    # new、json 指令暂停后用户发来的模板序号或 json
+    await router.follow_up(bot, event, state)
+
+
+@router.command('chat', r'keys$', permission=SUPERUSER)  # 脱敏显示失效apikey
+async def show_fail_keys(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
+    await Router.finish(api_keys.show_fail_keys(), at_sender=True)
+
+
+@router.command('chat', r'trace(\s+(?P<id>\d+|clear))?$', permission=SUPERUSER)  # 查看耗时最长的几次对话
+async def show_trace(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
+    if not tracer.enabled:
+        await Router.finish('未开启 tracing，请在配置中设置 tracing=true', at_sender=True)
+    arg: Optional[str] = info.get('id')
+    if arg == 'clear':
+        tracer.clear()
+        await Router.finish('已清空记录的 trace', at_sender=True)
+    traces: List[Trace] = tracer.slowest_traces()
+    if not traces:
+        await Router.finish('还没有记录到 trace', at_sender=True)
+    if arg is None:
+        msg: str = f'共记录 {tracer.traces} 条 trace（后台任务的 {tracer.background_traces} 条不计入），' \
+                   f'最慢的 {len(traces)} 条：\n'
+        msg += '\n'.join(f'{i + 1}. {trace.summary()}' for i, trace in enumerate(traces))
+        await Router.finish(msg, at_sender=True)
+    index: int = int(arg)
+    if index < 1 or index > len(traces):
+        await Router.finish("序号超出!", at_sender=True)
+    await Router.finish(traces[index - 1].format(), at_sender=True)
+
+
+@router.command('chat', r'migrate$', permission=SUPERUSER)  # 导入会话到sqlite
+async def migrate_sessions(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
+    try:
+        num: int = await session_container.migrate_from_json_dir()
+    except TypeError:
+        await Router.finish("当前会话存储不是sqlite，无需导入", at_sender=True)
+    await Router.finish(f"成功导入会话{num}条", at_sender=True)
+
+
+@router.command('chat', r'auth$', permission=GROUP)
+async def show_auth(bot: Bot, event: GroupMessageEvent, state: T_State, info: Dict[str, Any]):
     group_id: str = get_group_id(event)
     if session_container.get_group_auth(group_id):
-        await ShowAuth.finish("当前仅有管理员有权限管理会话", at_sender=True)
-    await ShowAuth.finish("当前所有人均有权限管理会话", at_sender=True)
+        await Router.finish("当前仅有管理员有权限管理会话", at_sender=True)
+    await Router.finish("当前所有人均有权限管理会话", at_sender=True)
 
 
 async def auth_check(matcher: Type[Matcher], bot: Bot, event: MessageEvent, group_id: str) -> None:
@@ -140,258 +195,295 @@ async def admin_check(bot: Bot, event: MessageEvent) -> bool:
     return (await SUPERUSER(bot, event)) or (await GROUP_ADMIN(bot, event)) or (await GROUP_OWNER(bot, event))
 
 
-@SetAuthOff.handle()
-async def _(bot: Bot, event: GroupMessageEvent):
+async def request_lane(bot: Bot, event: MessageEvent) -> str:
+    """
+    请求所属的调度分道
+    """
+    if await SUPERUSER(bot, event):
+        return 'superuser'
+    if not isinstance(event, GroupMessageEvent):
+        return 'private'
+    return 'admin' if await admin_check(bot, event) else 'user'
+
+
+@router.command('chat', r'auth off$', permission=GROUP)
+async def set_auth_off(bot: Bot, event: GroupMessageEvent, state: T_State, info: Dict[str, Any]):
     group_id: str = get_group_id(event)
     perm_check = await admin_check(bot, event)
     if not perm_check:
-        await SetAuthOff.finish("只有群主或管理员才能设置权限管理", at_sender=True)
-    session_container.set_group_auth(group_id, False)
-    await SetAuthOff.finish("设置成功，当前所有人均有权限管理会话", at_sender=True)
+        await Router.finish("只有群主或管理员才能设置权限管理", at_sender=True)
+    await session_container.set_group_auth(group_id, False)
+    await Router.finish("设置成功，当前所有人均有权限管理会话", at_sender=True)
 
 
-@SetAuthOn.handle()
-async def _(bot: Bot, event: GroupMessageEvent):
+@router.command('chat', r'auth on$', permission=GROUP)
+async def set_auth_on(bot: Bot, event: GroupMessageEvent, state: T_State, info: Dict[str, Any]):
     group_id: str = get_group_id(event)
     perm_check = await admin_check(bot, event)
     if not perm_check:
-        await SetAuthOn.finish("只有群主或管理员才能设置权限管理", at_sender=True)
-    session_container.set_group_auth(group_id, True)
-    await SetAuthOn.finish("设置成功，当前仅有管理员有权限管理会话", at_sender=True)
+        await Router.finish("只有群主或管理员才能设置权限管理", at_sender=True)
+    await session_container.set_group_auth(group_id, True)
+    await Router.finish("设置成功，当前仅有管理员有权限管理会话", at_sender=True)
 
 
-@ChatClear.handle()
-async def _(bot: Bot, event: MessageEvent):
+@router.command('chat', r'clear$', permission=ALLOW_PRIVATE)  # 清空本群全部会话
+async def chat_clear(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
     group_id: str = get_group_id(event)
     perm_check = await admin_check(bot, event)
     if not perm_check:
-        await ChatClear.finish("只有群主或管理员才能清空本群全部会话!", at_sender=True)
+        await Router.finish("只有群主或管理员才能清空本群全部会话!", at_sender=True)
     session_list: List[Session] = session_container.get_group_sessions(group_id)
     num = len(session_list)
     for session in session_list:
         await session_container.delete_session(session, group_id)
-    await ChatClear.finish(f"成功删除全部共{num}条会话", at_sender=True)
+    await Router.finish(f"成功删除全部共{num}条会话", at_sender=True)
 
 
-@ChatClearAt.handle()
-async def _(bot: Bot, event: MessageEvent, message: Message = EventMessage()):
+@router.command('chat', r'clear\s*\S+$', permission=ALLOW_PRIVATE)  # 删除@用户创建的会话
+async def chat_clear_at(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
     if isinstance(event, PrivateMessageEvent):
-        await ChatClearAt.finish()
-    segments: List[MessageSegment] = [s for s in message if s.type == 'at' and s.data.get("qq", "all") != 'all']
+        await Router.finish()
+    segments: List[MessageSegment] = [s for s in event.get_message()
+                                      if s.type == 'at' and s.data.get("qq", "all") != 'all']
     if not segments:
-        await ChatClearAt.finish()
+        await Router.finish()
     perm_check = await admin_check(bot, event)
     sender_id: int = int(event.get_user_id())
     user_id: int = int(segments[0].data.get("qq", ""))
     group_id: str = get_group_id(event)
     if user_id != sender_id and not perm_check:
-        await ChatClearAt.finish("您不是该会话的创建者或管理员!", at_sender=True)
-    session_list: List[Session] = [s for s in session_container.sessions if
-                                   s.group == group_id and s.creator == user_id]
+        await Router.finish("您不是该会话的创建者或管理员!", at_sender=True)
+    session_list: List[Session] = session_container.get_user_sessions(group_id, user_id)
     num = len(session_list)
     if num == 0:
-        await ChatClearAt.finish(f"本群用户 {user_id} 还没有创建过会话哦", at_sender=True)
+        await Router.finish(f"本群用户 {user_id} 还没有创建过会话哦", at_sender=True)
     for session in session_list:
         await session_container.delete_session(session, group_id)
-    await ChatClearAt.finish(f"成功删除本群用户 {user_id} 创建的全部会话共{num}条", at_sender=True)
+    await Router.finish(f"成功删除本群用户 {user_id} 创建的全部会话共{num}条", at_sender=True)
 
 
-@ChatCP.handle()
-async def _(bot: Bot, event: MessageEvent):
+@router.command('chat', r'cp$', permission=ALLOW_PRIVATE)  # 复制当前会话
+async def chat_cp(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
     user_id: int = int(event.get_user_id())
     group_id: str = get_group_id(event)
-    await auth_check(ChatCP, bot, event, group_id)
+    await auth_check(Router, bot, event, group_id)
     group_usage: Dict[int, Session] = session_container.get_group_usage(group_id)
     if user_id not in group_usage:
-        await ChatCP.finish(f'请先加入一个会话，再进行复制当前会话 或者使用 {menu_chat_str} cp <id> 进行复制',
+        await Router.finish(f'请先加入一个会话，再进行复制当前会话 或者使用 {menu_chat_str} cp <id> 进行复制',
                             at_sender=True)
     session: Session = group_usage[user_id]
-    group_usage[user_id].del_user(user_id)
-    new_session: Session = session_container.create_with_session(session, user_id, group_id)
-    await ChatCP.finish(f"创建并加入会话 '{new_session.name}' 成功!", at_sender=True)
+    new_session: Session = await session_container.create_with_session(session, user_id, group_id)
+    await Router.finish(f"创建并加入会话 '{new_session.name}' 成功!", at_sender=True)
 
 
-@ChatPrompt.handle()
-async def _(event: MessageEvent):
+@router.command('chat', r'prompt$', permission=ALLOW_PRIVATE)
+async def chat_prompt(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
     user_id: int = int(event.get_user_id())
     group_id: str = get_group_id(event)
     group_usage: Dict[int, Session] = session_container.get_group_usage(group_id)
     if user_id not in group_usage:
-        await ChatPrompt.finish('请先加入一个会话，再进行重命名', at_sender=True)
+        await Router.finish('请先加入一个会话，再进行重命名', at_sender=True)
     session: Session = group_usage[user_id]
-    await ChatPrompt.finish(f'会话：{session.name}\nprompt：{session.prompt}', at_sender=True)
+    await session.hydrate()
+    await Router.finish(f'会话：{session.name}\nprompt：{session.prompt}', at_sender=True)
 
 
-@ReName.handle()
-async def _(bot: Bot, event: MessageEvent, info: Dict[str, Any] = RegexDict()):
+@router.command('chat', r'rename\s+(?P<name>.+)$', permission=ALLOW_PRIVATE)  # 重命名当前会话
+async def rename(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
     user_id: int = int(event.get_user_id())
     group_id: str = get_group_id(event)
-    await auth_check(ReName, bot, event, group_id)
+    await auth_check(Router, bot, event, group_id)
     group_usage: Dict[int, Session] = session_container.get_group_usage(group_id)
     if user_id not in group_usage:
-        await ReName.finish('请先加入一个会话，再进行重命名', at_sender=True)
+        await Router.finish('请先加入一个会话，再进行重命名', at_sender=True)
     perm_check = await admin_check(bot, event)
     session: Session = group_usage[user_id]
     name: str = unescape(info.get('name', '').strip())
     if session.creator == user_id or perm_check:
-        session.rename(name[:32])
-        await ReName.finish(f'当前会话已命名为 {session.name}', at_sender=True)
+        try:
+            await session_container.rename(session, name[:32])
+        except SessionStateError as e:
+            await Router.finish(str(e), at_sender=True)
+        await Router.finish(f'当前会话已命名为 {session.name}', at_sender=True)
     logger.info(f'重命名群 {group_id} 会话 {session.name} 失败：权限不足', at_sender=True)
-    await ReName.finish("您不是该会话的创建者或管理员!", at_sender=True)
+    await Router.finish("您不是该会话的创建者或管理员!", at_sender=True)
 
 
-@ChatUserList.handle()
-async def _(event: MessageEvent, message: Message = EventMessage()):
+@router.command('chat', r'list\s*\S+$', permission=ALLOW_PRIVATE)  # 展示@用户创建的会话
+async def chat_user_list(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
     if isinstance(event, PrivateMessageEvent):
-        await ChatUserList.finish()
-    segments: List[MessageSegment] = [s for s in message if s.type == 'at' and s.data.get("qq", "all") != 'all']
+        await Router.finish()
+    segments: List[MessageSegment] = [s for s in event.get_message()
+                                      if s.type == 'at' and s.data.get("qq", "all") != 'all']
     if not segments:
-        await ChatUserList.finish()
+        await Router.finish()
     user_id: int = int(segments[0].data.get("qq", ""))
     group_id: str = get_group_id(event)
-    session_list: List[Session] = [s for s in session_container.sessions if
-                                   s.group == group_id and s.creator == user_id]
+    session_list: List[Session] = session_container.get_user_sessions(group_id, user_id)
     msg: str = f"在群中创建会话{len(session_list)}条：\n"
     for index, session in enumerate(session_list):
         msg += f" 名称:{session.name[:10]} " \
                f"创建者:{session.creator} " \
                f"时间:{datetime.fromtimestamp(session.creation_time)}\n"
-    await ChatUserList.finish(MessageSegment.at(user_id) + msg, at_sender=True)
+    await Router.finish(MessageSegment.at(user_id) + msg, at_sender=True)
 
 
-@ChatWho.handle()
-async def _(event: MessageEvent):
+@router.command('chat', r'who$', permission=ALLOW_PRIVATE)
+async def chat_who(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
     user_id: int = int(event.get_user_id())
     group_id: str = get_group_id(event)
     group_usage: Dict[int, Session] = session_container.get_group_usage(group_id)
     if user_id not in group_usage:
-        await ChatWho.finish('当前没有加入任何会话，请加入或创建一个会话', at_sender=True)
+        await Router.finish('当前没有加入任何会话，请加入或创建一个会话', at_sender=True)
     session: Session = group_usage[user_id]
     msg = f'当前所在会话信息:\n' \
           f"名称:{session.name[:10]}\n" \
           f"创建者:{session.creator}\n" \
           f"时间:{datetime.fromtimestamp(session.creation_time)}\n" \
           f"可以使用 {menu_chat_str} dump 导出json字符串格式的上下文信息"
-    await ChatWho.finish(msg, at_sender=True)
+    await Router.finish(msg, at_sender=True)
 
 
-@ChatCopy.handle()
-async def _(bot: Bot, event: MessageEvent, info: Dict[str, Any] = RegexDict()):
+@router.command('chat', r'cp\s+(?P<id>\d+)$', permission=ALLOW_PRIVATE)  # 复制序号为id的会话
+async def chat_copy(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
     session_id = int(info.get('id', '').strip())
     user_id: int = int(event.get_user_id())
     group_id: str = get_group_id(event)
-    await auth_check(ChatCopy, bot, event, group_id)
+    await auth_check(Router, bot, event, group_id)
     group_sessions: List[Session] = session_container.get_group_sessions(group_id)
-    group_usage: Dict[int, Session] = session_container.get_group_usage(group_id)
     if not group_sessions:
-        await ChatCopy.finish(f"本群尚未创建过会话!请用{menu_chat_str} new命令来创建会话!", at_sender=True)
+        await Router.finish(f"本群尚未创建过会话!请用{menu_chat_str} new命令来创建会话!", at_sender=True)
     if session_id < 1 or session_id > len(group_sessions):
-        await ChatCopy.finish("序号超出!", at_sender=True)
+        await Router.finish("序号超出!", at_sender=True)
     session: Session = group_sessions[session_id - 1]
-    if user_id in group_usage:
-        group_usage[user_id].del_user(user_id)
-    new_session: Session = session_container.create_with_session(session, user_id, group_id)
-    await ChatCopy.finish(f"创建并加入会话 '{new_session.name}' 成功!", at_sender=True)
+    new_session: Session = await session_container.create_with_session(session, user_id, group_id)
+    await Router.finish(f"创建并加入会话 '{new_session.name}' 成功!", at_sender=True)
 
 
-@Dump.handle()
-async def _(event: MessageEvent):
+@router.command('chat', r'dump$', permission=ALLOW_PRIVATE)  # 导出json
+async def dump(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
     user_id: int = int(event.get_user_id())
     group_id: str = get_group_id(event)
     try:
         session: Session = session_container.get_user_usage(group_id, user_id)
-        await Dump.finish(session.dump2json_str(), at_sender=True)
+        await session.hydrate()
+        await Router.finish(session.dump2json_str(), at_sender=True)
     except NeedCreatSession:
-        await Dump.finish('请先加入一个会话', at_sender=True)
+        await Router.finish('请先加入一个会话', at_sender=True)
 
 
-@Chat.handle()
-async def _(event: MessageEvent, info: Dict[str, Any] = RegexDict()):
+@router.command('talk', r'(?P<content>.+)', permission=ALLOW_PRIVATE, flags=re.S)  # 聊天
+async def chat(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
     content: str = unescape(info.get('content', '').strip())
     if not content:
-        await Chat.finish("输入不能为空!", at_sender=True)
+        await Router.finish("输入不能为空!", at_sender=True)
     user_id: int = int(event.get_user_id())
     group_id: str = get_group_id(event)
-    group_usage: Dict[int, Session] = session_container.get_group_usage(group_id)
-    if user_id not in group_usage:  # 若用户没有加入任何会话则先创建会话
-        session: Session = session_container.create_with_template('1', user_id, group_id)
-        logger.info(f"{user_id} 自动创建并加入会话 '{session.name}'")
-        if auto_create_preset_info:
-            await Chat.send(f"自动创建并加入会话 '{session.name}' 成功", at_sender=True)
-    else:
-        session: Session = group_usage[user_id]
-    answer: str = await session.ask_with_content(api_keys, base_url ,content, 'user', temperature, model, max_tokens)
-    await Chat.finish(answer, at_sender=at_sender)
-
-
-@Join.handle()
-async def _(event: MessageEvent, info: Dict[str, Any] = RegexDict()):
+    received: Optional[int] = state.get('_chatgpt_received_ns')
+    with tracer.span('chat.turn', start_ns=received, group=group_id, user=user_id):
+        if received is not None:
+            tracer.record('chat.match', received)
+        group_usage: Dict[int, Session] = session_container.get_group_usage(group_id)
+        if user_id not in group_usage:  # 若用户没有加入任何会话则先创建会话
+            template_id: Optional[str] = loadpresets.preset_registry.default_id()
+            if template_id is None:
+                await Router.finish('当前没有可用的预设模板，请联系管理员检查预设文件', at_sender=True)
+            session: Session = await session_container.create_with_template(template_id, user_id, group_id)
+            logger.info(f"{user_id} 自动创建并加入会话 '{session.name}'")
+            if auto_create_preset_info:
+                await Router.send(f"自动创建并加入会话 '{session.name}' 成功", at_sender=True)
+        else:
+            session: Session = group_usage[user_id]
+        sent: List[str] = []
+        lane: str = await request_lane(bot, event) if dispatcher.enabled else ''
+
+        async def send_segment(segment: str) -> None:
+            # 只在第一段回复中@发送者
+            with tracer.span('chat.send', chars=len(segment)):
+                await Router.send(segment, at_sender=at_sender and not sent)
+            sent.append(segment)
+
+        async def run_turn(turn_content: str) -> str:
+            try:
+                # 按优先级分道取得请求名额，繁忙时直接回复；多个进程共用状态后端时回合期间持有会话锁
+                async with dispatcher.slot(lane), session_container.hold(session):
+                    return await session.ask_with_content(api_keys, base_url, turn_content, 'user', temperature,
+                                                          model, max_tokens, send_segment if stream else None, user_id)
+            except (SessionStateError, BusyError) as e:
+                return str(e)
+
+        # 同一会话的请求排队执行，开启 turn_batch_window 时等待期间的消息会合并成一个回合
+        answer: Optional[str] = await turn_scheduler.submit(session, content, run_turn)
+        # 消息合并到同一会话的其他回合中时由该回合回复；流式请求已经分段发送过回复
+        if answer is not None and not sent:
+            with tracer.span('chat.send', chars=len(answer)):
+                await Router.send(answer, at_sender=at_sender)
+    await Router.finish()
+
+
+@router.command('chat', r'join\s+(?P<id>\d+)', permission=ALLOW_PRIVATE)  # 加入会话
+async def join(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
     session_id: int = int(info.get('id', '').strip())
     group_id: str = get_group_id(event)
     group_sessions: List[Session] = session_container.get_group_sessions(group_id)
-    group_usage: Dict[int, Session] = session_container.get_group_usage(group_id)
     if not group_sessions:
-        await Join.finish(f"本群尚未创建过会话!请用{menu_chat_str} new命令来创建会话!", at_sender=True)
+        await Router.finish(f"本群尚未创建过会话!请用{menu_chat_str} new命令来创建会话!", at_sender=True)
     if session_id < 1 or session_id > len(group_sessions):
-        await Join.finish("序号超出!", at_sender=True)
+        await Router.finish("序号超出!", at_sender=True)
     user_id: int = int(event.get_user_id())
     session: Session = group_sessions[session_id - 1]
-    if user_id in group_usage:
-        group_usage[user_id].del_user(user_id)
-    session.add_user(user_id)
-    group_usage[user_id] = session
-    await Join.finish(f"加入会话 {session_id}:{session.name} 成功!", at_sender=True)
+    await session_container.join(session, user_id, group_id)
+    await Router.finish(f"加入会话 {session_id}:{session.name} 成功!", at_sender=True)
 
 
-@CallMenu.handle()
-async def _():
+@router.command('chat', r'help$', permission=ALLOW_PRIVATE)  # 呼出菜单
+async def call_menu(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
     menu: str = __usage__
-    await CallMenu.finish(menu, at_sender=True)
+    await Router.finish(menu, at_sender=True)
 
 
-@DelSelf.handle()
-async def _(bot: Bot, event: MessageEvent):
+@router.command('chat', r'del\s*$', permission=ALLOW_PRIVATE)  # 删除当前会话
+async def del_self(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
     user_id: int = int(event.get_user_id())
     group_id: str = get_group_id(event)
-    await auth_check(DelSelf, bot, event, group_id)
-    group_usage: Dict[int, Session] = session_container.get_group_usage(group_id)
-    session: Session = group_usage.pop(user_id, None)
+    await auth_check(Router, bot, event, group_id)
+    session: Optional[Session] = await session_container.leave(user_id, group_id)
     if not session:
-        await DelSelf.finish("当前不存在会话", at_sender=True)
+        await Router.finish("当前不存在会话", at_sender=True)
     perm_check = await admin_check(bot, event)
     if session.creator == user_id or perm_check:
         await session_container.delete_session(session, group_id)
-        await DelSelf.finish("删除成功!", at_sender=True)
+        await Router.finish("删除成功!", at_sender=True)
     logger.info(f'删除群 {group_id} 会话 {session.name} 失败：权限不足', at_sender=True)
-    await DelSelf.finish("您不是该会话的创建者或管理员!", at_sender=True)
+    await Router.finish("您不是该会话的创建者或管理员!", at_sender=True)
 
 
-@Delete.handle()
-async def _(bot: Bot, event: MessageEvent, info: Dict[str, Any] = RegexDict()):
+@router.command('chat', r'del\s+(?P<id>\d+)', permission=ALLOW_PRIVATE)  # 删除会话
+async def delete(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
     session_id = int(info.get('id', '').strip())
     user_id: int = int(event.get_user_id())
     group_id: str = get_group_id(event)
-    await auth_check(Delete, bot, event, group_id)
+    await auth_check(Router, bot, event, group_id)
     group_sessions: List[Session] = session_container.get_group_sessions(group_id)
     if not group_sessions:
-        await Delete.finish("当前不存在会话", at_sender=True)
+        await Router.finish("当前不存在会话", at_sender=True)
     if session_id < 1 or session_id > len(group_sessions):
-        await Delete.finish("序号超出!", at_sender=True)
+        await Router.finish("序号超出!", at_sender=True)
     session: Session = group_sessions[session_id - 1]
     perm_check = await admin_check(bot, event)
     if session.creator == user_id or perm_check:
         await session_container.delete_session(session, group_id)
-        await Delete.finish("删除成功!", at_sender=True)
+        await Router.finish("删除成功!", at_sender=True)
     else:
         logger.info(f'删除群 {group_id} 会话 {session.name} 失败：权限不足', at_sender=True)
-        await Delete.finish("您不是该会话的创建者或管理员!", at_sender=True)
+        await Router.finish("您不是该会话的创建者或管理员!", at_sender=True)
 
 
 # 暂时已完成
 
 
-@ShowList.handle()
-async def _(event: MessageEvent):
+@router.command('chat', r'list\s*$', permission=ALLOW_PRIVATE)  # 展示群聊天列表
+async def show_list(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
     group_id: str = get_group_id(event)
     session_list: List[Session] = session_container.get_group_sessions(group_id)
     msg: str = f"本群全部会话共{len(session_list)}条：\n"
@@ -399,61 +491,64 @@ async def _(event: MessageEvent):
         msg += f"{index + 1}. {session.name} " \
                f"创建者:{session.creator} " \
                f"时间:{datetime.fromtimestamp(session.creation_time)}\n"
-    await ShowList.finish(msg, at_sender=True)
+    await Router.finish(msg, at_sender=True)
 
 
 # 暂时完成
 
 
-@CreateConversationWithPrompt.handle()
-async def _(bot: Bot, event: MessageEvent, info: Dict[str, Any] = RegexDict()):
+@router.command('chat', r'new\s+(?P<prompt>.+)$', permission=ALLOW_PRIVATE, flags=re.S)  # 利用自定义prompt创建会话
+async def create_with_prompt(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
     custom_prompt: str = unescape(info.get('prompt', '').strip())
     user_id: int = int(event.get_user_id())
     group_id: str = get_group_id(event)
-    await auth_check(CreateConversationWithPrompt, bot, event, group_id)
-    session: Session = session_container.create_with_str(custom_prompt, user_id, group_id, custom_prompt[:5])
-    await CreateConversationWithPrompt.finish(f"成功创建并加入会话 '{session.name}' ", at_sender=True)
+    await auth_check(Router, bot, event, group_id)
+    session: Session = await session_container.create_with_str(custom_prompt, user_id, group_id, custom_prompt[:5])
+    await Router.finish(f"成功创建并加入会话 '{session.name}' ", at_sender=True)
 
 
-@CreateConversationWithTemplate.handle()
-async def CreateConversation(bot: Bot, event: MessageEvent):
+@router.command('chat', r'new$', permission=ALLOW_PRIVATE)  # 利用模板创建会话
+async def create_with_template(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
     group_id: str = get_group_id(event)
-    await auth_check(CreateConversationWithTemplate, bot, event, group_id)
-    await CreateConversationWithTemplate.send(presets_str, at_sender=True)
+    await auth_check(Router, bot, event, group_id)
+    state[FOLLOW_UP_KEY] = create_from_template_id
+    await Router.pause(loadpresets.presets_str, at_sender=True)
 
 
 # 暂时完成
 
 
-@CreateConversationWithTemplate.got(key="template")
-async def Create(event: MessageEvent, template_id: str = ArgPlainText("template")):
+async def create_from_template_id(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
+    template_id: str = info['text']
     user_id: int = int(event.get_user_id())
     group_id: str = get_group_id(event)
     if not template_id.isdigit():
-        await CreateConversationWithTemplate.finish("输入ID无效！", at_sender=True)
-    session: Session = session_container.create_with_template(template_id, user_id, group_id)
-    await CreateConversationWithTemplate.send(f"使用模板 '{template_id}' 创建并加入会话 '{session.name}' 成功!",
-                                              at_sender=True)
+        await Router.finish("输入ID无效！", at_sender=True)
+    if template_id not in loadpresets.templateDict:
+        await Router.finish(f"模板 '{template_id}' 不存在！", at_sender=True)
+    session: Session = await session_container.create_with_template(template_id, user_id, group_id)
+    await Router.send(f"使用模板 '{template_id}' 创建并加入会话 '{session.name}' 成功!", at_sender=True)
 
 
-@CreateConversationWithJson.handle()
-async def CreateConversation(bot: Bot, event: MessageEvent):
+@router.command('chat', r'json$', permission=ALLOW_PRIVATE)  # 利用json创建会话
+async def create_with_json(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
     group_id: str = get_group_id(event)
-    await auth_check(CreateConversationWithTemplate, bot, event, group_id)
-    pass
+    await auth_check(Router, bot, event, group_id)
+    state[FOLLOW_UP_KEY] = create_from_json
+    await Router.pause("请直接输入json")
 
 
-@CreateConversationWithJson.got("jsonStr", "请直接输入json")
-async def GetJson(event: MessageEvent, json_str: str = ArgPlainText("jsonStr")):
+async def create_from_json(bot: Bot, event: MessageEvent, state: T_State, info: Dict[str, Any]):
+    json_str: str = info['text']
     try:
         chat_log = json.loads(json_str)
     except JSONDecodeError:
         logger.error("json字符串错误!")
-        await CreateConversationWithJson.finish("Json错误！", at_sender=True)
+        await Router.finish("Json错误！", at_sender=True)
     if not chat_log[0].get("role"):
-        await CreateConversationWithJson.finish("Json错误！", at_sender=True)
+        await Router.finish("Json错误！", at_sender=True)
     user_id: int = int(event.get_user_id())
     group_id: str = get_group_id(event)
-    session: Session = session_container.create_with_chat_log(chat_log, user_id, group_id,
-                                                              name=chat_log[0].get('content', '')[:5])
-    await CreateConversationWithJson.send(f"创建并加入会话 '{session}' 成功!", at_sender=True)
+    session: Session = await session_container.create_with_chat_log(chat_log, user_id, group_id,
+                                                                    name=chat_log[0].get('content', '')[:5])
+    await Router.send(f"创建并加入会话 '{session}' 成功!", at_sender=True)
@@ -1,13 +1,32 @@
-import random
-from typing import List, Union
+import time
+import heapq
+from email.utils import parsedate_to_datetime
+from typing import List, Union, Dict, Tuple, Optional, Collection
 from collections import UserString, UserList
 
+import httpx
+from openai import AsyncOpenAI
+
+from .ratelimit import TokenBucket
+
 
 class APIKey(UserString):
-    def __init__(self, key: str):
+    def __init__(self, key: str, index: int = 0):
         super().__init__(key.strip())
         self.status: bool = True
         self.fail_res: str = ''
+        self.index: int = index
+        # 调度状态
+        self.in_flight: int = 0
+        self.latency: float = 1.0
+        self.error_rate: float = 0.0
+        self.cooldown_until: float = 0.0
+        self.probing: bool = False
+        self.probe_interval: float = 0.0
+        self.version: int = 0
+        # 限流，未配置时为 None
+        self.request_bucket: Optional[TokenBucket] = None
+        self.token_bucket: Optional[TokenBucket] = None
 
     @property
     def key(self) -> str:
@@ -20,11 +39,70 @@ class APIKey(UserString):
         self.status = False
         self.fail_res = fail_res
 
+    def recover(self):
+        self.status = True
+        self.fail_res = ''
+
     def show_fail(self) -> str:
         return f'{self.show()} {self.fail_res}'
 
+    def capacity_wait(self, tokens: int) -> float:
+        """
+        距离这个 key 的限流余量足够发出一个需要 tokens 个 token 的请求还需要等待的秒数
+        """
+        wait: float = 0.0
+        if self.request_bucket is not None:
+            wait = self.request_bucket.wait_time(1)
+        if self.token_bucket is not None:
+            wait = max(wait, self.token_bucket.wait_time(tokens))
+        return wait
+
+    def consume(self, tokens: int) -> None:
+        if self.request_bucket is not None:
+            self.request_bucket.consume(1)
+        if self.token_bucket is not None:
+            self.token_bucket.consume(tokens)
+
+    def health_score(self) -> float:
+        """
+        分数越低越优先：并发请求越多、最近延迟越高、错误率越高分数越高
+        """
+        return (self.in_flight + 1) * max(self.latency, 0.05) * (1 + 4 * self.error_rate)
+
+
+def parse_retry_after(headers: Optional[httpx.Headers]) -> Optional[float]:
+    """
+    解析 429 响应的 Retry-After / retry-after-ms 头，返回需要等待的秒数
+    """
+    if not headers:
+        return None
+    if headers.get('retry-after-ms'):
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    value: Optional[str] = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
 
 class APIKeyPool(UserList):
+    """
+    apikey 调度：每次请求取出当前最优的可用 key
+    开启负载均衡时按 health_score 选择，否则按配置顺序一直使用同一个 key 直到它冷却或失效；
+    触发限速的 key 冷却到 Retry-After 之后，失效的 key 每隔 probe_interval 秒重新尝试一次
+    就绪的 key 保存在按分数排序的堆中，key 状态变化时压入新条目并用 version 使旧条目失效
+    """
+    EWMA_ALPHA: float = 0.2
+    MAX_PROBE_INTERVAL: float = 6 * 3600
 
     def __init__(self, api_keys: Union[str, list]):
         if not api_keys or not (isinstance(api_keys, list) or isinstance(api_keys, str)):
@@ -32,7 +110,35 @@ class APIKeyPool(UserList):
         if isinstance(api_keys, str):
             api_keys = [api_keys]
         self.valid_num: int = len(api_keys)
-        super().__init__([APIKey(k) for k in api_keys])
+        super().__init__([APIKey(k, i) for i, k in enumerate(api_keys)])
+        self.load_balancing: bool = False
+        self.cooldown: float = 20.0
+        self.probe_interval: float = 600.0
+        self._ready: List[Tuple[float, int, int, int]] = []
+        self._cooling: List[Tuple[float, int, int, int]] = []
+        self._seq: int = 0
+        for k in self.api_keys:
+            self._push_ready(k)
+
+    def configure(self, load_balancing: bool, cooldown: float, probe_interval: float) -> None:
+        self.load_balancing = load_balancing
+        self.cooldown = cooldown
+        self.probe_interval = probe_interval
+        for k in self.api_keys:
+            if k.status:
+                self._push_ready(k)
+
+    def configure_limits(self, rpm: int, tpm: int) -> None:
+        """
+        设置每个 key 每分钟的请求数与 token 数上限，0为不限制
+        """
+        for k in self.api_keys:
+            k.request_bucket = TokenBucket(rpm) if rpm > 0 else None
+            k.token_bucket = TokenBucket(tpm) if tpm > 0 else None
+
+    @property
+    def rate_limited(self) -> bool:
+        return any(k.request_bucket is not None or k.token_bucket is not None for k in self.api_keys)
 
     @property
     def api_keys(self) -> List[APIKey]:
@@ -45,8 +151,148 @@ class APIKeyPool(UserList):
     def len(self) -> int:
         return len(self.api_keys)
 
-    def shuffle(self):
-        random.shuffle(self.api_keys)
+    def capacity_wait(self, tokens: int, exclude: Collection[APIKey] = ()) -> Optional[float]:
+        """
+        距离有 key 可以发出一个需要 tokens 个 token 的请求还需要等待的秒数，考虑限流余量与冷却；
+        exclude 中的 key 只在冷却中时计入（冷却结束后可以再次使用）；没有可以等待的 key 时返回 None
+        """
+        now: float = time.monotonic()
+        best: Optional[float] = None
+        for k in self.api_keys:
+            if not k.status and not k.probing and k.cooldown_until <= now:
+                continue
+            if k in exclude and k.cooldown_until <= now:
+                continue
+            wait: float = max(k.cooldown_until - now, k.capacity_wait(tokens), 0.0)
+            if best is None or wait < best:
+                best = wait
+        return best
+
+    def refund(self, k: APIKey, tokens: int) -> None:
+        """
+        请求实际用掉的 token 比预留的少时退回差额
+        """
+        if k.token_bucket is not None and tokens > 0:
+            k.token_bucket.refund(tokens)
+
+    def _score(self, k: APIKey) -> float:
+        if k.probing:
+            return -1.0
+        return k.health_score() if self.load_balancing else float(k.index)
+
+    def _push(self, heap: list, priority: float, k: APIKey) -> None:
+        k.version += 1
+        self._seq += 1
+        heapq.heappush(heap, (priority, self._seq, k.version, k.index))
+        # 每个 key 最多只有一个有效条目，失效条目超过 key 数量的 2 倍时重建堆，避免堆无限增长
+        if len(heap) > 3 * len(self.api_keys):
+            heap[:] = [entry for entry in heap if entry[2] == self.api_keys[entry[3]].version]
+            heapq.heapify(heap)
+
+    def _push_ready(self, k: APIKey) -> None:
+        self._push(self._ready, self._score(k), k)
+
+    def _push_cooling(self, k: APIKey, deadline: float) -> None:
+        k.cooldown_until = deadline
+        self._push(self._cooling, deadline, k)
+
+    def _release_cooled(self, now: float) -> None:
+        while self._cooling and self._cooling[0][0] <= now:
+            _, _, version, index = heapq.heappop(self._cooling)
+            k: APIKey = self.api_keys[index]
+            if version != k.version:
+                continue
+            k.cooldown_until = 0.0
+            if not k.status:
+                k.probing = True
+            self._push_ready(k)
+
+    def acquire(self, exclude: Collection[APIKey] = (), tokens: int = 0) -> Optional[APIKey]:
+        """
+        取出当前最优的可用 key，exclude 中的 key 以及限流余量不足 tokens 的 key 不会被选中；没有可用 key 时返回 None
+        """
+        self._release_cooled(time.monotonic())
+        skipped: List[APIKey] = []
+        chosen: Optional[APIKey] = None
+        while self._ready:
+            _, _, version, index = heapq.heappop(self._ready)
+            k: APIKey = self.api_keys[index]
+            if version != k.version:
+                continue
+            if k in exclude or k.capacity_wait(tokens) > 0:
+                skipped.append(k)
+                continue
+            chosen = k
+            break
+        for k in skipped:
+            self._push_ready(k)
+        if chosen is None:
+            return None
+        chosen.consume(tokens)
+        chosen.in_flight += 1
+        if not chosen.probing:
+            # 同一个 key 可以同时处理多个请求；探测中的 key 在结果返回前不再分配
+            self._push_ready(chosen)
+        return chosen
+
+    def _update(self, k: APIKey, error: bool, latency: Optional[float] = None) -> None:
+        k.in_flight = max(k.in_flight - 1, 0)
+        k.error_rate += self.EWMA_ALPHA * ((1.0 if error else 0.0) - k.error_rate)
+        if latency is not None:
+            k.latency += self.EWMA_ALPHA * (latency - k.latency)
+
+    def report_success(self, k: APIKey, latency: float) -> None:
+        self._update(k, False, latency)
+        if k.probing:
+            k.probing = False
+            k.probe_interval = 0.0
+            k.recover()
+            self.valid_num += 1
+        if k.status and k.cooldown_until <= time.monotonic():
+            self._push_ready(k)
+
+    def release(self, k: APIKey) -> None:
+        """
+        请求被取消，归还 key，不影响它的统计
+        """
+        k.in_flight = max(k.in_flight - 1, 0)
+        if (k.status or k.probing) and k.cooldown_until <= time.monotonic():
+            self._push_ready(k)
+
+    def report_error(self, k: APIKey) -> None:
+        """
+        请求出现其他错误，key 仍然可用但降低优先级
+        """
+        if k.probing:
+            self.report_failure(k, k.fail_res)
+            return
+        self._update(k, True)
+        if k.status and k.cooldown_until <= time.monotonic():
+            self._push_ready(k)
+
+    def report_rate_limit(self, k: APIKey, retry_after: Optional[float] = None) -> None:
+        """
+        key 触发限速，冷却 Retry-After 秒，没有 Retry-After 时冷却 cooldown 秒
+        """
+        self._update(k, True)
+        self._push_cooling(k, time.monotonic() + (retry_after if retry_after is not None else self.cooldown))
+
+    def report_failure(self, k: APIKey, fail_res: str) -> None:
+        """
+        key 额度耗尽或权限错误，标记失效，开启探测时之后会重新尝试，每次失败后探测间隔翻倍
+        """
+        self._update(k, True)
+        if k.status:
+            k.fail(fail_res)
+            self.valid_num -= 1
+        else:
+            k.fail_res = fail_res
+        k.probing = False
+        k.version += 1
+        if self.probe_interval > 0:
+            k.probe_interval = min(k.probe_interval * 2 if k.probe_interval else self.probe_interval,
+                                   self.MAX_PROBE_INTERVAL)
+            self._push_cooling(k, time.monotonic() + k.probe_interval)
 
     def fail_keys(self) -> List[APIKey]:
         return [k for k in self.api_keys if not k.status]
@@ -58,4 +304,119 @@ class APIKeyPool(UserList):
         msg += f'已失效key共{fail_num}个：\n'
         for k in self.fail_keys():
             msg += f'{k.show_fail()}\n'
+        now: float = time.monotonic()
+        cooling: List[APIKey] = [k for k in self.api_keys if k.status and k.cooldown_until > now]
+        if cooling:
+            msg += f'限速冷却中key共{len(cooling)}个：\n'
+            for k in cooling:
+                msg += f'{k.show()} 剩余{k.cooldown_until - now:.0f}秒\n'
         return msg.strip()
+
+    def stats(self) -> List[Dict[str, float]]:
+        now: float = time.monotonic()
+        return [{
+            'key': k.show(),
+            'status': k.status,
+            'in_flight': k.in_flight,
+            'latency': k.latency,
+            'error_rate': k.error_rate,
+            'cooldown': max(k.cooldown_until - now, 0.0),
+        } for k in self.api_keys]
+
+
+class ClientPool:
+    """
+    按 (apikey, base_url) 缓存 AsyncOpenAI 客户端，所有客户端共享同一个 httpx 连接池
+    """
+
+    def __init__(self, http_client: httpx.AsyncClient, max_retries: int = 2):
+        self.http_client: httpx.AsyncClient = http_client
+        self.max_retries: int = max_retries
+        self._clients: Dict[Tuple[str, str], AsyncOpenAI] = {}
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def get(self, api_key: str, base_url: str) -> AsyncOpenAI:
+        client: AsyncOpenAI = self._clients.get((api_key, base_url))
+        if client is not None:
+            self.hits += 1
+            return client
+        self.misses += 1
+        client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=self.http_client,
+                             max_retries=self.max_retries)
+        self._clients[(api_key, base_url)] = client
+        return client
+
+    def discard(self, api_key: str) -> None:
+        """
+        移除该 apikey 的全部客户端，用于 key 失效后
+        """
+        for k in [k for k in self._clients if k[0] == api_key]:
+            del self._clients[k]
+
+    def __len__(self):
+        return len(self._clients)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'clients': len(self._clients),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class HttpStats:
+    """
+    通过 httpx 事件钩子与 httpcore trace 统计连接复用率与首字节时间(TTFB)
+    """
+
+    def __init__(self):
+        self.requests: int = 0
+        self.new_connections: int = 0
+        self.responses: int = 0
+        self.last_ttfb: float = 0.0
+        self.max_ttfb: float = 0.0
+        self.total_ttfb: float = 0.0
+
+    @property
+    def reuse_rate(self) -> float:
+        if not self.requests:
+            return 0.0
+        return max(self.requests - self.new_connections, 0) / self.requests
+
+    @property
+    def avg_ttfb(self) -> float:
+        return self.total_ttfb / self.responses if self.responses else 0.0
+
+    async def _trace(self, event_name: str, info: dict) -> None:
+        if event_name == 'connection.connect_tcp.complete':
+            self.new_connections += 1
+
+    async def on_request(self, request: httpx.Request) -> None:
+        self.requests += 1
+        request.extensions['trace'] = self._trace
+        request.extensions['start_time'] = time.perf_counter()
+
+    async def on_response(self, response: httpx.Response) -> None:
+        # 响应钩子在收到响应头、读取响应体之前调用
+        start: float = response.request.extensions.get('start_time')
+        if start is None:
+            return
+        ttfb: float = time.perf_counter() - start
+        self.responses += 1
+        self.last_ttfb = ttfb
+        self.max_ttfb = max(self.max_ttfb, ttfb)
+        self.total_ttfb += ttfb
+
+    def event_hooks(self) -> dict:
+        return {'request': [self.on_request], 'response': [self.on_response]}
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'requests': self.requests,
+            'new_connections': self.new_connections,
+            'reuse_rate': self.reuse_rate,
+            'last_ttfb': self.last_ttfb,
+            'max_ttfb': self.max_ttfb,
+            'avg_ttfb': self.avg_ttfb,
+        }
@@ -0,0 +1,28 @@
+"""
+基准测试公共初始化：初始化 nonebot 并加载插件，之后即可导入插件的各个模块
+"""
+import sys
+import importlib
+from pathlib import Path
+from types import ModuleType
+
+import nonebot
+from nonebot.adapters.onebot.v11 import Adapter
+
+PLUGIN_DIR: Path = Path(__file__).resolve().parents[1]
+
+
+def load_plugin(**config) -> str:
+    """
+    使用 config 初始化 nonebot 并加载插件，返回插件模块名
+    """
+    config.setdefault('api_key', 'sk-benchmark0000000000000000')
+    config.setdefault('log_level', 'WARNING')
+    nonebot.init(**config)
+    nonebot.get_driver().register_adapter(Adapter)
+    sys.path.insert(0, str(PLUGIN_DIR.parent))
+    return nonebot.load_plugin(PLUGIN_DIR.name).module_name
+
+
+def plugin_module(plugin_name: str, name: str) -> ModuleType:
+    return importlib.import_module(f'{plugin_name}.{name}')
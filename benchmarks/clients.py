@@ -0,0 +1,65 @@
+"""
+OpenAI 客户端复用基准测试
+对模拟接口发出请求，比较每次请求新建 AsyncOpenAI 与使用 ClientPool 缓存客户端的耗时、连接复用率与首字节时间
+用法: python benchmarks/clients.py -n 1000 --concurrency 10
+"""
+import time
+import asyncio
+import argparse
+import tempfile
+from pathlib import Path
+from typing import Callable
+
+from openai import AsyncOpenAI
+
+from _bootstrap import load_plugin, plugin_module
+from mock_openai import start_in_thread
+
+
+async def run(name: str, sessions, apikey, get_client: Callable, num: int, concurrency: int) -> None:
+    stats = apikey.HttpStats()
+    sessions.proxy_client.event_hooks = stats.event_hooks()
+    semaphore: asyncio.Semaphore = asyncio.Semaphore(concurrency)
+
+    async def request(i: int) -> None:
+        async with semaphore:
+            await get_client().chat.completions.create(
+                model='gpt-3.5-turbo', messages=[{'role': 'user', 'content': f'hello {i}'}], max_tokens=16)
+
+    start: float = time.perf_counter()
+    await asyncio.gather(*(request(i) for i in range(num)))
+    elapsed: float = time.perf_counter() - start
+    print(f'{name:<16}{num / elapsed:>10.1f}/s{stats.reuse_rate:>10.1%}{stats.avg_ttfb * 1000:>10.2f}ms'
+          f'{stats.max_ttfb * 1000:>10.2f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=1000, help='请求数量')
+    parser.add_argument('--concurrency', type=int, default=10, help='并发请求数')
+    parser.add_argument('--port', type=int, default=18555)
+    args = parser.parse_args()
+
+    base_url: str = f'http://127.0.0.1:{args.port}/v1'
+    start_in_thread(args.port)
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_path: Path = Path(tmp)
+        plugin_name: str = load_plugin(history_save_path=tmp_path / 'plugin', preset_path=tmp_path / 'presets',
+                                       openai_api_base=base_url)
+        sessions = plugin_module(plugin_name, 'sessions')
+        apikey = plugin_module(plugin_name, 'apikey')
+        api_key: str = 'sk-benchmark0000000000000000'
+
+        async def bench():
+            print(f'{"":<16}{"requests":>12}{"reuse":>10}{"avg ttfb":>12}{"max ttfb":>12}')
+            await run('new client', sessions, apikey,
+                      lambda: AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=sessions.proxy_client),
+                      args.n, args.concurrency)
+            await run('client pool', sessions, apikey, lambda: sessions.client_pool.get(api_key, base_url),
+                      args.n, args.concurrency)
+
+        asyncio.run(bench())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+"""
+端到端负载基准测试
+在本进程中加载插件，把模拟的群聊/私聊消息事件交给 nonebot 的 handle_event，经过真实的指令匹配、会话管理、
+请求与写入流程，上游为子进程中的模拟 OpenAI 接口（可以设置延迟、流式返回与错误注入）
+报告每秒完成的对话回合数、延迟分位数、写入磁盘的字节数与内存增长，可以用 --json 保存结果作为对比基线
+用法: python benchmarks/load.py --turns 2000 --concurrency 50 --groups 20 --users 10 --latency 0.2 --rate-limit 0.02
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import urllib.request
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import nonebot
+from nonebot.message import handle_event
+from nonebot.adapters.onebot.v11 import Adapter, Bot, Message, MessageEvent, GroupMessageEvent, PrivateMessageEvent
+
+from _bootstrap import load_plugin, plugin_module
+from mock_openai import ERRORS, start_in_process
+
+# 回复中出现这些内容时视为请求失败
+FAILURE_MARKERS: Tuple[str, ...] = ('请求失败', '冷却或已失效', '回复中断', '请稍后再试', '不存在可用apikey')
+SELF_ID: int = 10000
+
+
+def rss_bytes() -> int:
+    """
+    当前进程的常驻内存，非 Linux 时退回为峰值常驻内存
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    maxrss: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def dir_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered: List[float] = sorted(values)
+    return ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)]
+
+
+class BenchBot(Bot):
+    """
+    不连接协议端的 Bot，记录发出的消息，群成员信息一律返回普通成员
+    """
+
+    def __init__(self, adapter: Adapter, self_id: str):
+        super().__init__(adapter, self_id)
+        self.replies: List[str] = []
+
+    async def call_api(self, api: str, **data: Any) -> Any:
+        if api == 'get_group_member_info':
+            return {'role': 'member'}
+        if api in ('send_msg', 'send_group_msg', 'send_private_msg'):
+            self.replies.append(str(data.get('message', '')))
+            return {'message_id': len(self.replies)}
+        return {}
+
+
+class EventFactory:
+    """
+    生成模拟消息事件：users 个用户分布在 groups 个群中，private_ratio 比例的消息为私聊
+    用户第一次发言时以 new_ratio 的概率先用自定义 prompt 创建一个新会话，否则自动使用默认模板
+    """
+
+    def __init__(self, groups: int, users: int, private_ratio: float, new_ratio: float, message_chars: int,
+                 seed: int):
+        self.groups: int = groups
+        self.users: int = users
+        self.private_ratio: float = private_ratio
+        self.new_ratio: float = new_ratio
+        self.message_chars: int = message_chars
+        self.random: random.Random = random.Random(seed)
+        self._seen: set = set()
+        self._message_id: int = 0
+
+    def _event(self, text: str, user_id: int, group_id: Optional[int]) -> MessageEvent:
+        self._message_id += 1
+        common: Dict[str, Any] = dict(time=int(time.time()), self_id=SELF_ID, post_type='message', user_id=user_id,
+                                      message_id=self._message_id, message=Message(text),
+                                      original_message=Message(text), raw_message=text, font=0, to_me=False)
+        if group_id is None:
+            return PrivateMessageEvent(sub_type='friend', message_type='private',
+                                       sender={'user_id': user_id}, **common)
+        return GroupMessageEvent(sub_type='normal', message_type='group', group_id=group_id,
+                                 sender={'user_id': user_id, 'role': 'member'}, **common)
+
+    def next(self) -> List[MessageEvent]:
+        """
+        返回一个回合的事件，创建会话的事件在对话之前，需要按顺序处理
+        """
+        user_id: int = 100000 + self.random.randrange(self.users * self.groups)
+        group_id: Optional[int] = None if self.random.random() < self.private_ratio \
+            else 200000 + (user_id - 100000) % self.groups
+        text: str = f'/talk {"测试消息" * (self.message_chars // 4 + 1)}'[:self.message_chars + 6]
+        events: List[MessageEvent] = []
+        if (user_id, group_id) not in self._seen:
+            self._seen.add((user_id, group_id))
+            if self.random.random() < self.new_ratio:
+                events.append(self._event(f'/chat new 你是第{user_id}号用户的助手', user_id, group_id))
+        events.append(self._event(text, user_id, group_id))
+        return events
+
+
+async def bench(args: argparse.Namespace, plugin_name: str, history_path: Path) -> Dict[str, Any]:
+    driver = nonebot.get_driver()
+    bot: BenchBot = BenchBot(nonebot.get_adapter(Adapter), str(SELF_ID))
+    sessions = plugin_module(plugin_name, 'sessions')
+    await driver._lifespan.startup()
+    await sessions.session_container.wait_loaded()
+    factory: EventFactory = EventFactory(args.groups, args.users, args.private_ratio, args.new_ratio,
+                                         args.message_chars, args.seed)
+    latencies: List[float] = []
+    failures: int = 0
+    semaphore: asyncio.Semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run_turn(events: List[MessageEvent]) -> None:
+        nonlocal failures
+        async with semaphore:
+            start: float = time.perf_counter()
+            sent: int = len(bot.replies)
+            for event in events:
+                await handle_event(bot, event)
+            latencies.append(time.perf_counter() - start)
+            if any(marker in reply for reply in bot.replies[sent:] for marker in FAILURE_MARKERS):
+                failures += 1
+
+    # 预热：建立连接、加载预设
+    await asyncio.gather(*(run_turn(factory.next()) for _ in range(min(args.warmup, args.turns))))
+    latencies.clear()
+    failures = 0
+    flushed_before: int = sessions.session_flusher.bytes_written
+    rss_start: int = rss_bytes()
+    cpu_start: float = cpu_seconds()
+    start: float = time.perf_counter()
+    await asyncio.gather(*(run_turn(factory.next()) for _ in range(args.turns)))
+    elapsed: float = time.perf_counter() - start
+    cpu: float = cpu_seconds() - cpu_start
+    rss_end: int = rss_bytes()
+    await driver._lifespan.shutdown()
+    return {
+        'turns': args.turns,
+        'concurrency': args.concurrency,
+        'elapsed': elapsed,
+        'turns_per_sec': args.turns / elapsed,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies, default=0.0),
+        'cpu_per_turn': cpu / args.turns,
+        'cpu_utilization': cpu / elapsed,
+        'failures': failures,
+        'sessions': sessions.session_container.session_count,
+        'bytes_written': sessions.session_flusher.bytes_written - flushed_before,
+        'disk_bytes': dir_size(history_path),
+        'rss_start': rss_start,
+        'rss_growth': rss_end - rss_start,
+        'http_reuse_rate': sessions.http_stats.reuse_rate,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--turns', type=int, default=2000, help='对话回合数')
+    parser.add_argument('--warmup', type=int, default=50, help='预热回合数，不计入结果')
+    parser.add_argument('--concurrency', type=int, default=50, help='同时处理的回合数')
+    parser.add_argument('--groups', type=int, default=20, help='群数量')
+    parser.add_argument('--users', type=int, default=10, help='每个群的用户数')
+    parser.add_argument('--private-ratio', type=float, default=0.1, help='私聊消息的比例')
+    parser.add_argument('--new-ratio', type=float, default=0.3, help='用户首次发言前先创建自定义会话的概率')
+    parser.add_argument('--message-chars', type=int, default=20, help='每条消息的字数')
+    parser.add_argument('--keys', type=int, default=3, help='apikey 数量')
+    parser.add_argument('--quota-keys', type=int, default=0, help='其中额度耗尽的 key 数量')
+    parser.add_argument('--auth-keys', type=int, default=0, help='其中无效的 key 数量')
+    parser.add_argument('--latency', type=float, default=0.2, help='模拟接口的延迟（秒）')
+    parser.add_argument('--jitter', type=float, default=0.1, help='模拟接口额外的随机延迟上限（秒）')
+    parser.add_argument('--reply-chars', type=int, default=200, help='模拟回复的字数')
+    parser.add_argument('--chunk-delay', type=float, default=0.0, help='流式返回时 chunk 之间的间隔（秒）')
+    parser.add_argument('--stream', action='store_true', help='使用流式请求')
+    for name in ERRORS:
+        parser.add_argument(f'--{name.replace("_", "-")}', type=float, default=0.0, help=f'返回 {name} 错误的概率')
+    parser.add_argument('-o', '--option', action='append', default=[], metavar='KEY=VALUE',
+                        help='额外的插件配置，如 -o save_interval=0 -o session_store=sqlite，可以重复')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--port', type=int, default=18555)
+    parser.add_argument('--json', type=Path, default=None, help='把结果写入该文件')
+    args = parser.parse_args()
+
+    keys: List[str] = [f'sk-bench{i:04d}{"0" * 24}' for i in range(args.keys)]
+    key_errors: Dict[str, str] = {k: 'quota' for k in keys[:args.quota_keys]}
+    key_errors.update({k: 'auth' for k in keys[args.quota_keys:args.quota_keys + args.auth_keys]})
+    mock = start_in_process(args.port, latency=args.latency, jitter=args.jitter, reply_chars=args.reply_chars,
+                            chunk_delay=args.chunk_delay, errors={name: getattr(args, name) for name in ERRORS},
+                            key_errors=key_errors)
+    options: Dict[str, str] = dict(option.split('=', 1) for option in args.option)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp_path: Path = Path(tmp)
+            rss_before: int = rss_bytes()
+            plugin_name: str = load_plugin(history_save_path=tmp_path / 'plugin', preset_path=tmp_path / 'presets',
+                                           openai_api_base=f'http://127.0.0.1:{args.port}/v1', api_key=keys,
+                                           stream=args.stream, **options)
+            result: Dict[str, Any] = asyncio.run(bench(args, plugin_name, tmp_path / 'plugin'))
+            result['rss_plugin'] = result['rss_start'] - rss_before
+            with urllib.request.urlopen(f'http://127.0.0.1:{args.port}/stats') as response:
+                result['upstream'] = json.load(response)
+    finally:
+        mock.terminate()
+
+    print(f'回合数        {result["turns"]}（并发 {result["concurrency"]}，会话 {result["sessions"]} 个）')
+    print(f'吞吐量        {result["turns_per_sec"]:.1f} 回合/秒，用时 {result["elapsed"]:.2f}s')
+    print(f'延迟          p50 {result["p50"] * 1000:.1f}ms  p95 {result["p95"] * 1000:.1f}ms  '
+          f'p99 {result["p99"] * 1000:.1f}ms  max {result["max"] * 1000:.1f}ms')
+    print(f'CPU           每回合 {result["cpu_per_turn"] * 1000:.2f}ms，占用 {result["cpu_utilization"]:.0%}')
+    print(f'失败回合      {result["failures"]}')
+    print(f'上游请求      {result["upstream"]["calls"]} 次，注入错误 {result["upstream"]["errors"]}，'
+          f'连接复用率 {result["http_reuse_rate"]:.1%}')
+    print(f'写入          {result["bytes_written"] / 1024:.1f}KB，磁盘占用 {result["disk_bytes"] / 1024:.1f}KB')
+    print(f'内存          加载插件 {result["rss_plugin"] / 1024 / 1024:.1f}MB，测试期间增长 '
+          f'{result["rss_growth"] / 1024 / 1024:.1f}MB，结束时 '
+          f'{(result["rss_start"] + result["rss_growth"]) / 1024 / 1024:.1f}MB')
+    if args.json is not None:
+        args.json.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding='utf8')
+
+
+if __name__ == '__main__':
+    main()
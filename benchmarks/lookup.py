@@ -0,0 +1,54 @@
+"""
+会话查找基准测试
+生成 N 个会话分布在 G 个群中，比较索引查找与线性扫描查找群会话、用户会话的耗时
+用法: python benchmarks/lookup.py -n 100000 --groups 10000 --queries 10000
+"""
+import time
+import random
+import argparse
+import tempfile
+from pathlib import Path
+from typing import Callable, List
+
+from _bootstrap import load_plugin, plugin_module
+
+
+def measure(name: str, queries: List[tuple], lookup: Callable[[str, int], list]) -> None:
+    start: float = time.perf_counter()
+    found: int = sum(len(lookup(group, creator)) for group, creator in queries)
+    elapsed: float = time.perf_counter() - start
+    print(f'{name:<28}{found:>10}{elapsed * 1e6 / len(queries):>14.2f}us')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=100000, help='会话数量')
+    parser.add_argument('--groups', type=int, default=10000, help='群数量')
+    parser.add_argument('--users', type=int, default=20, help='每个群的用户数量')
+    parser.add_argument('--queries', type=int, default=10000, help='查询次数')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_path: Path = Path(tmp)
+        plugin_name: str = load_plugin(history_save_path=tmp_path / 'plugin', preset_path=tmp_path / 'presets')
+        sessions = plugin_module(plugin_name, 'sessions')
+        container = sessions.session_container
+        rand: random.Random = random.Random(0)
+        for i in range(args.n):
+            group: str = str(10000 + rand.randrange(args.groups))
+            creator: int = rand.randrange(args.users)
+            session = sessions.Session([], creator, group, 'ChatGPT', 10, is_save=False, basic_len=0)
+            container._add_session(session)
+        all_sessions: list = container.sessions
+        queries: List[tuple] = [(str(10000 + rand.randrange(args.groups)), rand.randrange(args.users))
+                                for _ in range(args.queries)]
+        print(f'{"":<28}{"found":>10}{"per query":>16}')
+        measure('group scan', queries, lambda g, c: [s for s in all_sessions if s.group == g])
+        measure('group index', queries, lambda g, c: container.get_group_sessions(g))
+        measure('user scan', queries,
+                lambda g, c: [s for s in all_sessions if s.group == g and s.creator == c])
+        measure('user index', queries, container.get_user_sessions)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+指令匹配基准测试
+比较每条消息在原先每条指令一个 on_regex matcher 与现在单个 matcher 查表分发两种方式下的匹配耗时：
+check 为对本插件全部 matcher 依次检查权限与规则的耗时，handle_event 为非指令消息经过 nonebot 完整事件处理的耗时
+用法: python benchmarks/matching.py -n 20000 --command-ratio 0.05
+"""
+import re
+import time
+import random
+import asyncio
+import argparse
+import importlib
+import tempfile
+from pathlib import Path
+from typing import Any, Callable, List, Optional, Tuple, Type
+
+import nonebot
+from nonebot.matcher import Matcher, matchers
+from nonebot.message import handle_event
+from nonebot.permission import SUPERUSER, Permission
+from nonebot.plugin import on_regex
+from nonebot.adapters.onebot.v11 import Bot, Adapter, Message, MessageEvent, GroupMessageEvent, PrivateMessageEvent
+from nonebot.adapters.onebot.v11.permission import GROUP
+
+from _bootstrap import load_plugin
+
+CHATTER: Tuple[str, ...] = ('今天吃什么', '哈哈哈哈哈', '[CQ:at,qq=10001] 在吗', '有人打游戏吗？', '[CQ:image,file=a.jpg]',
+                            '这个问题我也不知道，等会儿问问老师', '/help', '收到', '+1', '晚安')
+COMMANDS: Tuple[str, ...] = ('/talk 你好', '/talk 帮我写一首诗', '/chat list', '/chat who', '/chat join 1', '/chat help',
+                             '/chat keys', '/chat auth')
+
+
+def legacy_patterns(pattern_str: str, prefix_str: str, talk_cmd_str: str,
+                    allow_private: Permission) -> List[Tuple[str, int, Permission]]:
+    """
+    改为单个 matcher 之前每条指令各自的正则与权限
+    """
+    return [
+        (rf"^{prefix_str}{talk_cmd_str}\s+(?P<content>.+)", re.S, allow_private),
+        (rf"^{pattern_str}\s+help$", 0, allow_private),
+        (rf"^{pattern_str}\s+list\s*$", 0, allow_private),
+        (rf"^{pattern_str}\s+join\s+(?P<id>\d+)", 0, allow_private),
+        (rf"^{pattern_str}\s+del\s+(?P<id>\d+)", 0, allow_private),
+        (rf"^{pattern_str}\s+del\s*$", 0, allow_private),
+        (rf"^{pattern_str}\s+dump$", 0, allow_private),
+        (rf"^{pattern_str}\s+new\s+(?P<prompt>.+)$", re.S, allow_private),
+        (rf"^{pattern_str}\s+new$", 0, allow_private),
+        (rf"^{pattern_str}\s+json$", 0, allow_private),
+        (rf"^{pattern_str}\s+cp\s+(?P<id>\d+)$", 0, allow_private),
+        (rf"^{pattern_str}\s+cp$", 0, allow_private),
+        (rf'^{pattern_str}\s+who$', 0, allow_private),
+        (rf"^{pattern_str}\s+list\s*\S+$", 0, allow_private),
+        (rf"^{pattern_str}\s+rename\s+(?P<name>.+)$", 0, allow_private),
+        (rf"^{pattern_str}\s+prompt$", 0, allow_private),
+        (rf"{pattern_str}\s+clear$", 0, allow_private),
+        (rf"{pattern_str}\s+clear\s*\S+$", 0, allow_private),
+        (rf'^{pattern_str}\s+auth on$', 0, GROUP),
+        (rf'^{pattern_str}\s+auth off$', 0, GROUP),
+        (rf'^{pattern_str}\s+auth$', 0, GROUP),
+        (rf'^{pattern_str}\s+keys$', 0, SUPERUSER),
+        (rf'^{pattern_str}\s+migrate$', 0, SUPERUSER),
+        (rf'^{pattern_str}\s+trace(\s+(?P<id>\d+|clear))?$', 0, SUPERUSER),
+    ]
+
+
+def make_events(n: int, command_ratio: float, private_ratio: float, seed: int) -> List[MessageEvent]:
+    rand: random.Random = random.Random(seed)
+    events: List[MessageEvent] = []
+    for i in range(n):
+        text: str = rand.choice(COMMANDS) if rand.random() < command_ratio else rand.choice(CHATTER)
+        user_id: int = 100000 + rand.randrange(1000)
+        common = dict(time=0, self_id=10000, post_type='message', user_id=user_id, message_id=i,
+                      message=Message(text), original_message=Message(text), raw_message=text, font=0, to_me=False)
+        if rand.random() < private_ratio:
+            events.append(PrivateMessageEvent(sub_type='friend', message_type='private',
+                                              sender={'user_id': user_id}, **common))
+        else:
+            events.append(GroupMessageEvent(sub_type='normal', message_type='group', group_id=200000 + user_id % 50,
+                                            sender={'user_id': user_id, 'role': 'member'}, **common))
+    return events
+
+
+async def check(candidates: List[Type[Matcher]], bot: Bot, event: MessageEvent) -> int:
+    """
+    与 nonebot 处理事件时相同，先检查权限再检查规则，返回符合条件的 matcher 数量
+    """
+    matched: int = 0
+    for matcher in candidates:
+        if await matcher.check_perm(bot, event) and await matcher.check_rule(bot, event, {}):
+            matched += 1
+    return matched
+
+
+async def measure(name: str, events: List[MessageEvent], run: Callable[[MessageEvent], Any],
+                  baseline: Optional[float] = None) -> float:
+    start: float = time.perf_counter()
+    for event in events:
+        await run(event)
+    elapsed: float = (time.perf_counter() - start) * 1e6 / len(events)
+    speedup: str = f'{baseline / elapsed:>8.1f}x' if baseline else ''
+    print(f'{name:<28}{elapsed:>12.1f}us{speedup}')
+    return elapsed
+
+
+async def bench(args: argparse.Namespace, plugin_name: str) -> None:
+    plugin = importlib.import_module(plugin_name)
+    bot: Bot = Bot(nonebot.get_adapter(Adapter), '10000')
+    router_matchers: List[Type[Matcher]] = list(matchers[1])
+    legacy: List[Type[Matcher]] = [on_regex(pattern, flags, permission=permission)
+                                   for pattern, flags, permission in
+                                   legacy_patterns(plugin.pattern_str, plugin.prefix_str, plugin.talk_cmd_str,
+                                                   plugin.ALLOW_PRIVATE)]
+    events: List[MessageEvent] = make_events(args.n, args.command_ratio, args.private_ratio, args.seed)
+    chatter: List[MessageEvent] = make_events(args.n, 0, args.private_ratio, args.seed)
+    print(f'{len(legacy)} 个 on_regex matcher 对比 {len(router_matchers)} 个 matcher，消息 {args.n} 条，'
+          f'其中指令占 {args.command_ratio:.0%}')
+    print(f'{"方式":<28}{"每条消息":>14}{"加速":>8}')
+    # 每种方式测两轮，第一轮预热
+    for _ in range(2):
+        before: float = await measure('check on_regex', events, lambda e: check(legacy, bot, e))
+        await measure('check router', events, lambda e: check(router_matchers, bot, e), before)
+    matchers[1] = legacy
+    before = await measure('handle_event on_regex', chatter, lambda e: handle_event(bot, e))
+    matchers[1] = router_matchers
+    await measure('handle_event router', chatter, lambda e: handle_event(bot, e), before)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=20000, help='消息数量')
+    parser.add_argument('--command-ratio', type=float, default=0.05, help='check 测试中指令消息的比例')
+    parser.add_argument('--private-ratio', type=float, default=0.1, help='私聊消息的比例')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_path: Path = Path(tmp)
+        plugin_name: str = load_plugin(history_save_path=tmp_path / 'plugin', preset_path=tmp_path / 'presets')
+        asyncio.run(bench(args, plugin_name))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+会话历史记录内存基准测试
+比较每条消息一个 dict 的列表与预设前缀加环形缓冲的 History 两种表示方式下，N 个会话读入内存后占用的内存，
+以及每回合追加消息、淘汰最早的消息并组装请求上下文的耗时；
+最后比较 N 个会话使用同一个模板时，创建与从存储读入后每个会话各自一份预设与共用同一份预设的耗时与内存
+用法: python benchmarks/memory.py -n 10000 --messages 100
+"""
+import gc
+import copy
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+from _bootstrap import load_plugin, plugin_module
+
+
+def make_lines(preset: int, messages: int, chars: int) -> List[str]:
+    """
+    会话日志中每条消息的一行 json，读取时每个会话各自解析一遍，与从存储中读取时一样每条消息都是新的对象
+    """
+    lines: List[str] = []
+    for j in range(preset + messages):
+        role: str = 'system' if j < preset else ('user' if j % 2 else 'assistant')
+        lines.append(json.dumps({'role': role, 'content': f'第{j}条消息' + '测' * chars}, ensure_ascii=False))
+    return lines
+
+
+def measure_memory(build: Callable[[], List[Any]]) -> Tuple[List[Any], int, float]:
+    """
+    返回读入的会话、占用的内存与读入耗时，耗时另外不开启 tracemalloc 读入一次测量
+    """
+    gc.collect()
+    start: float = time.perf_counter()
+    build()
+    elapsed: float = time.perf_counter() - start
+    gc.collect()
+    tracemalloc.start()
+    sessions: List[Any] = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return sessions, current, elapsed
+
+
+def legacy_build(context_builder, history: List[Dict[str, str]], basic_len: int, max_count: int,
+                 budget: int) -> List[Dict[str, str]]:
+    """
+    改为 History 之前的上下文组装：切片出预设与最新的消息再拼接
+    """
+    preset: List[Dict[str, str]] = history[:basic_len]
+    used: int = context_builder.messages_tokens(preset)
+    start: int = len(history)
+    lower: int = max(basic_len, len(history) - max_count)
+    while start > lower:
+        tokens: int = context_builder.message_tokens(history[start - 1])
+        if used + tokens > budget and start < len(history):
+            break
+        used += tokens
+        start -= 1
+    return preset + history[start:]
+
+
+def measure_turns(name: str, sessions: List[Any], turn: Callable[[Any, int], Any], rounds: int,
+                  baseline: float = 0.0) -> float:
+    start: float = time.perf_counter()
+    for i in range(rounds):
+        for session in sessions:
+            turn(session, i)
+    elapsed: float = (time.perf_counter() - start) * 1e6 / (rounds * len(sessions))
+    speedup: str = f'{baseline / elapsed:>8.2f}x' if baseline else ''
+    print(f'{name:<24}{elapsed:>12.2f}us{speedup}')
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=10000, help='会话数量')
+    parser.add_argument('--preset', type=int, default=2, help='每个会话预设的消息数量')
+    parser.add_argument('--messages', type=int, default=100, help='预设之后的消息数量，同时作为 history_max')
+    parser.add_argument('--chars', type=int, default=30, help='每条消息的字数')
+    parser.add_argument('--window', type=int, default=10, help='chat_memory_max')
+    parser.add_argument('--rounds', type=int, default=5, help='每个会话进行的回合数')
+    parser.add_argument('--template-chars', type=int, default=1000, help='模板预设每条消息的字数')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_path: Path = Path(tmp)
+        plugin_name: str = load_plugin(history_save_path=tmp_path / 'plugin', preset_path=tmp_path / 'presets',
+                                       tokenizer='heuristic')
+        history = plugin_module(plugin_name, 'history')
+        sessions = plugin_module(plugin_name, 'sessions')
+        context_builder = sessions.context_builder
+        budget: int = context_builder.budget('gpt-3.5-turbo', 1024)
+        lines: List[str] = make_lines(args.preset, args.messages, args.chars)
+        total: int = args.n * len(lines)
+
+        legacy, legacy_bytes, legacy_time = measure_memory(
+            lambda: [[json.loads(line) for line in lines] for _ in range(args.n)])
+        ring, ring_bytes, ring_time = measure_memory(
+            lambda: [history.History.from_messages([json.loads(line) for line in lines], args.preset, args.messages)
+                     for _ in range(args.n)])
+        print(f'{args.n} 个会话，每个会话 {args.preset} 条预设与 {args.messages} 条消息，每条消息约 {args.chars} 字')
+        print(f'{"方式":<22}{"内存":>12}{"每条消息":>12}{"读入耗时":>12}')
+        for name, size, elapsed in (('list[dict]', legacy_bytes, legacy_time), ('History', ring_bytes, ring_time)):
+            print(f'{name:<24}{size / 2 ** 20:>10.1f}MB{size / total:>12.1f}B{elapsed * 1000:>12.1f}ms')
+        print(f'内存减少 {1 - ring_bytes / legacy_bytes:.1%}')
+
+        def legacy_turn(h: List[Dict[str, str]], i: int) -> None:
+            h.append({'role': 'user', 'content': f'新消息{i}'})
+            while len(h) > args.preset + args.messages:
+                h.pop(0)
+            legacy_build(context_builder, h, args.preset, args.window, budget)
+
+        def ring_turn(h, i: int) -> None:
+            h.append(history.Message('user', f'新消息{i}'))
+            [m.as_dict() for m in context_builder.build(h.preset, h.recent, args.window, budget)]
+
+        print('每回合追加一条消息、淘汰最早的消息并组装上下文的耗时')
+        before: float = measure_turns('list[dict]', legacy, legacy_turn, args.rounds)
+        measure_turns('History', ring, ring_turn, args.rounds, before)
+        del legacy, ring
+
+        template: List[dict] = [{'role': 'system', 'content': '设定' * (args.template_chars // 2)},
+                                {'role': 'assistant', 'content': '好' * args.template_chars}]
+        template_text: str = json.dumps(template, ensure_ascii=False)
+        key: str = history.prefix_key(template)
+        # 与 SessionContainer.template_prefix 一样，模板的共享预设只生成一次
+        shared = history.intern_prefix(template)
+
+        def own_prefix(messages: List[dict]):
+            # 改为共用预设之前：每个会话各自持有一份预设
+            return history.Prefix('', tuple(history.Message.from_dict(m) for m in messages))
+
+        print(f'{args.n} 个会话使用同一个模板，预设 {len(template)} 条消息，每条约 {args.template_chars} 字')
+        print(f'{"方式":<22}{"内存":>12}{"每个会话":>12}{"耗时":>12}')
+        for name, build in (
+                ('创建：深拷贝预设', lambda: [history.History(own_prefix(copy.deepcopy(template)), (), args.messages)
+                                        for _ in range(args.n)]),
+                ('创建：共用预设', lambda: [history.History(shared, (), args.messages) for _ in range(args.n)]),
+                ('读入：各自一份', lambda: [history.History(own_prefix(json.loads(template_text)), (), args.messages)
+                                       for _ in range(args.n)]),
+                ('读入：按哈希共用', lambda: [history.History(history.intern_prefix(json.loads(template_text), key), (),
+                                                          args.messages) for _ in range(args.n)])):
+            _, size, elapsed = measure_memory(build)
+            print(f'{name:<16}{size / 2 ** 20:>10.1f}MB{size / args.n:>12.1f}B{elapsed * 1e6 / args.n:>12.2f}us')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""
+基准测试用的模拟 OpenAI 接口，只实现 /v1/chat/completions，支持 stream=True 的 SSE 流式返回，可以按概率或按 key 注入错误
+用法: python benchmarks/mock_openai.py --port 18555 --latency 0.05 --reply-chars 400 --chunk-delay 0.02 --rate-limit 0.05
+"""
+import time
+import json
+import random
+import socket
+import asyncio
+import argparse
+import threading
+import multiprocessing
+from typing import Dict, Tuple
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+SENTENCE: str = '这是模拟接口返回的一句话，用来测试流式回复。'
+# 可以注入的错误：状态码、OpenAI 格式的错误内容与响应头
+ERRORS: Dict[str, Tuple[int, dict, dict]] = {
+    'rate_limit': (429, {'message': 'Rate limit reached for requests', 'type': 'requests',
+                         'code': 'rate_limit_exceeded'}, {'retry-after-ms': '500'}),
+    'quota': (429, {'message': 'You exceeded your current quota, please check your plan and billing details.',
+                    'type': 'insufficient_quota', 'code': 'insufficient_quota'}, {}),
+    'auth': (401, {'message': 'Incorrect API key provided.', 'type': 'invalid_request_error',
+                   'code': 'invalid_api_key'}, {}),
+}
+
+
+def create_app(latency: float = 0.0, reply_chars: int = 0, chunk_chars: int = 4, chunk_delay: float = 0.0,
+               jitter: float = 0.0, errors: Dict[str, float] = None, key_errors: Dict[str, str] = None) -> FastAPI:
+    """
+    latency 为返回第一个字节前的延迟，另加 0~jitter 秒的随机延迟；reply_chars 大于0时回复为该长度的模拟文本，否则回显最后一条消息；
+    流式返回时每 chunk_chars 个字为一个 chunk，chunk 之间间隔 chunk_delay 秒
+    errors 为每种错误（见 ERRORS）的出现概率，key_errors 指定某些 key 的每次请求都返回某种错误
+    """
+    app: FastAPI = FastAPI()
+    app.state.latency = latency
+    app.state.jitter = jitter
+    app.state.reply_chars = reply_chars
+    app.state.chunk_chars = chunk_chars
+    app.state.chunk_delay = chunk_delay
+    app.state.errors = errors or {}
+    app.state.key_errors = key_errors or {}
+    app.state.calls = 0
+    app.state.error_counts = {name: 0 for name in ERRORS}
+
+    def pick_error(request: Request):
+        key: str = request.headers.get('authorization', '').split()[-1]
+        name: str = app.state.key_errors.get(key)
+        if name is None:
+            roll: float = random.random()
+            for error, rate in app.state.errors.items():
+                if roll < rate:
+                    name = error
+                    break
+                roll -= rate
+        if name is None:
+            return None
+        app.state.error_counts[name] += 1
+        status, error, headers = ERRORS[name]
+        return JSONResponse({'error': error}, status_code=status, headers=headers)
+
+    def reply(body: dict) -> str:
+        if app.state.reply_chars > 0:
+            text: str = (SENTENCE * (app.state.reply_chars // len(SENTENCE) + 1))[:app.state.reply_chars]
+            return '\n\n'.join(text[i:i + 200] for i in range(0, len(text), 200))
+        return f'echo: {body["messages"][-1]["content"]}'
+
+    async def stream(body: dict, content: str):
+        size: int = max(app.state.chunk_chars, 1)
+        for i in range(0, len(content), size):
+            delta: dict = {'content': content[i:i + size]}
+            if i == 0:
+                delta['role'] = 'assistant'
+            chunk: dict = {'id': f'chatcmpl-{app.state.calls}', 'object': 'chat.completion.chunk',
+                           'created': int(time.time()), 'model': body['model'],
+                           'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]}
+            yield f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n'
+            if app.state.chunk_delay > 0:
+                await asyncio.sleep(app.state.chunk_delay)
+        yield 'data: [DONE]\n\n'
+
+    @app.post('/v1/chat/completions')
+    async def chat_completions(request: Request):
+        body: dict = await request.json()
+        app.state.calls += 1
+        if app.state.latency > 0 or app.state.jitter > 0:
+            await asyncio.sleep(app.state.latency + random.random() * app.state.jitter)
+        error = pick_error(request)
+        if error is not None:
+            return error
+        content: str = reply(body)
+        if body.get('stream'):
+            return StreamingResponse(stream(body, content), media_type='text/event-stream')
+        if app.state.chunk_delay > 0:
+            # 非流式时模拟完整生成所需的时间
+            await asyncio.sleep(app.state.chunk_delay * len(content) / max(app.state.chunk_chars, 1))
+        return JSONResponse({
+            'id': f'chatcmpl-{app.state.calls}', 'object': 'chat.completion', 'created': int(time.time()),
+            'model': body['model'],
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 10, 'completion_tokens': 5, 'total_tokens': 15},
+        })
+
+    @app.get('/stats')
+    async def stats():
+        return {'calls': app.state.calls, 'errors': app.state.error_counts}
+
+    return app
+
+
+def start_in_thread(port: int = 18555, **kwargs) -> FastAPI:
+    """
+    在后台线程中启动模拟接口并返回 app，可以修改 app.state 调整行为
+    """
+    app: FastAPI = create_app(**kwargs)
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='error'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return app
+
+
+def _serve(port: int, kwargs: dict) -> None:
+    uvicorn.run(create_app(**kwargs), host='127.0.0.1', port=port, log_level='error')
+
+
+def start_in_process(port: int = 18555, **kwargs) -> multiprocessing.Process:
+    """
+    在子进程中启动模拟接口，避免与被测代码争用 GIL，统计数据通过 GET /stats 获取
+    """
+    process = multiprocessing.Process(target=_serve, args=(port, kwargs), daemon=True)
+    process.start()
+    deadline: float = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.terminate()
+    raise RuntimeError(f'模拟接口未能在端口 {port} 启动')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=18555)
+    parser.add_argument('--latency', type=float, default=0.0, help='每次请求的模拟延迟（秒）')
+    parser.add_argument('--reply-chars', type=int, default=0, help='模拟回复的字数，0为回显')
+    parser.add_argument('--chunk-chars', type=int, default=4, help='流式返回时每个 chunk 的字数')
+    parser.add_argument('--chunk-delay', type=float, default=0.0, help='流式返回时 chunk 之间的间隔（秒）')
+    parser.add_argument('--jitter', type=float, default=0.0, help='每次请求额外的随机延迟上限（秒）')
+    for name in ERRORS:
+        parser.add_argument(f'--{name.replace("_", "-")}', type=float, default=0.0, help=f'返回 {name} 错误的概率')
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.latency, args.reply_chars, args.chunk_chars, args.chunk_delay, args.jitter,
+                           {name: getattr(args, name) for name in ERRORS}),
+                host='127.0.0.1', port=args.port, log_level='error')
@@ -0,0 +1,93 @@
+"""
+语义缓存基准测试
+向一个分区写入 N 条随机问题，测量写入、未命中检索、改写后命中检索的延迟，以及超出上限时淘汰的耗时
+用法: python benchmarks/semantic.py -n 100000 --queries 1000
+"""
+import time
+import random
+import argparse
+import tempfile
+from pathlib import Path
+from typing import List
+
+from _bootstrap import load_plugin, plugin_module
+
+WORDS: List[str] = ['怎么', '如何', '为什么', '可以', '设置', '机器人', '会话', '预设', '插件', '指令', '删除', '创建',
+                    '加入', '权限', '管理员', '群聊', '私聊', '代理', '配置', '文件', '模型', '回复', '历史', '记录']
+
+
+def question(rand: random.Random) -> str:
+    return ''.join(rand.choice(WORDS) for _ in range(rand.randint(4, 10))) + '？'
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)]
+
+
+def report(name: str, values: List[float]) -> None:
+    print(f'{name:<18}{len(values):>8}{percentile(values, 50) * 1e6:>12.1f}us{percentile(values, 99) * 1e6:>12.1f}us')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=100000, help='缓存条数')
+    parser.add_argument('--queries', type=int, default=1000, help='检索次数')
+    parser.add_argument('--dim', type=int, default=256, help='哈希向量维度')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_path: Path = Path(tmp)
+        plugin_name: str = load_plugin(history_save_path=tmp_path / 'plugin', preset_path=tmp_path / 'presets')
+        semantic = plugin_module(plugin_name, 'semantic')
+        cache = semantic.SemanticCache(semantic.HashingEmbedder(dim=args.dim), 0.9, args.n)
+        partition: str = cache.partition_key('gpt-3.5-turbo', [{'role': 'user', 'content': 'preset'}])
+        rand: random.Random = random.Random(0)
+        questions: List[str] = [question(rand) for _ in range(args.n)]
+
+        embed_times: List[float] = []
+        put_times: List[float] = []
+        for q in questions:
+            start: float = time.perf_counter()
+            vector = cache.embed(q)
+            embed_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            cache.put(partition, vector, f'answer of {q}')
+            put_times.append(time.perf_counter() - start)
+
+        miss_times: List[float] = []
+        hits_before: int = cache.hits
+        for _ in range(args.queries):
+            vector = cache.embed(question(rand) + '呢')
+            start = time.perf_counter()
+            cache.get(partition, vector)
+            miss_times.append(time.perf_counter() - start)
+        random_hits: int = cache.hits - hits_before
+        hits_before = cache.hits
+        hit_times: List[float] = []
+        for q in rand.sample(questions, args.queries):
+            vector = cache.embed('请问' + q)
+            start = time.perf_counter()
+            cache.get(partition, vector)
+            hit_times.append(time.perf_counter() - start)
+
+        evict_times: List[float] = []
+        for q in questions[:args.queries]:
+            vector = cache.embed(q + '！')
+            start = time.perf_counter()
+            cache.put(partition, vector, 'x')
+            evict_times.append(time.perf_counter() - start)
+
+        print(f'{"":<18}{"count":>8}{"p50":>14}{"p99":>14}')
+        report('embed', embed_times)
+        report('put', put_times)
+        report('get (random)', miss_times)
+        report('get (paraphrase)', hit_times)
+        report('put with evict', evict_times)
+        print(f'paraphrase hit rate {(cache.hits - hits_before) / args.queries:.1%}, '
+              f'random question hit rate {random_hits / args.queries:.1%}, '
+              f'entries {cache.size}, evictions {cache.evictions}')
+
+
+if __name__ == '__main__':
+    main()
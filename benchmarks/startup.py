@@ -0,0 +1,66 @@
+"""
+启动加载基准测试
+生成 N 个模拟会话文件，比较串行读取、线程池/进程池并行读取以及只读取索引的耗时
+用法: python benchmarks/startup.py -n 10000 --messages 50 --workers 4
+"""
+import time
+import argparse
+import tempfile
+from pathlib import Path
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Callable, List, Optional
+
+from _bootstrap import load_plugin, plugin_module
+
+
+def generate(stores, store, num: int, messages: int) -> None:
+    changes: List = []
+    for i in range(num):
+        group: str = str(10000 + i % 1000)
+        meta: dict = {'session_id': f'bench{i}', 'creator': i, 'users': [i], 'group': group, 'name': 'ChatGPT',
+                      'creation_time': 1700000000 + i, 'chat_memory_max': 10, 'history_max': 100, 'basic_len': 2,
+                      'summary': '', 'prefix': ''}
+        chat_log: List[dict] = [{'role': 'user' if j % 2 else 'assistant', 'content': f'第{j}条消息 ' * 20}
+                                for j in range(messages)]
+        changes.append(stores.SessionChanges(meta['session_id'], f'{group}_ChatGPT_{i}_{meta["creation_time"]}',
+                                             meta, chat_log, True, True))
+    store.apply(changes, ())
+
+
+def measure(name: str, load: Callable[[Optional[Executor]], list], executor: Optional[Executor] = None) -> None:
+    start: float = time.perf_counter()
+    sessions: list = load(executor)
+    print(f'{name:<32}{len(sessions):>10}{(time.perf_counter() - start) * 1000:>12.1f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=10000, help='会话数量')
+    parser.add_argument('--messages', type=int, default=50, help='每个会话的消息数量')
+    parser.add_argument('--workers', type=int, default=4, help='并行读取的线程/进程数')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_path: Path = Path(tmp)
+        plugin_name: str = load_plugin(history_save_path=tmp_path / 'plugin', preset_path=tmp_path / 'presets')
+        stores = plugin_module(plugin_name, 'stores')
+        json_dir: Path = tmp_path / 'json'
+        json_dir.mkdir()
+        generate(stores, stores.JsonDirStore(json_dir, 2.0), args.n, args.messages)
+        generate(stores, stores.SqliteStore(tmp_path / 'sessions.db'), args.n, args.messages)
+        print(f'{"":<32}{"sessions":>10}{"time":>14}')
+        measure('json serial', lambda e: stores.JsonDirStore(json_dir, 2.0).load(e))
+        with ThreadPoolExecutor(args.workers) as executor:
+            measure(f'json threads({args.workers})', lambda e: stores.JsonDirStore(json_dir, 2.0).load(e), executor)
+        with ProcessPoolExecutor(args.workers) as executor:
+            measure(f'json processes({args.workers})', lambda e: stores.JsonDirStore(json_dir, 2.0).load(e),
+                    executor)
+            measure(f'json index processes({args.workers})',
+                    lambda e: stores.JsonDirStore(json_dir, 2.0).load_index(e), executor)
+        measure('json index serial', lambda e: stores.JsonDirStore(json_dir, 2.0).load_index(e))
+        measure('sqlite', lambda e: stores.SqliteStore(tmp_path / 'sessions.db').load(e))
+        measure('sqlite index', lambda e: stores.SqliteStore(tmp_path / 'sessions.db').load_index(e))
+
+
+if __name__ == '__main__':
+    main()
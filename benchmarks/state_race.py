@@ -0,0 +1,153 @@
+"""
+多进程共用状态后端的竞争测试
+启动两个各自加载插件的 worker 进程（各有自己的会话文件夹，相当于两个容器），通过同一个 Redis 共用会话状态，
+同一用户在同一个群中从两个进程同时发送消息，结束后检查 Redis 中该会话的聊天记录是否包含全部消息、没有重复
+默认在本进程中用 fakeredis 启动一个本地的 Redis（需要 pip install fakeredis），也可以用 --redis-url 指定真实的 Redis
+用法: python benchmarks/state_race.py --messages 5 --rounds 3
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+REDIS_PREFIX: str = 'bench:'
+GROUP_ID: int = 100
+USER_ID: int = 2
+SELF_ID: int = 10000
+WORKERS: Tuple[str, ...] = ('a', 'b')
+
+
+async def run_worker(args: argparse.Namespace, plugin_name: str) -> Dict[str, Any]:
+    import redis.asyncio as redis
+    from redis.commands.core import AsyncScript
+    import nonebot
+    from nonebot.message import handle_event
+    from nonebot.adapters.onebot.v11 import Adapter
+    from _bootstrap import plugin_module
+    from load import BenchBot, EventFactory, FAILURE_MARKERS
+
+    driver = nonebot.get_driver()
+    bot: BenchBot = BenchBot(nonebot.get_adapter(Adapter), str(SELF_ID))
+    sessions = plugin_module(plugin_name, 'sessions')
+    factory: EventFactory = EventFactory(1, 1, 0.0, 0.0, 0, 0)
+    client = redis.from_url(args.redis_url)
+    # fakeredis 的 TCP 服务返回错误后会断开连接，提前载入状态后端的脚本，避免 EVALSHA 返回 NOSCRIPT
+    for script in vars(sessions.state_backend).values():
+        if isinstance(script, AsyncScript):
+            await client.script_load(script.script)
+    await driver._lifespan.startup()
+    await sessions.session_container.wait_loaded()
+    # 第一个 worker 先创建会话，之后两个 worker 同时开始发送
+    if args.worker == WORKERS[0]:
+        await handle_event(bot, factory._event('/talk hello', USER_ID, GROUP_ID))
+    await client.incr(f'{REDIS_PREFIX}ready')
+    while int(await client.get(f'{REDIS_PREFIX}ready')) < len(WORKERS):
+        await asyncio.sleep(0.01)
+    await client.aclose()
+    sent: int = len(bot.replies)
+    start: float = time.perf_counter()
+    await asyncio.gather(*(handle_event(bot, factory._event(f'/talk {args.worker} {i}', USER_ID, GROUP_ID))
+                           for i in range(args.messages)))
+    elapsed: float = time.perf_counter() - start
+    failures: int = sum(any(marker in reply for marker in FAILURE_MARKERS) for reply in bot.replies[sent:])
+    stats: Dict[str, float] = sessions.state_backend.stats()
+    await driver._lifespan.shutdown()
+    return {'worker': args.worker, 'elapsed': elapsed, 'failures': failures, 'state': stats}
+
+
+def worker_main(args: argparse.Namespace) -> None:
+    from _bootstrap import load_plugin
+    plugin_name: str = load_plugin(history_save_path=args.history, preset_path=args.history.parent / 'presets',
+                                   openai_api_base=f'http://127.0.0.1:{args.port}/v1', state_backend='redis',
+                                   redis_url=args.redis_url, redis_prefix=REDIS_PREFIX,
+                                   history_max=args.messages * 8 + 20)
+    print(json.dumps(asyncio.run(run_worker(args, plugin_name))), flush=True)
+
+
+def start_fake_redis(port: int) -> str:
+    try:
+        from fakeredis import TcpFakeServer
+    except ModuleNotFoundError:
+        sys.exit('没有指定 --redis-url 时需要安装 fakeredis: pip install fakeredis')
+    server = TcpFakeServer(('127.0.0.1', port), server_type='redis')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'redis://127.0.0.1:{port}/0'
+
+
+def check(redis_url: str, messages: int) -> Tuple[List[str], List[str]]:
+    """
+    返回 Redis 中会话缺少的消息与重复的消息
+    """
+    import redis
+    client = redis.Redis.from_url(redis_url, decode_responses=True)
+    contents: List[str] = []
+    for key in client.scan_iter(f'{REDIS_PREFIX}{{{GROUP_ID}}}:session:*'):
+        contents += [m['content'] for m in json.loads(client.get(key))['chat_log'] if m['role'] == 'user']
+    expected: List[str] = [f'{worker} {i}' for worker in WORKERS for i in range(messages)]
+    return [c for c in expected if c not in contents], sorted({c for c in contents if contents.count(c) > 1})
+
+
+def run_round(args: argparse.Namespace, tmp_path: Path) -> bool:
+    import redis
+    # 只清理本测试的键，--redis-url 指定的 Redis 中的其他数据不受影响
+    client = redis.Redis.from_url(args.redis_url)
+    for key in client.scan_iter(f'{REDIS_PREFIX}*'):
+        client.delete(key)
+    processes: List[subprocess.Popen] = [
+        subprocess.Popen([sys.executable, __file__, '--worker', worker, '--history', str(tmp_path / worker),
+                          '--redis-url', args.redis_url, '--port', str(args.port), '--messages', str(args.messages)],
+                         stdout=subprocess.PIPE, text=True)
+        for worker in WORKERS]
+    results: List[Dict[str, Any]] = []
+    for process in processes:
+        out, _ = process.communicate(timeout=120)
+        if process.returncode != 0:
+            print(f'worker 退出码 {process.returncode}')
+            return False
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    missing, duplicated = check(args.redis_url, args.messages)
+    for result in results:
+        print(f'  worker {result["worker"]}: 用时 {result["elapsed"]:.2f}s，失败 {result["failures"]}，'
+              f'状态后端 {result["state"]}')
+    print(f'  缺少的消息 {missing or "无"}，重复的消息 {duplicated or "无"}')
+    return not missing and not duplicated and not any(result['failures'] for result in results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=5, help='每个 worker 同时发送的消息数')
+    parser.add_argument('--rounds', type=int, default=3, help='重复的轮数')
+    parser.add_argument('--redis-url', default=None, help='使用的 Redis，不指定时用 fakeredis 在本地启动一个')
+    parser.add_argument('--redis-port', type=int, default=16379, help='fakeredis 监听的端口')
+    parser.add_argument('--latency', type=float, default=0.05, help='模拟接口的延迟（秒）')
+    parser.add_argument('--port', type=int, default=18555)
+    parser.add_argument('--worker', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--history', type=Path, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker is not None:
+        worker_main(args)
+        return
+
+    from mock_openai import start_in_process
+    args.redis_url = args.redis_url or start_fake_redis(args.redis_port)
+    mock = start_in_process(args.port, latency=args.latency)
+    passed: int = 0
+    try:
+        for num in range(args.rounds):
+            print(f'第 {num + 1} 轮')
+            with tempfile.TemporaryDirectory() as tmp:
+                passed += run_round(args, Path(tmp))
+    finally:
+        mock.terminate()
+    print(f'通过 {passed}/{args.rounds} 轮')
+    sys.exit(0 if passed == args.rounds else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+流式回复基准测试
+模拟接口逐字返回长回复，比较非流式与流式请求时用户看到第一段回复的时间以及发送的分段数
+用法: python benchmarks/streaming.py --reply-chars 1000 --chunk-delay 0.01
+"""
+import time
+import argparse
+import asyncio
+import tempfile
+from pathlib import Path
+from typing import List
+
+from _bootstrap import load_plugin, plugin_module
+from mock_openai import start_in_thread
+
+
+async def run(name: str, sessions, stream: bool, base_url: str) -> None:
+    session = sessions.Session([], 1, '10000', 'bench', 10, is_save=False, basic_len=0)
+    session.update('写一篇长文章', 'user')
+    segment_times: List[float] = []
+    start: float = time.perf_counter()
+
+    async def on_segment(segment: str) -> None:
+        segment_times.append(time.perf_counter() - start)
+
+    answer: str = await session.ask(sessions.session_container.api_keys, base_url, max_tokens=4096,
+                                    on_segment=on_segment if stream else None)
+    total: float = time.perf_counter() - start
+    first: float = segment_times[0] if segment_times else total
+    print(f'{name:<12}{len(answer):>8}{max(len(segment_times), 1):>10}{first * 1000:>14.1f}ms{total * 1000:>12.1f}ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reply-chars', type=int, default=1000, help='模拟回复的字数')
+    parser.add_argument('--chunk-delay', type=float, default=0.01, help='chunk 之间的间隔（秒），每个 chunk 4 个字')
+    parser.add_argument('--port', type=int, default=18555)
+    args = parser.parse_args()
+
+    base_url: str = f'http://127.0.0.1:{args.port}/v1'
+    start_in_thread(args.port, reply_chars=args.reply_chars, chunk_delay=args.chunk_delay)
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_path: Path = Path(tmp)
+        plugin_name: str = load_plugin(history_save_path=tmp_path / 'plugin', preset_path=tmp_path / 'presets',
+                                       openai_api_base=base_url)
+        sessions = plugin_module(plugin_name, 'sessions')
+
+        async def bench():
+            print(f'{"":<12}{"chars":>8}{"segments":>10}{"first reply":>16}{"total":>14}')
+            await run('blocking', sessions, False, base_url)
+            await run('stream', sessions, True, base_url)
+
+        asyncio.run(bench())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import json
+import time
+import hashlib
+from pathlib import Path
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from nonebot.log import logger
+
+from .stores import atomic_write, dump_records
+
+
+def context_key(model: str, temperature: float, max_tokens: int, messages: List[Dict[str, str]]) -> str:
+    """
+    请求参数与上下文的哈希，作为回复缓存的 key
+    """
+    payload: str = json.dumps([model, temperature, max_tokens, messages], ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    回复缓存，按上下文哈希缓存回复，超过 max_entries 条时淘汰最久未使用的，超过 ttl 秒过期
+    设置 path 时启动时从文件读取，关闭时写入文件
+    """
+
+    def __init__(self, max_entries: int, ttl: float, path: Optional[Path] = None):
+        self.max_entries: int = max_entries
+        self.ttl: float = ttl
+        self.path: Optional[Path] = path
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[str]:
+        entry: Optional[Tuple[float, str]] = self._entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, answer: str) -> None:
+        self._entries[key] = (time.time() + self.ttl, answer)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def load(self) -> None:
+        if self.path is None or not self.path.exists():
+            return
+        now: float = time.time()
+        with open(self.path, 'r', encoding='utf8') as f:
+            for line in f:
+                try:
+                    record: dict = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record['expires'] > now:
+                    self._entries[record['key']] = (record['expires'], record['answer'])
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        logger.info(f'读取回复缓存 {len(self._entries)} 条')
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        now: float = time.time()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(self.path, dump_records([{'key': key, 'expires': expires, 'answer': answer}
+                                              for key, (expires, answer) in self._entries.items() if expires > now]))
+
+    def stats(self) -> Dict[str, float]:
+        lookups: int = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
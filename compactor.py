@@ -0,0 +1,203 @@
+import time
+import asyncio
+import contextvars
+from typing import Awaitable, Callable, Dict, List, Optional, Type, TYPE_CHECKING
+
+from nonebot.log import logger
+
+from .tracing import Span, tracer
+from .history import Message
+
+if TYPE_CHECKING:
+    from .sessions import Session
+
+# 摘要在请求中的格式，固定放在预设之后
+SUMMARY_TEMPLATE: str = '以下是之前对话内容的摘要，请结合它继续对话：\n{}'
+SUMMARY_PROMPT: str = ('请把下面的对话整理为简洁的摘要，保留人物设定、关键事实、双方的约定与未完成的话题，'
+                       '使用与对话相同的语言，只输出摘要本身，不超过 {} 字。')
+
+Complete = Callable[[List[Dict[str, str]], int], Awaitable[str]]
+
+
+def summary_message(summary: str) -> Message:
+    return Message('system', SUMMARY_TEMPLATE.format(summary))
+
+
+def format_transcript(messages: List[Dict[str, str]]) -> str:
+    return '\n'.join(f'{m.get("role", "user")}: {m.get("content") or ""}' for m in messages)
+
+
+class Summarizer:
+    """
+    把之前的摘要与新的一段对话合并为新的摘要，max_tokens 为摘要的长度上限
+    """
+    name: str = ''
+
+    def __init__(self, max_tokens: int, complete: Optional[Complete] = None):
+        self.max_tokens: int = max_tokens
+        self.complete: Optional[Complete] = complete
+
+    async def summarize(self, summary: str, messages: List[Dict[str, str]]) -> str:
+        raise NotImplementedError
+
+
+class ChatSummarizer(Summarizer):
+    """
+    请求接口生成摘要，complete 为发出请求的函数，参数为请求的消息与回复的 max_tokens
+    """
+    name = 'chat'
+
+    async def summarize(self, summary: str, messages: List[Dict[str, str]]) -> str:
+        transcript: str = format_transcript(messages)
+        if summary:
+            transcript = f'之前的摘要：\n{summary}\n\n新的对话：\n{transcript}'
+        return (await self.complete([{'role': 'system', 'content': SUMMARY_PROMPT.format(self.max_tokens)},
+                                     {'role': 'user', 'content': transcript}], self.max_tokens)).strip()
+
+
+class ExtractiveSummarizer(Summarizer):
+    """
+    不请求接口：每条消息只保留开头的 line_chars 个字接在之前的摘要后面，超出长度时丢弃最早的部分
+    用于离线测试，或不希望为压缩额外花费 token 的情况
+    """
+    name = 'extractive'
+
+    def __init__(self, max_tokens: int, complete: Optional[Complete] = None, line_chars: int = 60):
+        super().__init__(max_tokens, complete)
+        self.line_chars: int = line_chars
+
+    async def summarize(self, summary: str, messages: List[Dict[str, str]]) -> str:
+        lines: List[str] = summary.splitlines() if summary else []
+        for m in messages:
+            content: str = ' '.join((m.get('content') or '').split())
+            if content:
+                lines.append(f'{m.get("role", "user")}: {content[:self.line_chars]}')
+        # 中文大约一个字一个 token，按字数截断
+        while len(lines) > 1 and sum(len(line) + 1 for line in lines) > self.max_tokens:
+            lines.pop(0)
+        return '\n'.join(lines)
+
+
+SUMMARIZERS: Dict[str, Type[Summarizer]] = {
+    ChatSummarizer.name: ChatSummarizer,
+    ExtractiveSummarizer.name: ExtractiveSummarizer,
+}
+
+
+def register_summarizer(summarizer: Type[Summarizer]) -> Type[Summarizer]:
+    """
+    注册自定义的摘要方式，之后可以在配置 compact_summarizer 中使用它的 name
+    """
+    SUMMARIZERS[summarizer.name] = summarizer
+    return summarizer
+
+
+def create_summarizer(name: str, max_tokens: int, complete: Complete) -> Summarizer:
+    if name not in SUMMARIZERS:
+        logger.warning(f'未知的摘要方式 {name}，已使用接口生成摘要')
+        name = ChatSummarizer.name
+    return SUMMARIZERS[name](max_tokens, complete)
+
+
+class Compactor:
+    """
+    在后台压缩会话的历史记录：发送窗口（最新的 chat_memory_max 条）之前尚未压缩的消息达到 threshold 条时，
+    与之前的摘要一起总结为新的摘要，被压缩的消息从历史记录中移除，不阻塞对话的请求
+    apply 负责把摘要写回会话，会话已被删除或期间历史记录被替换时返回 False，本次结果作废
+    """
+
+    def __init__(self, summarizer: Summarizer, threshold: int,
+                 apply: Callable[["Session", str, List[Message]], Awaitable[bool]],
+                 retry_interval: float = 60.0):
+        self.summarizer: Summarizer = summarizer
+        self.threshold: int = max(threshold, 1)
+        self.apply: Callable[["Session", str, List[Message]], Awaitable[bool]] = apply
+        self.retry_interval: float = retry_interval
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._retry_at: Dict[str, float] = {}
+        self.compactions: int = 0
+        self.failures: int = 0
+        self.discarded: int = 0
+        self.messages_compacted: int = 0
+        self.last_latency: float = 0.0
+        self.total_latency: float = 0.0
+
+    @staticmethod
+    def backlog(session: "Session") -> int:
+        """
+        发送窗口之前尚未压缩的消息数量
+        """
+        return len(session.history.recent) - session.chat_memory_max
+
+    def schedule(self, session: "Session") -> None:
+        if session.session_id in self._tasks or self.backlog(session) < self.threshold:
+            return
+        retry_at: Optional[float] = self._retry_at.get(session.session_id)
+        if retry_at is not None:
+            if retry_at > time.monotonic():
+                return
+            del self._retry_at[session.session_id]
+        # 在空的 context 中创建任务，不计入触发压缩的那次对话的 trace，只记下该 trace 的 id
+        parent: Optional[Span] = tracer.current_span
+        task: asyncio.Task = contextvars.Context().run(asyncio.get_running_loop().create_task,
+                                                       self._compact(session, parent.trace_id if parent else None))
+        self._tasks[session.session_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(session.session_id, None))
+
+    async def _compact(self, session: "Session", link: Optional[str] = None) -> None:
+        with tracer.span('session.compact', background=True, session=session.name,
+                         **({'link': link} if link else {})):
+            compacted: List[Message] = session.history.oldest(self.backlog(session))
+            start: float = time.perf_counter()
+            try:
+                summary: str = await self.summarizer.summarize(session.summary, compacted)
+                if not summary:
+                    raise ValueError('摘要为空')
+                applied: bool = await self.apply(session, summary, compacted)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failures += 1
+                self._retry_at[session.session_id] = time.monotonic() + self.retry_interval
+                tracer.set_error(type(e).__name__)
+                logger.warning(f'压缩会话 {session.name} 的历史记录失败，{self.retry_interval:.0f} 秒后重试\n{type(e)}:{e}')
+                return
+            self._retry_at.pop(session.session_id, None)
+            if not applied:
+                self.discarded += 1
+                return
+            latency: float = time.perf_counter() - start
+            self.compactions += 1
+            self.messages_compacted += len(compacted)
+            self.last_latency = latency
+            self.total_latency += latency
+            tracer.set_attribute('messages', len(compacted))
+            logger.debug(f'会话 {session.name} 压缩了 {len(compacted)} 条消息，耗时 {latency:.2f}s')
+
+    def forget(self, session: "Session") -> None:
+        """
+        会话被删除时调用，取消正在进行的压缩并清除重试时间
+        """
+        self._retry_at.pop(session.session_id, None)
+        task: Optional[asyncio.Task] = self._tasks.get(session.session_id)
+        if task is not None:
+            task.cancel()
+
+    async def close(self) -> None:
+        tasks: List[asyncio.Task] = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'running': len(self._tasks),
+            'retry_pending': len(self._retry_at),
+            'compactions': self.compactions,
+            'failures': self.failures,
+            'discarded': self.discarded,
+            'messages_compacted': self.messages_compacted,
+            'last_latency': self.last_latency,
+            'avg_latency': self.total_latency / self.compactions if self.compactions else 0.0,
+        }
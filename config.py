@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import List, Union
+from typing import List, Union, Dict
 
 from nonebot import get_driver
 from pydantic import Extra, BaseModel, validator
@@ -11,27 +11,93 @@ from nonebot import get_plugin_config
 class Config(BaseModel, extra=Extra.ignore, arbitrary_types_allowed=True):
     api_key: Union["APIKeyPool", str, List[str]] = None
     key_load_balancing: bool = False
+    key_cooldown: float = 20.0
+    key_probe_interval: float = 600.0
+    hedge_requests: bool = False
+    hedge_percentile: float = 95.0
+    hedge_min_delay: float = 1.0
+    key_rpm: int = 0
+    key_tpm: int = 0
+    global_rpm: int = 0
+    rate_limit_max_wait: float = 30.0
+    user_max_pending: int = 2
+    group_weights: Dict[str, int] = {}
+    response_cache: bool = False
+    response_cache_any_temperature: bool = False
+    response_cache_max: int = 1000
+    response_cache_ttl: float = 86400.0
+    response_cache_path: Path = None
+    semantic_cache: bool = False
+    semantic_cache_threshold: float = 0.85
+    semantic_cache_max: int = 10000
+    semantic_cache_embedder: str = 'hashing'
+    semantic_cache_model: str = ''
     history_save_path: Path = Path("data/ChatHistory").absolute()
+    save_interval: float = 1.0
+    log_compact_ratio: float = 2.0
+    session_store: str = 'json'
+    sqlite_path: Path = None
+    lazy_load_history: bool = False
+    history_cache_max: int = 0
+    history_cache_max_bytes: int = 0
+    load_workers: int = 1
+    load_with_processes: bool = False
+    state_backend: str = 'memory'
+    redis_url: str = 'redis://localhost:6379/0'
+    redis_prefix: str = 'chatgpt:'
+    state_lock_ttl: float = 120.0
     preset_path: Path = Path("data/Presets").absolute()
+    preset_reload_interval: float = 5.0
     openai_proxy: str = None
     openai_api_base: str = "https://api.openai.com/v1"
+    http2: bool = False
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 5.0
+    openai_max_retries: int = None
     chat_memory_max: int = 10
     history_max: int = 100
+    compact_threshold: int = 0
+    compact_summarizer: str = 'chat'
+    compact_model: str = ''
+    compact_max_tokens: int = 512
     temperature: float = 0.5
     model_name: str = 'gpt-3.5-turbo'
     allow_private: bool = True
     change_chat_to: str = None
     max_tokens: int = 1024
+    tokenizer: str = 'auto'
+    context_windows: Dict[str, int] = {}
+    stream: bool = False
+    stream_flush_chars: int = 200
+    stream_flush_interval: float = 3.0
+    turn_batch_window: float = 0.0
+    dispatch_concurrency: int = 0
+    dispatch_lanes: Dict[str, int] = {}
+    dispatch_queue_max: int = 100
     auto_create_preset_info: bool = True
     customize_prefix: str = '/'
     customize_talk_cmd: str = 'talk'
     timeout: int = 10
     default_only_admin: bool = False
     at_sender: bool = True
+    metrics: bool = False
+    metrics_path: str = '/chatgpt/metrics'
+    tracing: bool = False
+    trace_slowest: int = 10
 
     @validator('api_key')
     def api_key_validator(cls, v) -> APIKeyPool:
         return APIKeyPool(v)
 
+    @validator('compact_threshold')
+    def compact_threshold_validator(cls, v, values):
+        # 历史记录要能容纳发送窗口与待压缩的消息，否则消息会在压缩前被丢弃
+        if v > 0 and 'history_max' in values and 'chat_memory_max' in values \
+                and values['history_max'] <= values['chat_memory_max'] + v:
+            raise ValueError(f'history_max({values["history_max"]}) 需要大于 chat_memory_max({values["chat_memory_max"]}) '
+                             f'与 compact_threshold({v}) 之和')
+        return v
+
 
 plugin_config = get_plugin_config(Config)
@@ -36,3 +36,45 @@ class NoApiKeyError(ApiKeyError):
 
     def __str__(self) -> str:
         return self.ErrorInfo
+
+
+class RateLimitedError(Exception):
+    def __init__(self, ErrorInfo):
+        self.ErrorInfo = ErrorInfo
+
+    def __str__(self) -> str:
+        return self.ErrorInfo
+
+
+class SessionStateError(Exception):
+    def __init__(self, ErrorInfo):
+        self.ErrorInfo = ErrorInfo
+
+    def __str__(self) -> str:
+        return self.ErrorInfo
+
+
+class BusyError(Exception):
+    def __init__(self, ErrorInfo):
+        self.ErrorInfo = ErrorInfo
+
+    def __str__(self) -> str:
+        return self.ErrorInfo
+
+
+class SessionWriteError(Exception):
+    def __init__(self, ErrorInfo, session_ids=()):
+        self.ErrorInfo = ErrorInfo
+        # 写入失败的会话，其余会话已经写入成功
+        self.session_ids = set(session_ids)
+
+    def __str__(self) -> str:
+        return self.ErrorInfo
+
+
+class PresetNotFoundError(Exception):
+    def __init__(self, ErrorInfo):
+        self.ErrorInfo = ErrorInfo
+
+    def __str__(self) -> str:
+        return self.ErrorInfo
@@ -0,0 +1,158 @@
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, List, Optional
+
+from nonebot.log import logger
+
+from .tracing import tracer
+from .custom_errors import BusyError
+
+# 默认的优先级顺序：主人、群管理员、群内普通用户、私聊
+LANES: List[str] = ['superuser', 'admin', 'user', 'private']
+BUSY_REPLY: str = '当前请求过多，请稍后再试'
+
+
+class _Lane:
+    def __init__(self, name: str, priority: int, limit: int):
+        self.name: str = name
+        self.priority: int = priority
+        # 本道同时请求数上限，0 表示只受总并发数限制
+        self.limit: int = limit
+        self.running: int = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+        self.admitted: int = 0
+        self.shed: int = 0
+        self.total_wait: float = 0.0
+        self.max_wait: float = 0.0
+
+    @property
+    def full(self) -> bool:
+        return 0 < self.limit <= self.running
+
+
+class Dispatcher:
+    """
+    按优先级分道调度对接口的请求：总并发数不超过 concurrency，每道另有各自的并发上限
+    有空闲时优先放行优先级高的道，同一道内先到先得；排队的请求总数达到 queue_max 时，
+    丢弃优先级更低的道中最后排队的请求，没有更低的道时新请求直接返回繁忙，不在内存中无限堆积
+    concurrency 为 0 时不做调度
+    """
+
+    def __init__(self, concurrency: int, lanes: Dict[str, int], queue_max: int):
+        self.concurrency: int = concurrency
+        self.queue_max: int = max(queue_max, 0)
+        order: List[str] = []
+        for name in lanes:
+            if name not in LANES:
+                logger.warning(f'未知的请求分道 {name}，可选 {"/".join(LANES)}')
+            elif name not in order:
+                order.append(name)
+        order.extend(name for name in LANES if name not in order)
+        self._lanes: Dict[str, _Lane] = {name: _Lane(name, i, max(lanes.get(name, 0), 0))
+                                         for i, name in enumerate(order)}
+        self.running: int = 0
+        self.queued: int = 0
+        self.rejected: int = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.concurrency > 0
+
+    def _can_run(self, lane: _Lane) -> bool:
+        return self.running < self.concurrency and not lane.full
+
+    def _grant(self, lane: _Lane) -> None:
+        lane.running += 1
+        lane.admitted += 1
+        self.running += 1
+
+    def _shed_lower(self, priority: int) -> bool:
+        """
+        队列已满时丢弃优先级最低的道中最后排队的请求，为优先级更高的请求腾出位置
+        """
+        for lane in sorted(self._lanes.values(), key=lambda x: -x.priority):
+            if lane.priority <= priority:
+                return False
+            while lane.waiters:
+                future: asyncio.Future = lane.waiters.pop()
+                self.queued -= 1
+                if future.done():
+                    continue
+                lane.shed += 1
+                future.set_exception(BusyError(BUSY_REPLY))
+                return True
+        return False
+
+    def _dispatch(self) -> None:
+        for lane in sorted(self._lanes.values(), key=lambda x: x.priority):
+            while lane.waiters and self._can_run(lane):
+                future: asyncio.Future = lane.waiters.popleft()
+                self.queued -= 1
+                if future.done():
+                    continue
+                self._grant(lane)
+                future.set_result(None)
+            if self.running >= self.concurrency:
+                return
+
+    async def acquire(self, name: str) -> None:
+        lane: _Lane = self._lanes.get(name) or self._lanes['user']
+        if self._can_run(lane) and not lane.waiters:
+            self._grant(lane)
+            return
+        if self.queued >= self.queue_max and not self._shed_lower(lane.priority):
+            lane.shed += 1
+            self.rejected += 1
+            raise BusyError(BUSY_REPLY)
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+        lane.waiters.append(future)
+        self.queued += 1
+        start: float = time.perf_counter()
+        start_ns: int = time.time_ns()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # 已经分到了名额才被取消，归还名额
+                self.release(lane.name)
+            elif future in lane.waiters:
+                lane.waiters.remove(future)
+                self.queued -= 1
+            raise
+        wait: float = time.perf_counter() - start
+        lane.total_wait += wait
+        lane.max_wait = max(lane.max_wait, wait)
+        tracer.record('dispatch.wait', start_ns, lane=lane.name)
+
+    def release(self, name: str) -> None:
+        lane: _Lane = self._lanes.get(name) or self._lanes['user']
+        lane.running -= 1
+        self.running -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, name: str) -> AsyncIterator[None]:
+        """
+        取得 name 道的一个请求名额，繁忙时抛出 BusyError
+        """
+        if not self.enabled:
+            yield
+            return
+        await self.acquire(name)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+    def stats(self) -> List[Dict[str, object]]:
+        return [{
+            'lane': lane.name,
+            'running': lane.running,
+            'waiting': len(lane.waiters),
+            'admitted': lane.admitted,
+            'shed': lane.shed,
+            'max_wait': lane.max_wait,
+            'avg_wait': lane.total_wait / lane.admitted if lane.admitted else 0.0,
+        } for lane in self._lanes.values()]
@@ -0,0 +1,58 @@
+from collections import deque
+from typing import Deque, Dict, Optional
+
+
+class HedgePolicy:
+    """
+    对冲请求策略：请求超过最近成功请求延迟的 percentile 分位数仍未返回时，用另一个 key 同时再请求一次
+    样本不足 min_samples 个时使用 default_delay，延迟不小于 min_delay
+    """
+
+    def __init__(self, enabled: bool, percentile: float, min_delay: float, default_delay: float,
+                 window: int = 256, min_samples: int = 20):
+        self.enabled: bool = enabled
+        self.percentile: float = min(max(percentile, 0.0), 100.0)
+        self.min_delay: float = min_delay
+        self.default_delay: float = default_delay
+        self.min_samples: int = min_samples
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self.requests: int = 0
+        self.hedged: int = 0
+        self.hedge_wins: int = 0
+        # 全局每分钟请求数没有余量而放弃的对冲
+        self.rate_limited: int = 0
+        self.extra_prompt_tokens: int = 0
+        self.extra_completion_tokens: int = 0
+
+    def observe(self, latency: float) -> None:
+        self._latencies.append(latency)
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(int(len(ordered) * percentile / 100), len(ordered) - 1)]
+
+    def delay(self) -> Optional[float]:
+        """
+        本次请求的对冲延迟，未开启时返回 None
+        """
+        if not self.enabled:
+            return None
+        if len(self._latencies) < self.min_samples:
+            return max(self.default_delay, self.min_delay)
+        return max(self.latency_percentile(self.percentile), self.min_delay)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'requests': self.requests,
+            'hedged': self.hedged,
+            'hedge_rate': self.hedged / self.requests if self.requests else 0.0,
+            'hedge_wins': self.hedge_wins,
+            'rate_limited': self.rate_limited,
+            'extra_prompt_tokens': self.extra_prompt_tokens,
+            'extra_completion_tokens': self.extra_completion_tokens,
+            'delay': self.delay() or 0.0,
+            'p50': self.latency_percentile(50) or 0.0,
+            'p99': self.latency_percentile(99) or 0.0,
+        }
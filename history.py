@@ -0,0 +1,148 @@
+import sys
+import json
+import hashlib
+from weakref import WeakValueDictionary
+from collections import deque
+from collections.abc import Mapping
+from itertools import chain, islice
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+
+class Message(Mapping):
+    """
+    一条消息，只有 role 与 content 两个字段，比每条消息一个 dict 占用的内存少得多，role 使用驻留的字符串
+    实现了只读的 Mapping 接口，可以像 dict 一样读取；写入存储或发送请求时用 as_dict 转换
+    创建后不再修改，复制会话时多个会话直接共用同一个对象
+    """
+    __slots__ = ('role', 'content')
+    _KEYS: Tuple[str, str] = ('role', 'content')
+
+    def __init__(self, role: str, content: str):
+        self.role: str = sys.intern(role)
+        self.content: str = content
+
+    @classmethod
+    def from_dict(cls, data: Mapping) -> "Message":
+        if isinstance(data, Message):
+            return data
+        return cls(data.get('role') or 'user', data.get('content') or '')
+
+    def __getitem__(self, key: str) -> str:
+        if key == 'role':
+            return self.role
+        if key == 'content':
+            return self.content
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._KEYS)
+
+    def __len__(self) -> int:
+        return 2
+
+    def as_dict(self) -> Dict[str, str]:
+        return {'role': self.role, 'content': self.content}
+
+    def __repr__(self) -> str:
+        return f'Message({self.role!r}, {self.content!r})'
+
+
+def prefix_key(messages: Iterable[Mapping]) -> str:
+    """
+    预设内容的哈希，空的预设为空字符串
+    """
+    payload: List[List[str]] = [[m['role'], m['content']] for m in messages]
+    if not payload:
+        return ''
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf8')).hexdigest()[:32]
+
+
+class Prefix:
+    """
+    不可变的预设前缀，key 为内容的哈希；内容相同的预设在进程内只保存一份，由 intern_prefix 取得
+    """
+    __slots__ = ('key', 'messages', '__weakref__')
+
+    def __init__(self, key: str, messages: Tuple[Message, ...]):
+        self.key: str = key
+        self.messages: Tuple[Message, ...] = messages
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+
+# 没有会话引用的预设会自动移除
+_prefixes: "WeakValueDictionary[str, Prefix]" = WeakValueDictionary()
+EMPTY_PREFIX: Prefix = Prefix('', ())
+
+
+def intern_prefix(messages: Sequence[Mapping], key: Optional[str] = None) -> Prefix:
+    """
+    取得内容为 messages 的共享预设，已知 key 且该预设已在内存中时不需要转换与计算哈希
+    """
+    if key:
+        prefix: Optional[Prefix] = _prefixes.get(key)
+        if prefix is not None:
+            return prefix
+    converted: Tuple[Message, ...] = tuple(Message.from_dict(m) for m in messages)
+    key = key or prefix_key(converted)
+    if not key:
+        return EMPTY_PREFIX
+    return _prefixes.setdefault(key, Prefix(key, converted))
+
+
+class History:
+    """
+    会话的历史记录：共享的预设前缀 prefix，加上最多 history_max 条消息的环形缓冲 recent（collections.deque）
+    追加消息与淘汰最早的消息都是 O(1)，超出容量时自动淘汰预设之后最早的消息，预设不会被淘汰
+    预设与消息都不可变，复制会话（fork）时共用预设与消息对象，只复制 recent 中的引用，之后各自追加互不影响
+    """
+    __slots__ = ('prefix', 'recent')
+
+    def __init__(self, prefix: Prefix, recent: Iterable[Mapping], history_max: int):
+        self.prefix: Prefix = prefix
+        self.recent: Deque[Message] = deque((Message.from_dict(m) for m in recent), maxlen=max(history_max, 1))
+
+    @classmethod
+    def from_messages(cls, messages: Sequence[Mapping], basic_len: int, history_max: int,
+                      key: Optional[str] = None) -> "History":
+        """
+        前 basic_len 条为预设，key 为已知的预设哈希
+        """
+        return cls(intern_prefix(messages[:basic_len], key), islice(messages, basic_len, None), history_max)
+
+    def fork(self, history_max: int) -> "History":
+        return History(self.prefix, self.recent, history_max)
+
+    @property
+    def preset(self) -> Tuple[Message, ...]:
+        return self.prefix.messages
+
+    def __len__(self) -> int:
+        return len(self.preset) + len(self.recent)
+
+    def __iter__(self) -> Iterator[Message]:
+        return chain(self.preset, self.recent)
+
+    def __getitem__(self, index: int) -> Message:
+        if index < 0:
+            index += len(self)
+        if index < len(self.preset):
+            return self.preset[index]
+        return self.recent[index - len(self.preset)]
+
+    def append(self, message: Message) -> None:
+        self.recent.append(message)
+
+    def oldest(self, count: int) -> List[Message]:
+        """
+        预设之后最早的 count 条消息
+        """
+        return list(islice(self.recent, count))
+
+    def drop_oldest(self, count: int) -> None:
+        for _ in range(min(count, len(self.recent))):
+            self.recent.popleft()
+
+    def as_dicts(self) -> List[Dict[str, str]]:
+        return [m.as_dict() for m in self]
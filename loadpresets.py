@@ -1,12 +1,18 @@
 import json
+import asyncio
 from pathlib import Path
 from datetime import date
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+from concurrent.futures import Executor, ThreadPoolExecutor
 
+from nonebot import get_driver
 from nonebot.log import logger
 from pydantic import BaseModel, ValidationError, validator
 
 from .config import plugin_config
+from .stores import atomic_write
+from .history import Prefix, intern_prefix
+from .custom_errors import PresetNotFoundError
 
 # 尝试引用 chardet，非必须，不存在也不会报错
 try:
@@ -98,12 +104,13 @@ def create_preset2json(prompt: list, filepath: Path, encoding: str = 'utf8', ens
         logger.success(f"创建{file_name}成功!")
 
 
-def load_preset(filepath: Path, num: int, encoding: str = 'utf8') -> Optional[Preset]:
+def load_preset(filepath: Path, num: int, encoding: str = 'utf8', preset_data: List[dict] = None) -> Optional[Preset]:
     """
-    加载路径下的模板 json文件
+    加载路径下的模板 json文件，已读取的文件内容可以通过 preset_data 传入
     """
-    with open(filepath, 'r', encoding=encoding) as f:
-        preset_data: List[dict] = json.load(f)
+    if preset_data is None:
+        with open(filepath, 'r', encoding=encoding) as f:
+            preset_data = json.load(f)
     try:
         preset: Preset = Preset(
             name=filepath.stem,
@@ -125,31 +132,213 @@ def get_encoding(file_path: Path) -> str:
         return chardet.detect(f.read()).get('encoding', 'utf8')
 
 
-def load_all_preset(path: Path) -> List[Preset]:
+def read_preset_file(file_path: Path) -> Optional[List[dict]]:
     """
-    加载指定文件夹下所有模板 json文件，返回 Preset列表
+    读取模板 json文件内容，utf8 解码失败时使用 chardet 检测文件编码
     """
-    if not path.exists():
-        path.mkdir(parents=True)
-    presets: List[Preset] = []
-    CreateBasicPresetJson(path)
-    for file in path.rglob('*.json'):
-        preset: Optional[Preset] = load_preset(file, len(presets) + 1)
-        if preset is None:
+    try:
+        with open(file_path, 'r', encoding='utf8') as f:
+            return json.load(f)
+    except UnicodeDecodeError:
+        pass
+    except Exception as e:
+        logger.error(f'预设: {file_path.stem} 读取失败! {type(e)}:{e}')
+        return
+    try:
+        encoding: str = get_encoding(file_path)
+    except NameError:
+        logger.warning(f'{file_path} 预设文件编码不是utf8读取失败，需要安装 chardet 模块检测文件编码')
+        return
+    try:
+        with open(file_path, 'r', encoding=encoding) as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error(f'预设: {file_path.stem} 读取失败! encoding {encoding} {type(e)}:{e}')
+
+
+class PresetRegistry:
+    """
+    预设模板注册表，定时检查 path 下模板 json 文件的修改时间与大小，只重新读取新增与修改过的文件
+    模板的 id 按文件保存在 path 下的 .preset_ids 中，重启或增删其他模板后不会改变；新文件按发现的顺序分配新的 id
+    内容相同的预设共用同一份 Prefix，会话按内容哈希引用预设，修改模板后已创建的会话仍使用原来的预设
+    """
+    IDS_FILE: str = '.preset_ids'
+    # 用户没有加入会话时自动使用的模板，不存在时使用 id 最小的模板
+    DEFAULT_ID: str = '1'
+
+    def __init__(self, path: Path):
+        self.path: Path = path
+        # 模板文件的相对路径 -> id，文件删除后仍然保留，恢复时使用原来的 id
+        self._ids: Dict[str, int] = {}
+        # 模板文件的相对路径 -> (修改时间, 大小)
+        self._stats: Dict[str, Tuple[int, int]] = {}
+        # 模板文件的相对路径 -> 预设
+        self._presets: Dict[str, Preset] = {}
+        # 模板 id -> 预设对应的共享前缀
+        self._prefixes: Dict[str, Prefix] = {}
+        self.reloads: int = 0
+
+    @property
+    def ids_path(self) -> Path:
+        return self.path / self.IDS_FILE
+
+    def _load_ids(self) -> None:
+        if not self.ids_path.exists():
+            return
+        try:
+            with open(self.ids_path, 'r', encoding='utf8') as f:
+                self._ids = {str(k): int(v) for k, v in json.load(f).items()}
+        except Exception as e:
+            logger.error(f'读取预设 id 文件 {self.ids_path} 失败，将重新分配 id\n{type(e)}:{e}')
+
+    def _save_ids(self) -> None:
+        try:
+            atomic_write(self.ids_path, json.dumps(dict(sorted(self._ids.items(), key=lambda item: item[1])),
+                                                   ensure_ascii=False, indent=2))
+        except OSError as e:
+            logger.error(f'保存预设 id 文件 {self.ids_path} 失败\n{type(e)}:{e}')
+
+    def scan(self, executor: Optional[Executor] = None, initial: bool = False
+             ) -> Optional[Tuple[Dict[str, Tuple[int, int]], Dict[str, Preset]]]:
+        """
+        在线程中执行，返回文件状态与全部预设，没有文件变化时返回 None
+        读取失败的文件保留修改前的预设，文件再次修改后重新读取
+        """
+        if initial:
+            if not self.path.exists():
+                self.path.mkdir(parents=True)
+            CreateBasicPresetJson(self.path)
+            self._load_ids()
+        stats: Dict[str, Tuple[int, int]] = {}
+        files: Dict[str, Path] = {}
+        for file in self.path.rglob('*.json'):
             try:
-                preset: Optional[Preset] = load_preset(file, len(presets) + 1, encoding=get_encoding(file))
-            except NameError:
-                logger.warning(f'{file} 预设文件编码不是utf8读取失败，需要安装 chardet 模块检测文件编码')
-        if preset:
-            presets.append(preset)
-    if len(presets) > 0:
-        logger.success(f"此次共成功加载{len(presets)}个预设")
-    else:
-        logger.error("未成功加载任何预设!")
-    return presets
+                stat = file.stat()
+            except OSError:
+                continue
+            name: str = file.relative_to(self.path).as_posix()
+            files[name] = file
+            stats[name] = (stat.st_mtime_ns, stat.st_size)
+        changed: List[str] = [name for name in files if self._stats.get(name) != stats[name]]
+        if not changed and stats.keys() == self._stats.keys():
+            return None
+        paths: List[Path] = [files[name] for name in changed]
+        presets: Dict[str, Preset] = {name: preset for name, preset in self._presets.items() if name in files}
+        new_ids: bool = False
+        for name, file, preset_data in zip(changed, paths, executor.map(read_preset_file, paths) if executor else
+                                           map(read_preset_file, paths)):
+            if preset_data is None:
+                continue
+            # 只给读取并校验成功的模板分配 id，格式错误的文件不占用 id
+            preset_id: int = self._ids.get(name) or max(self._ids.values(), default=0) + 1
+            preset: Optional[Preset] = load_preset(file, preset_id, preset_data=preset_data)
+            if not preset:
+                continue
+            if name not in self._ids:
+                self._ids[name] = preset_id
+                new_ids = True
+            presets[name] = preset
+        if new_ids:
+            self._save_ids()
+        return stats, presets
+
+    def apply(self, stats: Dict[str, Tuple[int, int]], presets: Dict[str, Preset]) -> None:
+        """
+        在事件循环中替换全部预设，未修改的预设沿用原来的共享前缀
+        """
+        global presets_str
+        for name in self._presets.keys() - presets.keys():
+            logger.info(f'预设: {self._presets[name].name} 已移除')
+        previous: Dict[str, Preset] = dict(templateDict)
+        ordered: List[Preset] = sorted(presets.values(), key=lambda p: p.preset_id)
+        prefixes: Dict[str, Prefix] = {}
+        for preset in ordered:
+            preset_id: str = str(preset.preset_id)
+            prefix: Optional[Prefix] = self._prefixes.get(preset_id)
+            if prefix is None or previous.get(preset_id) is not preset:
+                prefix = intern_prefix(preset.preset)
+            prefixes[preset_id] = prefix
+        self._stats = stats
+        self._presets = presets
+        self._prefixes = prefixes
+        presets_list[:] = ordered
+        presets_str = Preset.presets2str(presets_list)
+        templateDict.clear()
+        templateDict.update({str(preset.preset_id): preset for preset in presets_list})
+        self.reloads += 1
+
+    def prefix(self, preset_id: str) -> Prefix:
+        """
+        模板对应的共享前缀，使用模板创建的会话不复制预设的内容，模板不存在时抛出 PresetNotFoundError
+        """
+        prefix: Optional[Prefix] = self._prefixes.get(preset_id)
+        if prefix is None:
+            raise PresetNotFoundError(f"模板 '{preset_id}' 不存在！")
+        return prefix
+
+    def default_id(self) -> Optional[str]:
+        """
+        自动创建会话使用的模板 id，模板 1 被删除后使用 id 最小的模板，没有任何模板时返回 None
+        """
+        if self.DEFAULT_ID in templateDict:
+            return self.DEFAULT_ID
+        return str(presets_list[0].preset_id) if presets_list else None
 
 
 preset_path: Path = plugin_config.preset_path
-presets_list: List[Preset] = load_all_preset(preset_path)
+# 预设在启动后于后台加载，presets_list 与 templateDict 原地更新，加载完成前到达的指令会等待 presets_loaded
+presets_list: List[Preset] = []
 presets_str: str = Preset.presets2str(presets_list)
-templateDict: Dict[str, Preset] = {str(preset.preset_id): preset for preset in presets_list}
+templateDict: Dict[str, Preset] = {}
+preset_registry: PresetRegistry = PresetRegistry(preset_path)
+presets_loaded: asyncio.Event = asyncio.Event()
+_load_task: Optional[asyncio.Task] = None
+
+
+async def reload_presets(executor: Optional[Executor] = None, initial: bool = False) -> bool:
+    """
+    重新读取修改过的预设，返回是否有变化
+    """
+    changes = await asyncio.get_running_loop().run_in_executor(None, preset_registry.scan, executor, initial)
+    if changes is None:
+        return False
+    preset_registry.apply(*changes)
+    return True
+
+
+async def load_presets_async() -> None:
+    try:
+        with ThreadPoolExecutor(max(plugin_config.load_workers, 1)) as executor:
+            # 预设文件很少，读取主要耗时在 chardet 编码检测等 IO 上，使用线程池即可
+            await reload_presets(executor, initial=True)
+        if len(presets_list) > 0:
+            logger.success(f"此次共成功加载{len(presets_list)}个预设")
+        else:
+            logger.error("未成功加载任何预设!")
+    finally:
+        presets_loaded.set()
+
+
+async def watch_presets(interval: float) -> None:
+    """
+    启动时加载全部预设，之后每隔 interval 秒检查一次预设文件夹，修改模板不需要重启
+    """
+    await load_presets_async()
+    while interval > 0:
+        await asyncio.sleep(interval)
+        try:
+            await reload_presets()
+        except Exception as e:
+            logger.error(f'重新加载预设失败\n{type(e)}:{e}')
+
+
+@get_driver().on_startup
+async def _start_loading_presets():
+    global _load_task
+    _load_task = asyncio.get_running_loop().create_task(watch_presets(plugin_config.preset_reload_interval))
+
+
+@get_driver().on_shutdown
+async def _stop_watching_presets():
+    if _load_task is not None:
+        _load_task.cancel()
@@ -0,0 +1,258 @@
+import math
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from nonebot import get_driver
+from nonebot.log import logger
+from nonebot.drivers import ASGIMixin, HTTPServerSetup, Request, Response, URL
+
+CONTENT_TYPE: str = 'text/plain; version=0.0.4; charset=utf-8'
+# 请求延迟的默认分桶，单位秒
+LATENCY_BUCKETS: Tuple[float, ...] = (0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0)
+
+LabelValues = Tuple[str, ...]
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_sample(name: str, labels: Dict[str, str], value: float) -> str:
+    if labels:
+        label_str: str = ','.join(f'{k}="{_escape(str(v))}"' for k, v in labels.items())
+        return f'{name}{{{label_str}}} {_format_value(value)}'
+    return f'{name} {_format_value(value)}'
+
+
+class Metric:
+    """
+    一个指标，按标签值分别记录，label_names 为空时只有一个值
+    """
+    type: str = 'untyped'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name: str = name
+        self.documentation: str = documentation
+        self.label_names: Tuple[str, ...] = tuple(label_names)
+
+    def _key(self, labels: Dict[str, object]) -> LabelValues:
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def _labels(self, key: LabelValues) -> Dict[str, str]:
+        return dict(zip(self.label_names, key))
+
+    def samples(self) -> Iterable[Sample]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines: List[str] = [f'# HELP {self.name} {_escape(self.documentation)}', f'# TYPE {self.name} {self.type}']
+        lines.extend(_format_sample(name, labels, value) for name, labels, value in self.samples())
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, value: float = 1, **labels) -> None:
+        key: LabelValues = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterable[Sample]:
+        for key, value in self._values.items():
+            yield self.name, self._labels(key), value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def samples(self) -> Iterable[Sample]:
+        for key, value in self._values.items():
+            yield self.name, self._labels(key), value
+
+
+class Histogram(Metric):
+    """
+    直方图，buckets 为各分桶的上界，输出时按 Prometheus 的格式累加
+    """
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        # 每组标签值对应 [各分桶计数..., 超出最大分桶的计数, 总和]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key: LabelValues = self._key(labels)
+        counts: Optional[List[float]] = self._values.get(key)
+        if counts is None:
+            counts = self._values[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def count(self, **labels) -> int:
+        counts: Optional[List[float]] = self._values.get(self._key(labels))
+        return int(sum(counts[:-1])) if counts else 0
+
+    def samples(self) -> Iterable[Sample]:
+        for key, counts in self._values.items():
+            labels: Dict[str, str] = self._labels(key)
+            total: float = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                total += count
+                yield f'{self.name}_bucket', {**labels, 'le': _format_value(bound)}, total
+            yield f'{self.name}_sum', labels, counts[-1]
+            yield f'{self.name}_count', labels, total
+
+
+class StatsCollector:
+    """
+    把各组件 stats() 返回的数值导出为 gauge，名称为 {prefix}_{字段名}
+    stats() 返回列表时每一项按 label 字段区分；字段值为字典时按 label 为键展开
+    """
+
+    def __init__(self, prefix: str, stats: Callable[[], object], label: str = ''):
+        self.prefix: str = prefix
+        self.stats: Callable[[], object] = stats
+        self.label: str = label
+
+    def _rows(self) -> Iterable[Tuple[Dict[str, str], Dict[str, object]]]:
+        stats = self.stats()
+        if isinstance(stats, dict):
+            yield {}, stats
+            return
+        for row in stats:
+            yield {self.label: str(row.get(self.label, ''))}, row
+
+    def render(self) -> List[str]:
+        samples: Dict[str, List[Tuple[Dict[str, str], float]]] = {}
+        for labels, row in self._rows():
+            for field, value in row.items():
+                if field == self.label:
+                    continue
+                if isinstance(value, dict):
+                    samples.setdefault(field, []).extend(({**labels, self.label or 'key': str(k)}, v)
+                                                         for k, v in value.items())
+                elif isinstance(value, (int, float)):
+                    samples.setdefault(field, []).append((labels, float(value)))
+        lines: List[str] = []
+        for field, values in samples.items():
+            if not values:
+                continue
+            name: str = f'{self.prefix}_{field}'
+            lines.append(f'# TYPE {name} gauge')
+            lines.extend(_format_sample(name, labels, value) for labels, value in values)
+        return lines
+
+
+class MetricsRegistry:
+    """
+    指标注册表，render 生成 Prometheus 文本格式，采集前先调用注册的 on_collect 回调更新 gauge
+    """
+
+    def __init__(self, namespace: str):
+        self.namespace: str = namespace
+        self._metrics: List[Metric] = []
+        self._collectors: List[StatsCollector] = []
+        self._on_collect: List[Callable[[], None]] = []
+
+    def _register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(f'{self.namespace}_{name}', documentation, label_names))
+
+    def gauge(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(f'{self.namespace}_{name}', documentation, label_names))
+
+    def histogram(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(f'{self.namespace}_{name}', documentation, label_names, buckets))
+
+    def register_stats(self, prefix: str, stats: Callable[[], object], label: str = '') -> None:
+        self._collectors.append(StatsCollector(f'{self.namespace}_{prefix}', stats, label))
+
+    def on_collect(self, callback: Callable[[], None]) -> Callable[[], None]:
+        self._on_collect.append(callback)
+        return callback
+
+    def render(self) -> str:
+        for callback in self._on_collect:
+            callback()
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            try:
+                lines.extend(collector.render())
+            except Exception as e:
+                logger.warning(f'采集指标 {collector.prefix} 失败\n{type(e)}:{e}')
+        return '\n'.join(lines) + '\n'
+
+
+class PluginMetrics(MetricsRegistry):
+    """
+    插件的请求、apikey、token 与会话存储指标
+    """
+
+    def __init__(self):
+        super().__init__('chatgpt')
+        self.request_latency: Histogram = self.histogram(
+            'request_duration_seconds', '单次上游请求的耗时', ('model', 'key', 'result'))
+        self.request_attempts: Histogram = self.histogram(
+            'request_attempts', '每次提问向上游发出的请求次数', buckets=(1, 2, 3, 4, 6, 8))
+        self.key_failures: Counter = self.counter(
+            'key_failures_total', 'apikey 请求失败次数，按异常类型区分', ('key', 'error'))
+        self.prompt_tokens: Counter = self.counter(
+            'prompt_tokens_total', '请求消耗的 prompt tokens', ('model', 'key'))
+        self.completion_tokens: Counter = self.counter(
+            'completion_tokens_total', '请求消耗的 completion tokens', ('model', 'key'))
+        self.session_save_latency: Histogram = self.histogram(
+            'session_save_seconds', '每次写入会话的耗时', buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+        self.sessions: Gauge = self.gauge('sessions', '会话总数')
+        self.sessions_loaded: Gauge = self.gauge('sessions_loaded', '历史记录已读入内存的会话数')
+        self.history_bytes: Gauge = self.gauge('history_bytes', '内存中历史记录的估算字节数')
+
+    def mount(self, path: str) -> bool:
+        """
+        在 nonebot 的 ASGI 驱动器（如 FastAPI）上挂载指标接口，驱动器不支持时返回 False
+        """
+        driver = get_driver()
+        if not isinstance(driver, ASGIMixin):
+            logger.warning(f'当前驱动器 {driver.type} 不支持 HTTP 服务，无法开启指标接口')
+            return False
+
+        async def handle(request: Request) -> Response:
+            return Response(200, headers={'Content-Type': CONTENT_TYPE}, content=self.render())
+
+        driver.setup_http_server(HTTPServerSetup(URL(path), 'GET', 'chatgpt_metrics', handle))
+        logger.info(f'指标接口已挂载于 {path}')
+        return True
+
+
+metrics: PluginMetrics = PluginMetrics()
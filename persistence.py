@@ -0,0 +1,177 @@
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Set, TypeVar, TYPE_CHECKING
+
+from nonebot.log import logger
+
+from .stores import SessionStore, SessionChanges
+from .custom_errors import SessionWriteError
+from .metrics import metrics
+from .tracing import tracer
+
+if TYPE_CHECKING:
+    from .sessions import Session
+
+T = TypeVar('T')
+
+
+class SessionFlusher:
+    """
+    会话延迟写入器
+    会话修改后只标记为脏，由后台任务每隔 interval 秒合并写入一次；interval <= 0 时每次修改立即写入
+    """
+
+    def __init__(self, store: SessionStore, interval: float):
+        self.store: SessionStore = store
+        self.interval: float = interval
+        self._dirty: Dict[int, "Session"] = {}
+        self._deleted: Set[str] = set()
+        self._inflight: Set[str] = set()
+        self._lock: asyncio.Lock = asyncio.Lock()
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='session_flusher')
+        self._task: "asyncio.Task | None" = None
+        # 每次写入成功后调用，写入前不能卸载的会话此时可以卸载
+        self.on_flushed: Optional[Callable[[], None]] = None
+        self.flush_count: int = 0
+        self.write_count: int = 0
+        self.bytes_written: int = 0
+        self.last_flush_latency: float = 0.0
+        self.max_flush_latency: float = 0.0
+        self.total_flush_latency: float = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._dirty) + len(self._deleted)
+
+    def is_pending(self, session: "Session") -> bool:
+        """
+        会话是否还有尚未写入存储的修改
+        """
+        return id(session) in self._dirty or session.session_id in self._inflight
+
+    async def read(self, func: Callable[..., T], *args) -> T:
+        """
+        在写入线程中读取存储，不阻塞事件循环，并且排在已经提交的写入之后
+        """
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def mark_dirty(self, session: "Session") -> None:
+        if not self.enabled:
+            start: float = time.perf_counter()
+            try:
+                self.bytes_written += self.store.apply([session.take_changes()], ())
+            except Exception as e:
+                # 本次的修改已经取出，下次写入时改为完整写入
+                session._rewrite = True
+                logger.error(f'写入会话失败\n{type(e)}:{e}')
+                return
+            self.write_count += 1
+            metrics.session_save_latency.observe(time.perf_counter() - start)
+            if self.on_flushed is not None:
+                self.on_flushed()
+            return
+        self._dirty[id(session)] = session
+
+    def discard(self, session: "Session") -> None:
+        """
+        丢弃会话尚未写入的修改，并在下次写入时从存储中删除该会话
+        """
+        self._dirty.pop(id(session), None)
+        if not self.enabled:
+            self.store.apply([], (session.session_id,))
+            return
+        self._deleted.add(session.session_id)
+
+    async def flush(self) -> None:
+        async with self._lock:
+            if not self._dirty and not self._deleted:
+                return
+            # 在事件循环线程中取出修改，避免写入线程读到正在修改的 history
+            sessions: List["Session"] = list(self._dirty.values())
+            changes: List[SessionChanges] = [s.take_changes() for s in sessions]
+            deleted: List[str] = list(self._deleted)
+            self._dirty, self._deleted = {}, set()
+            self._inflight = {c.session_id for c in changes}
+            start: float = time.perf_counter()
+            try:
+                with tracer.span('session.flush', background=True, sessions=len(changes), deleted=len(deleted)):
+                    size: int = await asyncio.get_running_loop().run_in_executor(self._executor, self.store.apply,
+                                                                                 changes, deleted)
+            except SessionWriteError as e:
+                self._requeue([s for s in sessions if s.session_id in e.session_ids], ())
+                raise
+            except BaseException:
+                self._requeue(sessions, deleted)
+                raise
+            finally:
+                self._inflight = set()
+            latency: float = time.perf_counter() - start
+            self.flush_count += 1
+            self.write_count += len(changes)
+            self.bytes_written += size
+            self.last_flush_latency = latency
+            self.max_flush_latency = max(self.max_flush_latency, latency)
+            self.total_flush_latency += latency
+            metrics.session_save_latency.observe(latency)
+            logger.debug(f'写入会话 {len(changes)} 个，删除会话 {len(deleted)} 个，耗时 {latency * 1000:.2f}ms')
+            if self.on_flushed is not None:
+                self.on_flushed()
+
+    def _requeue(self, sessions: List["Session"], deleted: Iterable[str]) -> None:
+        """
+        写入失败后重新排队：已取出的增量无法再次取出，这些会话下次改为完整写入
+        """
+        # 写入期间又被删除的会话不再写入
+        self._deleted.update(deleted)
+        for session in sessions:
+            if session.session_id in self._deleted:
+                continue
+            session._rewrite = True
+            self._dirty.setdefault(id(session), session)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f'后台写入会话失败\n{type(e)}:{e}')
+
+    def start(self) -> None:
+        if self.enabled and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            try:
+                await self.flush()
+            except Exception as e:
+                # 失败的会话已重新排队并改为完整写入，关闭前再尝试一次
+                logger.error(f'关闭时写入会话失败，正在重试\n{type(e)}:{e}')
+                await self.flush()
+        except Exception as e:
+            logger.error(f'关闭时写入会话失败，{self.queue_depth} 个会话的修改未能保存\n{type(e)}:{e}')
+            raise
+        finally:
+            self.store.close()
+        logger.info(f'会话已全部写入，共写入 {self.write_count} 次，平均耗时 '
+                    f'{self.total_flush_latency / max(self.flush_count, 1) * 1000:.2f}ms')
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'queue_depth': self.queue_depth,
+            'flush_count': self.flush_count,
+            'write_count': self.write_count,
+            'bytes_written': self.bytes_written,
+            'last_flush_latency': self.last_flush_latency,
+            'max_flush_latency': self.max_flush_latency,
+            'avg_flush_latency': self.total_flush_latency / self.flush_count if self.flush_count else 0.0,
+        }
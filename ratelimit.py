@@ -0,0 +1,242 @@
+import time
+import asyncio
+from collections import deque
+from typing import Deque, Dict, Optional, TYPE_CHECKING
+
+from nonebot.log import logger
+
+from .custom_errors import RateLimitedError
+
+if TYPE_CHECKING:
+    from .apikey import APIKeyPool, APIKey
+
+
+class TokenBucket:
+    """
+    令牌桶，每分钟补充 per_minute 个令牌，最多存 per_minute 个
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity: float = float(per_minute)
+        self.rate: float = per_minute / 60
+        self.tokens: float = self.capacity
+        self._updated: float = time.monotonic()
+
+    def _refill(self) -> None:
+        now: float = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, n: float) -> float:
+        """
+        需要等待多少秒才能取出 n 个令牌，n 超过桶容量时按桶满计算
+        """
+        self._refill()
+        n = min(n, self.capacity)
+        return max(n - self.tokens, 0.0) / self.rate
+
+    def consume(self, n: float) -> None:
+        self._refill()
+        self.tokens -= n
+
+    def refund(self, n: float) -> None:
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + n)
+
+
+class _Waiter:
+    def __init__(self, user: int, tokens: int):
+        self.user: int = user
+        self.tokens: int = tokens
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.start: float = time.perf_counter()
+
+
+class RateLimiter:
+    """
+    请求限流：apikey 的每分钟请求数/token 数与全局每分钟请求数都有余量时才放行请求
+    没有余量时请求按群排队，群之间加权轮询，每个用户同时排队的请求数有上限
+    """
+
+    def __init__(self, api_keys: "APIKeyPool", global_rpm: int, max_wait: float, user_max_pending: int,
+                 group_weights: Dict[str, int] = None):
+        self.api_keys: "APIKeyPool" = api_keys
+        self.global_bucket: Optional[TokenBucket] = TokenBucket(global_rpm) if global_rpm > 0 else None
+        self.max_wait: float = max_wait
+        self.user_max_pending: int = user_max_pending
+        self.group_weights: Dict[str, int] = group_weights or {}
+        self._queues: Dict[str, Deque[_Waiter]] = {}
+        self._rotation: Deque[str] = deque()
+        self._credit: int = 0
+        self._user_pending: Dict[int, int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.admitted: int = 0
+        self.queued: int = 0
+        self.rejected: int = 0
+        self.timeouts: int = 0
+        self.max_queue_wait: float = 0.0
+        self.total_queue_wait: float = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.global_bucket is not None or self.api_keys.rate_limited
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def group_depth(self, group: str) -> int:
+        return len(self._queues.get(group, ()))
+
+    def _capacity_wait(self, tokens: int) -> Optional[float]:
+        """
+        距离能放行一个需要 tokens 个 token 的请求还需要等待的秒数，没有任何可用 key 时返回 None
+        """
+        wait: Optional[float] = self.api_keys.capacity_wait(tokens)
+        if wait is not None and self.global_bucket is not None:
+            wait = max(wait, self.global_bucket.wait_time(1))
+        return wait
+
+    def _grant(self, tokens: int) -> Optional["APIKey"]:
+        """
+        放行一个请求，同时从 APIKeyPool 取出 key 并扣除余量，避免放行后余量被其他请求占用
+        """
+        key: Optional["APIKey"] = self.api_keys.acquire(tokens=tokens)
+        if key is None:
+            return None
+        if self.global_bucket is not None:
+            self.global_bucket.consume(1)
+        self.admitted += 1
+        return key
+
+    def try_consume(self) -> bool:
+        """
+        不排队地占用一次全局每分钟请求数，用于对冲等额外的请求；没有余量或有请求在排队时返回 False
+        """
+        if self.global_bucket is None:
+            return True
+        if self._queues or self.global_bucket.wait_time(1) > 0:
+            return False
+        self.global_bucket.consume(1)
+        return True
+
+    def refund(self) -> None:
+        """
+        归还 try_consume 占用但没有发出的请求
+        """
+        if self.global_bucket is not None:
+            self.global_bucket.refund(1)
+
+    async def admit(self, group: str, user: int, tokens: int) -> Optional["APIKey"]:
+        """
+        等待到可以发出请求，返回已经取出的 key；未开启限流或没有任何可用 key 时返回 None，由调用者自己取 key
+        用户排队的请求过多或等待超时时抛出 RateLimitedError
+        """
+        if not self.enabled:
+            return None
+        if not self._queues and self._capacity_wait(tokens) == 0:
+            key: Optional["APIKey"] = self._grant(tokens)
+            if key is not None:
+                return key
+        if self._user_pending.get(user, 0) >= self.user_max_pending:
+            self.rejected += 1
+            raise RateLimitedError('您排队中的请求过多，请等待之前的回复后再试')
+        waiter: _Waiter = _Waiter(user, tokens)
+        if group not in self._queues:
+            self._queues[group] = deque()
+            self._rotation.append(group)
+        self._queues[group].append(waiter)
+        self._user_pending[user] = self._user_pending.get(user, 0) + 1
+        self.queued += 1
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._dispatch())
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter.future), self.max_wait)
+        except asyncio.CancelledError:
+            # 已经放行但请求被取消，归还取出的 key
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.result() is not None:
+                self.api_keys.release(waiter.future.result())
+            raise
+        except asyncio.TimeoutError:
+            if waiter.future.done():
+                return waiter.future.result()
+            self.timeouts += 1
+            logger.warning(f'群 {group} 的请求排队超过 {self.max_wait:.0f} 秒，已放弃')
+            raise RateLimitedError('当前请求人数过多，请稍后再试')
+        finally:
+            if not waiter.future.done():
+                waiter.future.cancel()
+                self._remove(group, waiter)
+            self._release_user(user)
+
+    def _release_user(self, user: int) -> None:
+        self._user_pending[user] -= 1
+        if not self._user_pending[user]:
+            del self._user_pending[user]
+
+    def _remove(self, group: str, waiter: _Waiter) -> None:
+        queue: Optional[Deque[_Waiter]] = self._queues.get(group)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            return
+        if not queue:
+            self._drop_group(group)
+
+    def _drop_group(self, group: str) -> None:
+        del self._queues[group]
+        if self._rotation and self._rotation[0] == group:
+            self._credit = 0
+        self._rotation.remove(group)
+
+    def _head(self) -> Optional[str]:
+        """
+        加权轮询：当前群用完 weight 次机会后轮到下一个群
+        """
+        if not self._rotation:
+            return None
+        if self._credit <= 0:
+            self._credit = max(self.group_weights.get(self._rotation[0], 1), 1)
+        return self._rotation[0]
+
+    async def _dispatch(self) -> None:
+        while True:
+            group: Optional[str] = self._head()
+            if group is None:
+                return
+            waiter: _Waiter = self._queues[group][0]
+            wait: Optional[float] = self._capacity_wait(waiter.tokens)
+            key: Optional["APIKey"] = None
+            if wait == 0:
+                key = self._grant(waiter.tokens)
+                if key is None:
+                    # 有余量的 key 正在探测中，稍后再试
+                    wait = 0.1
+            if wait:
+                await asyncio.sleep(min(wait, 1.0))
+                continue
+            # wait 为 None 时没有任何可用 key，直接放行，由 Session.ask 返回提示
+            self._queues[group].popleft()
+            self._credit -= 1
+            if not self._queues[group]:
+                self._drop_group(group)
+            elif self._credit <= 0:
+                self._rotation.rotate(-1)
+            queue_wait: float = time.perf_counter() - waiter.start
+            self.max_queue_wait = max(self.max_queue_wait, queue_wait)
+            self.total_queue_wait += queue_wait
+            waiter.future.set_result(key)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            'queue_depth': self.queue_depth,
+            'groups': {g: len(q) for g, q in self._queues.items()},
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'max_queue_wait': self.max_queue_wait,
+            'avg_queue_wait': self.total_queue_wait / self.queued if self.queued else 0.0,
+        }
@@ -0,0 +1,99 @@
+import re
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from nonebot.adapters import Bot, Event
+from nonebot.permission import Permission
+from nonebot.typing import T_State
+
+CommandHandler = Callable[[Bot, Event, T_State, Dict[str, Any]], Awaitable[None]]
+
+# 规则匹配到的指令与参数存放在 state 中的键
+ROUTED_KEY: str = '_chatgpt_routed'
+# 需要用户再发一条消息的指令（如 new、json）在 state 中存放后续处理函数的键
+FOLLOW_UP_KEY: str = '_chatgpt_follow_up'
+_WORD: re.Pattern = re.compile(r'[A-Za-z]*')
+
+
+class Command:
+    __slots__ = ('head', 'pattern', 'permission', 'handler')
+
+    def __init__(self, head: str, pattern: re.Pattern, permission: Optional[Permission], handler: CommandHandler):
+        self.head: str = head
+        self.pattern: re.Pattern = pattern
+        self.permission: Optional[Permission] = permission
+        self.handler: CommandHandler = handler
+
+    def __repr__(self) -> str:
+        return f'Command({self.head} {self.pattern.pattern!r} -> {self.handler.__name__})'
+
+
+class CommandRouter:
+    """
+    插件的全部指令共用一个 matcher，实例本身作为 matcher 的规则
+    先用一条前缀正则排除无关消息，再按子命令开头的单词查表，只匹配同一单词下的几条指令并检查其权限
+    """
+
+    def __init__(self, heads: Dict[str, str]):
+        # heads 为指令名到前缀正则的映射，如 {'chat': '/(chat|c)', 'talk': '/talk'}，前缀后需要有空白
+        self._head: re.Pattern = re.compile('(?:' + '|'.join(f'(?P<{name}>{regex})' for name, regex in heads.items())
+                                            + r')\s+')
+        self._table: Dict[str, Dict[str, List[Command]]] = {name: {} for name in heads}
+
+    def command(self, head: str, pattern: str, permission: Optional[Permission] = None,
+                flags: int = 0) -> Callable[[CommandHandler], CommandHandler]:
+        """
+        注册一条指令，pattern 匹配前缀之后的部分，以开头的单词作为查表的键，不以单词开头的指令在没有同名单词时匹配
+        """
+
+        def decorator(handler: CommandHandler) -> CommandHandler:
+            word: str = _WORD.match(pattern).group()
+            command: Command = Command(head, re.compile(pattern, flags), permission, handler)
+            self._table[head].setdefault(word, []).append(command)
+            return handler
+
+        return decorator
+
+    @property
+    def commands(self) -> List[Command]:
+        return [command for table in self._table.values() for commands in table.values() for command in commands]
+
+    def match(self, text: str) -> Optional[Tuple[Command, re.Match]]:
+        head: Optional[re.Match] = self._head.match(text)
+        if head is None:
+            return None
+        rest: str = text[head.end():]
+        table: Dict[str, List[Command]] = self._table[head.lastgroup]
+        commands: List[Command] = table.get(_WORD.match(rest).group()) or table.get('', [])
+        for command in commands:
+            matched: Optional[re.Match] = command.pattern.match(rest)
+            if matched is not None:
+                return command, matched
+        return None
+
+    async def __call__(self, bot: Bot, event: Event, state: T_State) -> bool:
+        try:
+            text: str = str(event.get_message())
+        except Exception:
+            return False
+        routed: Optional[Tuple[Command, re.Match]] = self.match(text)
+        if routed is None:
+            return False
+        command, matched = routed
+        if command.permission is not None and not await command.permission(bot, event):
+            return False
+        state[ROUTED_KEY] = (command, matched.groupdict())
+        return True
+
+    @staticmethod
+    async def dispatch(bot: Bot, event: Event, state: T_State) -> None:
+        command, info = state[ROUTED_KEY]
+        await command.handler(bot, event, state, info)
+
+    @staticmethod
+    async def follow_up(bot: Bot, event: Event, state: T_State) -> None:
+        """
+        matcher 暂停后收到的下一条消息交给指令设置的后续处理函数，参数 text 为消息的纯文本
+        """
+        handler: Optional[CommandHandler] = state.pop(FOLLOW_UP_KEY, None)
+        if handler is not None:
+            await handler(bot, event, state, {'text': event.get_plaintext()})
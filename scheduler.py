@@ -0,0 +1,102 @@
+import time
+import asyncio
+from typing import Dict, List, Optional, Callable, Awaitable, TYPE_CHECKING
+
+from nonebot.log import logger
+
+from .tracing import tracer
+
+if TYPE_CHECKING:
+    from .sessions import Session
+
+
+class _Batch:
+    def __init__(self, content: str):
+        self.contents: List[str] = [content]
+        self.done: asyncio.Event = asyncio.Event()
+
+
+class _TurnQueue:
+    def __init__(self):
+        self.lock: asyncio.Lock = asyncio.Lock()
+        self.batch: Optional[_Batch] = None
+        self.waiting: int = 0
+
+
+class TurnScheduler:
+    """
+    会话回合调度器，同一个会话同时只有一个请求，其余消息排队等待
+    batch_window > 0 时，同一会话在等待期间收到的消息会合并成一条用户消息一起请求
+    """
+
+    def __init__(self, batch_window: float):
+        self.batch_window: float = batch_window
+        self._queues: Dict[str, _TurnQueue] = {}
+        self.turns: int = 0
+        self.coalesced: int = 0
+        self.last_wait: float = 0.0
+        self.max_wait: float = 0.0
+        self.total_wait: float = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        正在等待或正在请求的回合数
+        """
+        return sum(q.waiting for q in self._queues.values())
+
+    def session_depth(self, session: "Session") -> int:
+        queue: Optional[_TurnQueue] = self._queues.get(session.session_id)
+        return queue.waiting if queue else 0
+
+    async def submit(self, session: "Session", content: str, run: Callable[[str], Awaitable[str]]) -> Optional[str]:
+        """
+        按顺序在会话中执行 run(content) 并返回回复；消息被合并到其他回合时等待该回合结束并返回 None
+        """
+        queue: _TurnQueue = self._queues.setdefault(session.session_id, _TurnQueue())
+        if queue.batch is not None:
+            batch: _Batch = queue.batch
+            batch.contents.append(content)
+            self.coalesced += 1
+            tracer.set_attribute('coalesced', True)
+            await batch.done.wait()
+            return None
+        batch = _Batch(content)
+        if self.batch_window > 0:
+            queue.batch = batch
+        queue.waiting += 1
+        start: float = time.perf_counter()
+        start_ns: int = time.time_ns()
+        try:
+            if self.batch_window > 0:
+                await asyncio.sleep(self.batch_window)
+            async with queue.lock:
+                # 拿到锁之后不再接受合并，之后的消息进入下一个回合
+                if queue.batch is batch:
+                    queue.batch = None
+                wait: float = time.perf_counter() - start
+                self.turns += 1
+                self.last_wait = wait
+                self.max_wait = max(self.max_wait, wait)
+                self.total_wait += wait
+                tracer.record('turn.wait', start_ns, messages=len(batch.contents))
+                if len(batch.contents) > 1:
+                    logger.debug(f'会话 {session.name} 合并 {len(batch.contents)} 条消息，等待 {wait * 1000:.1f}ms')
+                return await run('\n'.join(batch.contents))
+        finally:
+            if queue.batch is batch:
+                queue.batch = None
+            batch.done.set()
+            queue.waiting -= 1
+            if not queue.waiting and self._queues.get(session.session_id) is queue:
+                del self._queues[session.session_id]
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'queue_depth': self.queue_depth,
+            'turns': self.turns,
+            'coalesced': self.coalesced,
+            'last_wait': self.last_wait,
+            'max_wait': self.max_wait,
+            'avg_wait': self.total_wait / self.turns if self.turns else 0.0,
+        }
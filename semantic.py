@@ -0,0 +1,214 @@
+import json
+import zlib
+import time
+import hashlib
+from typing import Dict, List, Optional, Tuple, Type
+
+from nonebot.log import logger
+
+# 尝试引用 numpy，非必须，语义缓存需要
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    np = None
+
+# 尝试引用 sentence_transformers，非必须，使用本地向量模型时需要
+try:
+    from sentence_transformers import SentenceTransformer
+except ModuleNotFoundError:
+    SentenceTransformer = None
+
+
+class Embedder:
+    """
+    本地文本向量化，返回 L2 归一化的 float32 向量
+    """
+    name: str = ''
+
+    def __init__(self, model: str = ''):
+        self.model: str = model
+        self.dim: int = 0
+
+    def embed(self, text: str) -> "np.ndarray":
+        raise NotImplementedError
+
+
+class HashingEmbedder(Embedder):
+    """
+    字符 n-gram 哈希向量，不需要下载模型：每个 n-gram 按哈希值累加到 dim 维中的一维，并按哈希位决定正负号
+    """
+    name = 'hashing'
+
+    def __init__(self, model: str = '', dim: int = 256, ngrams: Tuple[int, ...] = (1, 2, 3)):
+        super().__init__(model)
+        self.dim = dim
+        self.ngrams: Tuple[int, ...] = ngrams
+
+    def embed(self, text: str) -> "np.ndarray":
+        text = ''.join(text.lower().split())
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for n in self.ngrams:
+            for i in range(len(text) - n + 1):
+                h: int = zlib.crc32(text[i:i + n].encode('utf8'))
+                vector[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        norm: float = float(np.linalg.norm(vector))
+        return vector / norm if norm else vector
+
+
+class SentenceTransformerEmbedder(Embedder):
+    """
+    使用 sentence-transformers 的本地模型，需要 sentence-transformers 依赖，model 为模型名或路径
+    """
+    name = 'sentence-transformers'
+
+    def __init__(self, model: str = ''):
+        super().__init__(model or 'paraphrase-multilingual-MiniLM-L12-v2')
+        self._model = SentenceTransformer(self.model, device='cpu')
+        self.dim = self._model.get_sentence_embedding_dimension()
+
+    def embed(self, text: str) -> "np.ndarray":
+        return self._model.encode(text, normalize_embeddings=True).astype(np.float32)
+
+
+EMBEDDERS: Dict[str, Type[Embedder]] = {
+    HashingEmbedder.name: HashingEmbedder,
+    SentenceTransformerEmbedder.name: SentenceTransformerEmbedder,
+}
+
+
+def register_embedder(embedder: Type[Embedder]) -> Type[Embedder]:
+    """
+    注册自定义的向量化方式，之后可以在配置 semantic_cache_embedder 中使用它的 name
+    """
+    EMBEDDERS[embedder.name] = embedder
+    return embedder
+
+
+def create_embedder(name: str, model: str = '') -> Optional[Embedder]:
+    if np is None:
+        logger.warning('语义缓存需要安装 numpy 模块，已关闭语义缓存')
+        return None
+    if name == SentenceTransformerEmbedder.name and SentenceTransformer is None:
+        logger.warning('需要安装 sentence-transformers 模块，已使用哈希向量')
+        name = HashingEmbedder.name
+    if name not in EMBEDDERS:
+        logger.warning(f'未知的向量化方式 {name}，已使用哈希向量')
+        name = HashingEmbedder.name
+    try:
+        return EMBEDDERS[name](model)
+    except Exception as e:
+        logger.warning(f'向量化方式 {name} 初始化失败，已使用哈希向量\n{type(e)}:{e}')
+        return HashingEmbedder()
+
+
+class VectorIndex:
+    """
+    一个分区的向量索引，向量按行存放在按需倍增的 numpy 矩阵中，检索为一次矩阵乘法
+    """
+
+    def __init__(self, dim: int, capacity: int = 64):
+        self.dim: int = dim
+        self.size: int = 0
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.last_used = np.zeros(capacity, dtype=np.float64)
+        self.answers: List[str] = []
+
+    def search(self, vector: "np.ndarray") -> Tuple[int, float]:
+        """
+        返回最相似的一条的序号与余弦相似度，索引为空时序号为 -1
+        """
+        if not self.size:
+            return -1, 0.0
+        scores = self.vectors[:self.size] @ vector
+        index: int = int(np.argmax(scores))
+        return index, float(scores[index])
+
+    def add(self, vector: "np.ndarray", answer: str, now: float) -> None:
+        if self.size == len(self.vectors):
+            self.vectors = np.concatenate([self.vectors, np.zeros_like(self.vectors)])
+            self.last_used = np.concatenate([self.last_used, np.zeros_like(self.last_used)])
+        self.vectors[self.size] = vector
+        self.last_used[self.size] = now
+        self.answers.append(answer)
+        self.size += 1
+
+    def oldest(self) -> Tuple[int, float]:
+        index: int = int(np.argmin(self.last_used[:self.size]))
+        return index, float(self.last_used[index])
+
+    def remove(self, index: int) -> None:
+        """
+        用最后一条覆盖被删除的一条
+        """
+        last: int = self.size - 1
+        self.vectors[index] = self.vectors[last]
+        self.last_used[index] = self.last_used[last]
+        self.answers[index] = self.answers[last]
+        self.answers.pop()
+        self.size -= 1
+
+
+class SemanticCache:
+    """
+    语义缓存：按预设分区，用最后一条用户消息的向量检索相似度不低于 threshold 的历史回复
+    所有分区合计最多 max_entries 条，超出时淘汰最久未使用的一条
+    """
+
+    def __init__(self, embedder: Embedder, threshold: float, max_entries: int):
+        self.embedder: Embedder = embedder
+        self.threshold: float = threshold
+        self.max_entries: int = max_entries
+        self._partitions: Dict[str, VectorIndex] = {}
+        self.size: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    @staticmethod
+    def partition_key(model: str, preset: List[Dict[str, str]]) -> str:
+        payload: str = json.dumps([model, preset], ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf8')).hexdigest()
+
+    def embed(self, text: str) -> "np.ndarray":
+        return self.embedder.embed(text)
+
+    def get(self, partition: str, vector: "np.ndarray") -> Optional[str]:
+        index: Optional[VectorIndex] = self._partitions.get(partition)
+        position, score = index.search(vector) if index is not None else (-1, 0.0)
+        if position < 0 or score < self.threshold:
+            self.misses += 1
+            return None
+        index.last_used[position] = time.monotonic()
+        self.hits += 1
+        logger.debug(f'命中语义缓存，相似度 {score:.3f}')
+        return index.answers[position]
+
+    def put(self, partition: str, vector: "np.ndarray", answer: str) -> None:
+        index: Optional[VectorIndex] = self._partitions.get(partition)
+        if index is None:
+            index = self._partitions[partition] = VectorIndex(self.embedder.dim)
+        index.add(vector, answer, time.monotonic())
+        self.size += 1
+        while self.size > self.max_entries:
+            self._evict()
+
+    def _evict(self) -> None:
+        partition, position = min(((key, index.oldest()) for key, index in self._partitions.items()),
+                                  key=lambda item: item[1][1])
+        index: VectorIndex = self._partitions[partition]
+        index.remove(position[0])
+        if not index.size:
+            del self._partitions[partition]
+        self.size -= 1
+        self.evictions += 1
+
+    def stats(self) -> Dict[str, float]:
+        lookups: int = self.hits + self.misses
+        return {
+            'entries': self.size,
+            'partitions': len(self._partitions),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+        }
@@ -1,18 +1,47 @@
-import copy
+import sys
 import json
+import uuid
+import time
+import asyncio
 import datetime
 from pathlib import Path
-from typing import List, Dict, Optional, Union, Set
+from contextlib import asynccontextmanager, AsyncExitStack
+from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import List, Dict, Optional, Union, Set, Any, Tuple, Callable, Awaitable, AsyncIterator
 
 import httpx
+from nonebot import get_driver
 from nonebot.log import logger
 from nonebot.adapters.onebot.v11 import MessageEvent, GroupMessageEvent
-from openai import AsyncOpenAI, APIResponseValidationError, AuthenticationError, RateLimitError
+from openai import (AsyncOpenAI, APIResponseValidationError, AuthenticationError, PermissionDeniedError,
+                    RateLimitError)
 
 from .config import plugin_config
-from .apikey import APIKeyPool, APIKey
-from .loadpresets import templateDict
-from .custom_errors import NeedCreatSession, NoResponseError
+from .apikey import APIKeyPool, APIKey, ClientPool, HttpStats, parse_retry_after
+from .loadpresets import templateDict, preset_registry
+from .persistence import SessionFlusher
+from .streaming import StreamBuffer
+from .scheduler import TurnScheduler
+from .dispatch import Dispatcher
+from .tokens import ContextBuilder, create_tokenizer
+from .hedging import HedgePolicy
+from .ratelimit import RateLimiter
+from .cache import ResponseCache, context_key
+from .semantic import SemanticCache, Embedder, create_embedder
+from .metrics import metrics
+from .tracing import tracer
+from .stores import SessionStore, JsonDirStore, SqliteStore, StoredSession, SessionChanges, migrate_sessions
+from .state import StateBackend, GroupState, create_state_backend
+from .compactor import Compactor, create_summarizer, summary_message
+from .history import History, Message
+from .custom_errors import NeedCreatSession, NoResponseError, RateLimitedError, SessionStateError
+
+# 尝试引用 h2，非必须，只有开启 http2 时需要
+try:
+    import h2
+except ModuleNotFoundError:
+    h2 = None
 
 type_user_id = int
 type_group_id = str
@@ -20,11 +49,28 @@ PRIVATE_GROUP: str = "Private"
 
 proxy: Optional[str] = plugin_config.openai_proxy
 if proxy:
-    proxy_client = httpx.AsyncClient(proxies=proxy)
     logger.info("已配置代理")
 else:
-    proxy_client = httpx.AsyncClient()
     logger.warning("未配置代理")
+_http2: bool = plugin_config.http2
+if _http2 and h2 is None:
+    logger.warning('开启 http2 需要安装 h2 模块 (pip install httpx[http2])，已退回 HTTP/1.1')
+    _http2 = False
+http_stats: HttpStats = HttpStats()
+proxy_client = httpx.AsyncClient(
+    proxy=proxy or None,
+    http2=_http2,
+    limits=httpx.Limits(
+        max_connections=plugin_config.max_connections,
+        max_keepalive_connections=plugin_config.max_keepalive_connections,
+        keepalive_expiry=plugin_config.keepalive_expiry,
+    ),
+    event_hooks=http_stats.event_hooks(),
+)
+# 有多个 key 时主要由 APIKeyPool 负责换 key 重试，同一个 key 上只重试一次，应对偶发的 5xx 与网络错误
+_max_retries: int = plugin_config.openai_max_retries if plugin_config.openai_max_retries is not None else (
+    1 if len(plugin_config.api_key) > 1 else 2)
+client_pool: ClientPool = ClientPool(proxy_client, max(_max_retries, 0))
 
 def get_group_id(event: MessageEvent) -> str:
     if isinstance(event, GroupMessageEvent):  # 当在群聊中时
@@ -35,19 +81,28 @@ def get_group_id(event: MessageEvent) -> str:
 
 class SessionContainer:
     def __init__(self, api_keys: APIKeyPool, chat_memory_max: int, base_url:str ,history_max: int, dir_path: Path,
-                 default_only_admin: bool):
+                 default_only_admin: bool, store: SessionStore, state: StateBackend):
         self.api_keys: APIKeyPool = api_keys
+        self.store: SessionStore = store
+        self.state: StateBackend = state
         self.base_url: str = base_url
         self.chat_memory_max: int = chat_memory_max
         self.history_max: int = history_max
         self.dir_path: Path = dir_path
-        self.sessions: List[Session] = []
+        # 按群以及按 (群, 创建者) 索引的会话，列表按创建顺序排列，保证 list 中的序号稳定
+        self._group_sessions: Dict[type_group_id, List[Session]] = {}
+        self._user_sessions: Dict[Tuple[type_group_id, type_user_id], List[Session]] = {}
+        self._session_count: int = 0
         self.session_usage: Dict[type_group_id, Dict[type_user_id, Session]] = {}
         self.default_only_admin: bool = default_only_admin
         self.group_auth: Dict[str, bool] = {}
+        self._state_epoch: str = ''
+        # 本进程正在持有会话锁的会话及持有次数，同步时不替换它们的内容
+        self._held: Dict[str, int] = {}
+        self._loaded: asyncio.Event = asyncio.Event()
+        self._load_task: Optional[asyncio.Task] = None
         if not dir_path.exists():
             dir_path.mkdir(parents=True)
-        self.load()
         self.load_group_auth()
 
     @property
@@ -68,44 +123,129 @@ class SessionContainer:
     def get_group_auth(self, gid: str) -> bool:
         return self.group_auth.setdefault(gid, self.default_only_admin)
 
-    def set_group_auth(self, gid: str, auth: bool):
+    async def set_group_auth(self, gid: str, auth: bool):
         self.group_auth[gid] = auth
         self.save_group_auth()
+        await self.state.set_group_auth(gid, auth)
 
     async def delete_session(self, session: "Session", gid: str) -> None:
         group_usage: Dict[int, Session] = self.get_group_usage(gid)
         users = set(uid for uid, s in group_usage.items() if s is session)
         for user in users:
             group_usage.pop(user, None)
-        self.sessions.remove(session)
-        session.delete_file()
+        self._drop_session(session)
+        await self.state.delete_session(str(session.group), session.session_id)
         logger.success(f'成功删除群 {gid} 会话 {session.name}')
 
+    def _drop_session(self, session: "Session") -> None:
+        self._remove_session(session)
+        history_cache.discard(session)
+        if compactor is not None:
+            compactor.forget(session)
+        session.delete_file()
+
     def get_group_sessions(self, group_id: Union[str, int]) -> List["Session"]:
-        return [s for s in self.sessions if s.group == str(group_id)]
+        return list(self._group_sessions.get(str(group_id), ()))
+
+    def get_user_sessions(self, group_id: Union[str, int], creator: int) -> List["Session"]:
+        """
+        获取群内某个用户创建的全部会话
+        """
+        return list(self._user_sessions.get((str(group_id), creator), ()))
+
+    @property
+    def sessions(self) -> List["Session"]:
+        return [s for group_sessions in self._group_sessions.values() for s in group_sessions]
+
+    @property
+    def session_count(self) -> int:
+        return self._session_count
+
+    def _add_session(self, session: "Session") -> None:
+        group: str = str(session.group)
+        self._group_sessions.setdefault(group, []).append(session)
+        self._user_sessions.setdefault((group, session.creator), []).append(session)
+        self._session_count += 1
+
+    def _remove_session(self, session: "Session") -> None:
+        group: str = str(session.group)
+        for index, key in ((self._group_sessions, group), (self._user_sessions, (group, session.creator))):
+            index[key].remove(session)
+            if not index[key]:
+                del index[key]
+        self._session_count -= 1
 
     @staticmethod
     def old_version_check(session: "Session"):
         if session.group == PRIVATE_GROUP:
-            session.file_path.unlink(missing_ok=True)
             session.group = PRIVATE_GROUP + f'_{session.creator}'
-            session.save()
+            session.save(rewrite=True)
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded.is_set()
+
+    async def wait_loaded(self) -> None:
+        await self._loaded.wait()
 
-    def load(self) -> None:
-        files: List[Path] = list(self.dir_path.glob('*.json'))
+    def _read_store(self, executor: Optional[Executor]) -> List[StoredSession]:
+        return self.store.load_index(executor) if _lazy_load_history else self.store.load(executor)
+
+    async def load_async(self, workers: int, use_process: bool) -> None:
+        """
+        在线程池/进程池中并行读取全部会话，读取完成前到达的指令会等待，避免重复创建会话
+        """
+        start: float = time.perf_counter()
+        executor: Optional[Executor] = None
+        if workers > 1:
+            executor = ProcessPoolExecutor(workers) if use_process else ThreadPoolExecutor(workers)
         try:
-            files.remove(self.group_auth_file_path)
-        except ValueError:
-            pass
-        for file in files:
-            session = Session.reload_from_file(file)
-            if not session:
-                continue
-            self.old_version_check(session)
-            self.sessions.append(session)
-            group = self.get_group_usage(session.group)
-            for user in session.users:
-                group[user] = session
+            stored_list: List[StoredSession] = await asyncio.get_running_loop().run_in_executor(
+                None, self._read_store, executor)
+            for stored in stored_list:
+                self.add_stored(stored)
+            if self.state.shared:
+                await self.seed_state()
+            logger.success(f'共加载会话 {self.session_count} 个，耗时 {time.perf_counter() - start:.2f}s')
+        except Exception as e:
+            logger.error(f'加载会话失败\n{type(e)}:{e}')
+        finally:
+            if executor:
+                executor.shutdown(wait=False)
+            self._loaded.set()
+
+    def start_loading(self, workers: int, use_process: bool) -> None:
+        self._load_task = asyncio.get_running_loop().create_task(self.load_async(workers, use_process))
+
+    def add_stored(self, stored: StoredSession) -> None:
+        try:
+            session: Session = Session.reload(**stored.data)
+        except Exception as e:
+            logger.error(f'加载 Session {stored.data.get("session_id")} 失败\n{type(e)}:{e}')
+            return
+        session._log_records = stored.records
+        if stored.rewrite:  # 旧版本单个json文件格式的会话迁移为追加写入的日志格式
+            session.save(rewrite=True)
+        self.old_version_check(session)
+        self._add_session(session)
+        group = self.get_group_usage(session.group)
+        for user in session.users:
+            group[user] = session
+
+    async def migrate_from_json_dir(self) -> int:
+        """
+        将会话文件夹中的全部会话导入当前的 SQLite 存储，返回导入的会话数量
+        """
+        if not isinstance(self.store, SqliteStore):
+            raise TypeError('当前会话存储不是 sqlite')
+        source: JsonDirStore = JsonDirStore(self.dir_path, _log_compact_ratio,
+                                            exclude=[self.group_auth_file_path, *_auxiliary_files])
+        migrated: List[StoredSession] = await asyncio.get_running_loop().run_in_executor(
+            None, migrate_sessions, source, self.store)
+        for stored in migrated:
+            self.add_stored(StoredSession(stored.data))
+        logger.success(f'成功从 {self.dir_path} 导入会话 {len(migrated)} 个')
+        return len(migrated)
 
     def get_group_usage(self, gid: Union[str, int]) -> Dict[type_user_id, "Session"]:
         return self.session_usage.setdefault(str(gid), {})
@@ -116,69 +256,355 @@ class SessionContainer:
         except KeyError:
             raise NeedCreatSession(f'群{gid} 用户{uid} 需要创建 Session')
 
-    def create_with_chat_log(self, chat_log: List[Dict[str, str]], creator: int, group: Union[int, str],
-                             name: str = '') -> "Session":
-        session: Session = Session(chat_log=chat_log, creator=creator, group=group, dir_path=self.dir_path,
-                                   name=name, history_max=self.history_max, chat_memory_max=self.chat_memory_max)
-        self.get_group_usage(group)[creator] = session
-        self.sessions.append(session)
-        session.add_user(creator)
+    async def join(self, session: "Session", uid: int, gid: Union[str, int]) -> None:
+        """
+        用户加入会话，同时退出之前所在的会话
+        """
+        group_usage: Dict[type_user_id, Session] = self.get_group_usage(gid)
+        old: Optional[Session] = group_usage.get(uid)
+        if old is not None and old is not session:
+            old.del_user(uid)
+        session.add_user(uid)
+        group_usage[uid] = session
+        await self.state.set_usage(str(gid), uid, session.session_id)
+
+    async def leave(self, uid: int, gid: Union[str, int]) -> Optional["Session"]:
+        session: Optional[Session] = self.get_group_usage(gid).pop(uid, None)
+        if session is not None:
+            session.del_user(uid)
+            await self.state.set_usage(str(gid), uid, None)
+        return session
+
+    async def rename(self, session: "Session", name: str) -> None:
+        async with self.hold(session):
+            session.rename(name)
+
+    async def apply_summary(self, session: "Session", summary: str, compacted: List[Message]) -> bool:
+        """
+        把后台生成的摘要写回会话，会话已被删除时放弃
+        """
+        if session not in self._group_sessions.get(str(session.group), ()):
+            return False
+        async with self.hold(session):
+            return session.compact(summary, compacted)
+
+    async def create_with_history(self, history: History, creator: int, group: Union[int, str], name: str = '',
+                                  summary: str = '') -> "Session":
+        session: Session = Session(chat_log=history, creator=creator, group=group, name=name,
+                                   history_max=self.history_max, chat_memory_max=self.chat_memory_max,
+                                   summary=summary)
+        self._add_session(session)
+        await self.publish(session)
+        await self.join(session, creator, group)
         logger.success(f'{creator} 成功创建会话 {session.name}')
         return session
 
-    def create_with_template(self, template_id: str, creator: int, group: Union[int, str]) -> "Session":
-        deep_copy: List[Dict[str, str]] = copy.deepcopy(templateDict[template_id].preset)
-        return self.create_with_chat_log(deep_copy, creator, group, name=templateDict[template_id].name)
+    async def create_with_chat_log(self, chat_log: List[Dict[str, str]], creator: int, group: Union[int, str],
+                                   name: str = '') -> "Session":
+        return await self.create_with_history(History.from_messages(chat_log, len(chat_log), self.history_max),
+                                              creator, group, name=name)
 
-    def create_with_str(self, custom_prompt: str, creator: int, group: Union[int, str], name: str = '') -> "Session":
+    async def create_with_template(self, template_id: str, creator: int, group: Union[int, str]) -> "Session":
+        with tracer.span('session.create_with_template', standalone=False, template=template_id):
+            # 新会话与模板共用同一份预设，不复制预设的内容
+            # 模板不存在时 prefix 抛出 PresetNotFoundError
+            history: History = History(preset_registry.prefix(template_id), (), self.history_max)
+            return await self.create_with_history(history, creator, group, name=templateDict[template_id].name)
+
+    async def create_with_str(self, custom_prompt: str, creator: int, group: Union[int, str],
+                              name: str = '') -> "Session":
         custom_prompt = [{"role": "user", "content": custom_prompt}, {
             "role": "assistant", "content": "好"}]
-        return self.create_with_chat_log(custom_prompt, creator, group, name=name)
-
-    def create_with_session(self, session: "Session", creator: int, group: str) -> "Session":
-        new_session: Session = Session(
-            chat_log=session.chat_memory,
-            creator=creator,
-            group=group,
-            name=session.name,
-            dir_path=self.dir_path,
-            history_max=self.history_max,
-            chat_memory_max=self.chat_memory_max,
-        )
-        self.get_group_usage(group)[creator] = new_session
-        self.sessions.append(new_session)
-        new_session.add_user(creator)
-        logger.success(f'{creator} 成功创建会话 {new_session.name}')
-        return new_session
+        return await self.create_with_chat_log(custom_prompt, creator, group, name=name)
+
+    async def create_with_session(self, session: "Session", creator: int, group: str) -> "Session":
+        """
+        复制会话：共用原会话的预设与消息，只复制消息的引用，之后两个会话各自追加互不影响
+        """
+        history: History = await session.hydrate()
+        return await self.create_with_history(history.fork(self.history_max), creator, group,
+                                              name=session.name, summary=session.summary)
+
+    async def sync(self, gid: str) -> None:
+        """
+        从共享的状态后端同步群内的会话、用户所在的会话与群权限，只读取版本号变化的会话
+        """
+        if not self.state.shared:
+            return
+        with tracer.span('state.sync', standalone=False, group=gid):
+            group: GroupState = await self.state.load_group(gid)
+            if group.epoch != self._state_epoch:
+                # 后端数据丢失时不能当作会话已被删除，重新写入本地的会话
+                logger.warning('状态后端的数据已丢失，重新写入本地会话')
+                await self.seed_state()
+                group = await self.state.load_group(gid)
+            local: Dict[str, Session] = {s.session_id: s for s in self._group_sessions.get(gid, ())}
+            stale: List[str] = [sid for sid, version in group.versions.items()
+                                if sid not in local or local[sid].version != version]
+            fetched: Dict[str, Tuple[int, Dict[str, Any]]] = await self.state.get_sessions(gid, stale) if stale else {}
+            for sid, session in local.items():
+                if sid not in group.versions:
+                    self._drop_session(session)
+            for sid in group.versions:
+                if sid not in fetched:
+                    continue
+                version, data = fetched[sid]
+                if sid in local:
+                    # 正在修改的会话由 hold 在取得锁后检查版本号，这里替换会丢掉进行中的修改
+                    if sid not in self._held:
+                        local[sid].restore(data, version)
+                    continue
+                added: Session = Session.reload(**data)
+                added.version = version
+                added.save(rewrite=True)
+                local[sid] = added
+                self._add_session(added)
+            # 按后端中的创建顺序排列，保证各进程 list 中的序号一致
+            ordered: List[Session] = [local[sid] for sid in group.versions if sid in local]
+            if ordered:
+                self._group_sessions[gid] = ordered
+                position: Dict[str, int] = {s.session_id: i for i, s in enumerate(ordered)}
+                for key in [k for k in self._user_sessions if k[0] == gid]:
+                    self._user_sessions[key].sort(key=lambda s: position.get(s.session_id, len(position)))
+            self.session_usage[gid] = {uid: local[sid] for uid, sid in group.usage.items() if sid in local}
+            users: Dict[str, Set[int]] = {}
+            for uid, sid in group.usage.items():
+                users.setdefault(sid, set()).add(uid)
+            for session in ordered:
+                session._users = users.get(session.session_id, set())
+            if group.auth is not None:
+                self.group_auth[gid] = group.auth
+
+    async def publish(self, session: "Session") -> None:
+        """
+        把会话写入共享的状态后端，其他进程已经修改过该会话时放弃本进程的修改，改为使用后端中的内容
+        """
+        if not self.state.shared:
+            return
+        version: Optional[int] = await self.state.put_session(str(session.group), session.session_id,
+                                                              session.version, session.as_dict())
+        if version is not None:
+            session.version = version
+            return
+        logger.warning(f'会话 {session.name} 已被其他进程修改，放弃本次修改')
+        await self.refresh(session)
+
+    async def refresh(self, session: "Session") -> None:
+        gid: str = str(session.group)
+        fetched: Dict[str, Tuple[int, Dict[str, Any]]] = await self.state.get_sessions(gid, [session.session_id])
+        if session.session_id not in fetched:
+            if session in self._group_sessions.get(gid, ()):
+                self._drop_session(session)
+            for uid in [uid for uid, s in self.get_group_usage(gid).items() if s is session]:
+                del self.get_group_usage(gid)[uid]
+            raise SessionStateError('会话已被删除，请重新加入或创建会话')
+        version, data = fetched[session.session_id]
+        session.restore(data, version)
+
+    @asynccontextmanager
+    async def hold(self, session: "Session") -> AsyncIterator[None]:
+        """
+        修改会话期间持有会话锁，其他进程修改过该会话时先重新读取，结束后写入状态后端与存储再释放锁
+        """
+        if not self.state.shared:
+            yield
+            return
+        async with AsyncExitStack() as stack:
+            with tracer.span('state.lock', standalone=False):
+                await stack.enter_async_context(self.state.lock(session.session_id))
+            sid: str = session.session_id
+            self._held[sid] = self._held.get(sid, 0) + 1
+            try:
+                versions: List[int] = await self.state.get_versions([(str(session.group), sid)])
+                if versions[0] != session.version:
+                    await self.refresh(session)
+                try:
+                    yield
+                finally:
+                    await self.publish(session)
+                    # 存储可能由多个进程共用，释放锁之前写入，避免与其他进程的写入交错
+                    await session_flusher.flush()
+            finally:
+                self._held[sid] -= 1
+                if not self._held[sid]:
+                    del self._held[sid]
+
+    async def seed_state(self) -> None:
+        """
+        启动时把后端中还没有的会话、用户所在的会话与群权限写入后端，后端中已有的会话之后同步时读取
+        """
+        sessions: List[Session] = self.sessions
+        versions: List[int] = await self.state.get_versions([(str(s.group), s.session_id) for s in sessions])
+        created: int = 0
+        for session, version in zip(sessions, versions):
+            if version == 0:
+                session.version = 0
+                await self.publish(session)
+                created += 1
+        self._state_epoch = await self.state.seed({gid: {uid: s.session_id for uid, s in usage.items()}
+                                                   for gid, usage in self.session_usage.items()}, self.group_auth)
+        logger.info(f'已向状态后端写入会话 {created} 个，其余 {len(sessions) - created} 个已存在')
+
+
+class HistoryCache:
+    """
+    会话历史记录的 LRU 工作集
+    超出数量或字节预算时，卸载最久未访问且修改已全部写入存储的会话历史，之后访问时再从存储中读取
+    """
+    MESSAGE_OVERHEAD: int = sys.getsizeof(Message('', ''))
+
+    def __init__(self, max_count: int, max_bytes: int, track: bool = False):
+        self.max_count: int = max_count
+        self.max_bytes: int = max_bytes
+        # 不限制工作集时也统计已读入的会话与字节数，用于导出指标
+        self.track: bool = track
+        self._sessions: "OrderedDict[int, Session]" = OrderedDict()
+        self._sizes: Dict[int, int] = {}
+        self.total_bytes: int = 0
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_count > 0 or self.max_bytes > 0
+
+    @property
+    def loaded(self) -> int:
+        return len(self._sessions)
+
+    @classmethod
+    def history_size(cls, history: History) -> int:
+        # 预设由多个会话共用，不计入单个会话
+        return sum(sys.getsizeof(m.content) + cls.MESSAGE_OVERHEAD for m in history.recent)
+
+    def touch(self, session: "Session", hydrated: bool = False) -> None:
+        if hydrated:
+            self.misses += 1
+        else:
+            self.hits += 1
+        if not self.enabled and not self.track:
+            return
+        key: int = id(session)
+        if key in self._sessions:
+            self._sessions.move_to_end(key)
+            return
+        self._sessions[key] = session
+        self.resize(session)
+
+    def resize(self, session: "Session") -> None:
+        key: int = id(session)
+        if key not in self._sessions:
+            return
+        size: int = self.history_size(session._history)
+        self.total_bytes += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+        self._shrink(keep=key)
+
+    def shrink(self) -> None:
+        """
+        卸载超出预算的会话历史，在写入存储后调用：有未写入修改的会话在 touch 时不能卸载
+        """
+        self._shrink(keep=None)
+
+    def discard(self, session: "Session") -> None:
+        key: int = id(session)
+        self._sessions.pop(key, None)
+        self.total_bytes -= self._sizes.pop(key, 0)
+
+    def _over_budget(self) -> bool:
+        return (0 < self.max_count < len(self._sessions)) or (0 < self.max_bytes < self.total_bytes)
+
+    def _shrink(self, keep: Optional[int]) -> None:
+        if not self._over_budget():
+            return
+        for key, session in list(self._sessions.items()):
+            if key == keep or session._rewrite or session_flusher.is_pending(session):
+                continue
+            self.discard(session)
+            session._history_len = len(session._history)
+            session._history = None
+            self.evictions += 1
+            if not self._over_budget():
+                return
 
 
 class Session:
-    def __init__(self, chat_log: List[Dict[str, str]], creator: int, group: Union[int, str], name: str,
-                 chat_memory_max: int, dir_path: Path, history_max: int = 100,
-                 users=None, is_save: bool = True, basic_len: int = None):
-        self.history: List[Dict[str, str]] = chat_log
+    def __init__(self, chat_log: Union[List[Dict[str, str]], History, None], creator: int, group: Union[int, str],
+                 name: str, chat_memory_max: int, history_max: int = 100,
+                 users=None, is_save: bool = True, basic_len: int = None, session_id: str = None,
+                 summary: str = '', prefix: str = ''):
+        self.session_id: str = session_id or uuid.uuid4().hex
         self.creator: int = creator
         self._users: Set[int] = set(users) if users else set()
         self.group: str = group
         self.name: str = name
         self.chat_memory_max: int = chat_memory_max
+        # 预设之后最多保留的消息条数，预设不计入也不会被淘汰
         self.history_max: int = history_max
         self.creation_time: int = int(datetime.datetime.now().timestamp())
-        self.dir_path: Path = dir_path
-        if basic_len:
-            self.basic_len: int = basic_len
-        else:
-            self.basic_len = len(self.history)
+        # 存储中单独保存的预设的哈希，为空时预设与消息保存在一起（旧版本的格式），下次完整写入时更新
+        self.prefix: str = prefix
+        if isinstance(chat_log, History):
+            basic_len = len(chat_log.preset)
+        elif not basic_len:
+            basic_len = len(chat_log if chat_log is not None else session_store.load_history(self.session_id))
+        self.basic_len: int = basic_len
+        # 延迟加载时为 None，首次访问 history 时从存储中读取
+        self._history: Optional[History] = None
+        # 卸载时历史记录的条数，用于写入时判断是否需要压缩而不必重新读取，None 表示未知
+        self._history_len: Optional[int] = None
+        if isinstance(chat_log, History):
+            self._history = chat_log
+            history_cache.touch(self)
+        elif chat_log is not None:
+            self._history = History.from_messages(chat_log, basic_len, history_max, prefix or None)
+            history_cache.touch(self)
+        # 已经压缩移出历史记录的消息的摘要，请求时放在预设之后
+        self.summary: str = summary
+        # 尚未写入的消息、元信息是否修改、上次完整写入后写入的记录数以及是否需要完整写入
+        self._pending: List[Message] = []
+        self._meta_dirty: bool = False
+        self._log_records: int = 0
+        self._rewrite: bool = is_save
+        # 在共享状态后端中的版本号，0 表示还没有写入后端
+        self.version: int = 0
         if is_save:
             self.save()
 
+    @property
+    def history(self) -> History:
+        if self._history is None:
+            self._history = History.from_messages(session_store.load_history(self.session_id), self.basic_len,
+                                                  self.history_max, self.prefix or None)
+            history_cache.touch(self, hydrated=True)
+        else:
+            history_cache.touch(self)
+        return self._history
+
+    async def hydrate(self) -> History:
+        """
+        延迟加载时在写入线程中读取历史记录，避免在事件循环中读取文件或等待正在进行的写入
+        """
+        if self._history is None:
+            with tracer.span('session.hydrate', standalone=False):
+                messages: List[Dict[str, str]] = await session_flusher.read(session_store.load_history,
+                                                                            self.session_id)
+            # 读取期间可能已经被同步读取或从状态后端更新
+            if self._history is None:
+                self._history = History.from_messages(messages, self.basic_len, self.history_max,
+                                                      self.prefix or None)
+                history_cache.touch(self, hydrated=True)
+                return self._history
+        return self.history
+
     @property
     def prompt(self) -> str:
-        return self.history[0].get('content', '').strip()
+        return self.history[0].content.strip()
 
     def rename(self, name: str) -> None:
-        self.file_path.unlink(missing_ok=True)
         self.name = name
+        self._meta_dirty = True
         self.save()
 
     @property
@@ -187,18 +613,45 @@ class Session:
 
     def add_user(self, user: int) -> None:
         self._users.add(user)
+        self._meta_dirty = True
         self.save()
 
     def del_user(self, user: int) -> None:
         self._users.discard(user)
+        self._meta_dirty = True
         self.save()
 
     def delete_file(self):
-        self.file_path.unlink(missing_ok=True)
+        session_flusher.discard(self)
+
+    def restore(self, data: Dict[str, Any], version: int) -> None:
+        """
+        使用状态后端中其他进程写入的内容替换本地的会话，用户列表以后端中用户所在的会话为准，不在这里修改
+        """
+        self.name = data['name']
+        self.chat_memory_max = data['chat_memory_max']
+        self.history_max = data['history_max']
+        self.basic_len = data['basic_len']
+        self.summary = data.get('summary', '')
+        self._history = History.from_messages(data['chat_log'], self.basic_len, self.history_max)
+        history_cache.touch(self)
+        history_cache.resize(self)
+        self.version = version
+        self._pending = []
+        self.save(rewrite=True)
 
     @property
     def chat_memory(self) -> List[Dict[str, str]]:
-        return self.history[:self.basic_len] + self.history[self.basic_len - self.chat_memory_max:]
+        return self.context_messages(plugin_config.model_name, plugin_config.max_tokens)
+
+    def context_messages(self, model: str, max_tokens: int) -> List[Dict[str, str]]:
+        """
+        请求使用的上下文：预设，加上为回复预留 max_tokens 后预算内最新的至多 chat_memory_max 条消息
+        """
+        history: History = self.history
+        return [m.as_dict() for m in context_builder.build(
+            history.preset, history.recent, self.chat_memory_max, context_builder.budget(model, max_tokens),
+            [summary_message(self.summary)] if self.summary else ())]
 
     async def ask_with_content(
             self,
@@ -209,9 +662,13 @@ class Session:
             temperature: float = 0.5,
             model: str = 'gpt-3.5-turbo',
             max_tokens=1024,
+            on_segment: Callable[[str], Awaitable[Any]] = None,
+            user_id: int = None,
     ) -> str:
-        self.update(content, role)
-        return await self.ask(api_keys, base_url, temperature, model, max_tokens)
+        with tracer.span('session.ask_with_content', session=self.name, model=model, stream=on_segment is not None):
+            await self.hydrate()
+            self.update(content, role)
+            return await self.ask(api_keys, base_url, temperature, model, max_tokens, on_segment, user_id)
 
     async def ask(
             self,
@@ -220,67 +677,304 @@ class Session:
             temperature: float = 0.5,
             model: str = 'gpt-3.5-turbo',
             max_tokens=1024,
+            on_segment: Callable[[str], Awaitable[Any]] = None,
+            user_id: int = None,
     ) -> str:
-        if api_keys.valid_num <= 0:
+        """
+        请求回复并写入历史记录，传入 on_segment 时使用流式请求，回复会分段传给 on_segment
+        开启对冲请求时（仅非流式），请求超过对冲延迟仍未返回会用另一个 key 同时再请求一次，先成功的结果生效
+        开启限流时先按群排队等待 key 的余量，user_id 用于限制每个用户排队的请求数
+        """
+        if api_keys.valid_num <= 0 and api_keys.probe_interval <= 0:
             logger.error(f'当前不存在api key，请在配置文件里进行配置...')
             return '当前不存在可用apikey，请联系管理员检查apikey信息'
-        if _key_load_balancing:
-            api_keys.shuffle()
-        for num, api_key in enumerate(api_keys):
-            api_key: APIKey
-            log_info = f'Api Key([{num + 1}/{len(api_keys)}]): {api_key.show()}'
-            if not api_key.status:
-                logger.warning(f'{log_info} 被标记失效，已跳过... \n失效原因:{api_key.fail_res}')
-                continue
-            aclient = AsyncOpenAI(
-                api_key=api_key.key,
-                base_url=base_url,
-                http_client=proxy_client
-                )
+        await self.hydrate()
+        messages: List[Dict[str, str]] = self.context_messages(model, max_tokens)
+        cache_key: Optional[str] = None
+        # 两种缓存都默认只在 temperature 为 0 时使用
+        cacheable: bool = temperature == 0 or _cache_any_temperature
+        if response_cache is not None and cacheable:
+            cache_key = context_key(model, temperature, max_tokens, messages)
+            cached: Optional[str] = response_cache.get(cache_key)
+            if cached is not None:
+                logger.debug(f'会话 {self.name} 命中回复缓存')
+                tracer.set_attribute('cache', 'response')
+                self.update(cached, 'assistant')
+                return cached
+        semantic_key: Optional[Tuple[str, Any]] = None
+        history: History = self.history
+        if semantic_cache is not None and cacheable and messages[-1]['role'] == 'user' \
+                and len(history.recent) == 1 and not self.summary:
+            # 只看预设与最后一条用户消息，因此只用于预设之后只有这条消息的回合，
+            # 否则“继续”“为什么”之类的追问会命中其他会话的回复
+            partition: str = semantic_cache.partition_key(model, [m.as_dict() for m in history.preset])
+            vector = semantic_cache.embed(messages[-1]['content'])
+            cached = semantic_cache.get(partition, vector)
+            if cached is not None:
+                logger.debug(f'会话 {self.name} 命中语义缓存')
+                tracer.set_attribute('cache', 'semantic')
+                self.update(cached, 'assistant')
+                return cached
+            semantic_key = (partition, vector)
+        prompt_tokens: int = context_builder.messages_tokens(messages)
+        # 按最长回复预留 token 余量，请求结束后退回没用完的部分
+        reserved: int = prompt_tokens + max_tokens
+        try:
+            with tracer.span('rate_limit.admit', tokens=reserved):
+                admitted: Optional[APIKey] = await rate_limiter.admit(
+                    self.group, user_id if user_id is not None else self.creator, reserved)
+        except RateLimitedError as e:
+            return str(e)
+        sent: List[str] = []
+        tried: Set[APIKey] = set()
+        attempts: int = 0
+        pending: Set[asyncio.Task] = set()
+
+        async def send_segment(segment: str) -> None:
+            sent.append(segment)
+            await on_segment(segment)
+
+        def record_failure(api_key: APIKey, e: Exception, start: float) -> None:
+            metrics.key_failures.inc(key=api_key.index, error=type(e).__name__)
+            metrics.request_latency.observe(time.perf_counter() - start, model=model, key=api_key.index, result='error')
+            tracer.set_error(type(e).__name__)
+
+        async def attempt(api_key: APIKey, log_info: str) -> Optional[str]:
+            """
+            使用 api_key 请求一次，成功时返回回复，失败时记录 key 的状态并返回 None
+            """
+            aclient = client_pool.get(api_key.key, base_url)
             logger.debug(f'当前使用 {log_info}')
-            try: 
-                completion: dict = await aclient.chat.completions.create(
-                    model=model,
-                    messages=self.chat_memory,
-                    temperature=temperature,
-                    max_tokens=max_tokens,
-                    timeout=_timeout,
-                )
-                # 不知道新版本这个改成什么了
-                if completion.choices is None:
-                    raise NoResponseError("未返回任何choices")
-                if len(completion.choices) == 0:
-                    raise NoResponseError("返回的choices长度为0")
-                if completion.choices[0].message is None:
-                    raise NoResponseError("未返回任何文本!")
-                
-                self.update_from_completion(completion)
-                logger.debug(f'{log_info} 请求成功')
-                return completion.choices[0].message.content
+            start: float = time.perf_counter()
+            used: int = 0
+            usage = None
+            try:
+                if on_segment is not None:
+                    content: str = await self.stream_completion(aclient, send_segment, temperature, model,
+                                                                max_tokens, messages)
+                else:
+                    completion = await aclient.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        timeout=_timeout,
+                    )
+                    # 不知道新版本这个改成什么了
+                    if completion.choices is None:
+                        raise NoResponseError("未返回任何choices")
+                    if len(completion.choices) == 0:
+                        raise NoResponseError("返回的choices长度为0")
+                    if completion.choices[0].message is None:
+                        raise NoResponseError("未返回任何文本!")
+                    content = completion.choices[0].message.content
+                    usage = completion.usage
+                # 接口返回了用量时按实际用量统计，流式请求按估算值统计
+                if usage is not None:
+                    prompt_used, completion_used = usage.prompt_tokens, usage.completion_tokens
+                else:
+                    prompt_used = prompt_tokens
+                    completion_used = context_builder.message_tokens({'role': 'assistant', 'content': content})
+                used = prompt_used + completion_used
+            except asyncio.CancelledError:
+                # 对冲请求中输掉的一方被取消
+                api_keys.release(api_key)
+                raise
             except RateLimitError as e:
-                if 'You exceeded your current quota, please check your plan and billing details.' in e.user_message:
+                record_failure(api_key, e, start)
+                if e.code == 'insufficient_quota' or 'You exceeded your current quota' in e.message:
                     logger.warning(f'{log_info} 额度耗尽，已失效，尝试使用下一个...')
                     logger.warning(f'{type(e)}: {e}')
-                    api_key.fail(f'{type(e).__name__}: {e}')
-                    api_keys.valid_num -= 1
+                    api_keys.report_failure(api_key, f'{type(e).__name__}: {e}')
+                    client_pool.discard(api_key.key)
                 else:
-                    logger.warning(f'{log_info} 请求速率过快，尝试使用下一个...')
+                    retry_after: Optional[float] = parse_retry_after(e.response.headers)
+                    api_keys.report_rate_limit(api_key, retry_after)
+                    logger.warning(f'{log_info} 请求速率过快，冷却 '
+                                   f'{retry_after if retry_after is not None else api_keys.cooldown:.0f} 秒，尝试使用下一个...')
                     logger.warning(f'{e}')
-            except (APIResponseValidationError, AuthenticationError, PermissionError) as e:
+                return None
+            except (APIResponseValidationError, AuthenticationError, PermissionDeniedError) as e:
+                record_failure(api_key, e, start)
                 logger.warning(f'{log_info} 格式或权限错误，已失效，尝试使用下一个...')
                 logger.warning(f'{e}')
-                api_key.fail(f'{type(e).__name__}: {e}')
-                api_keys.valid_num -= 1
+                api_keys.report_failure(api_key, f'{type(e).__name__}: {e}')
+                client_pool.discard(api_key.key)
+                return None
             except Exception as e:
+                record_failure(api_key, e, start)
                 logger.warning(f'{log_info} 请求出现其他错误，尝试使用下一个...')
                 logger.warning(f'{type(e)}: {e}')
+                api_keys.report_error(api_key)
+                return None
+            finally:
+                api_keys.refund(api_key, reserved - used)
+            latency: float = time.perf_counter() - start
+            api_keys.report_success(api_key, latency)
+            hedge_policy.observe(latency)
+            metrics.request_latency.observe(latency, model=model, key=api_key.index, result='success')
+            metrics.prompt_tokens.inc(prompt_used, model=model, key=api_key.index)
+            metrics.completion_tokens.inc(completion_used, model=model, key=api_key.index)
+            tracer.set_attribute('prompt_tokens', prompt_used)
+            tracer.set_attribute('completion_tokens', completion_used)
+            logger.debug(f'{log_info} 请求成功，耗时 {latency:.2f}s' +
+                         (f'，共发送 {len(sent)} 段' if on_segment is not None else ''))
+            return content
+
+        async def traced_attempt(api_key: APIKey, log_info: str, number: int, hedge: bool) -> Optional[str]:
+            with tracer.span('llm.attempt', key=api_key.index, attempt=number, hedge=hedge):
+                return await attempt(api_key, log_info)
+
+        def launch(api_key: Optional[APIKey] = None) -> Optional[asyncio.Task]:
+            nonlocal attempts
+            if api_key is None:
+                api_key = api_keys.acquire(exclude=tried, tokens=reserved)
+            if api_key is None:
+                return None
+            tried.add(api_key)
+            attempts += 1
+            log_info = f'Api Key([{attempts}/{len(api_keys)}]): {api_key.show()}'
+            if api_key.probing:
+                log_info += ' (重新探测)'
+            task: asyncio.Task = asyncio.get_running_loop().create_task(
+                traced_attempt(api_key, log_info, attempts, bool(pending)))
+            pending.add(task)
+            return task
+
+        # 流式请求已经发送的分段无法撤回，不进行对冲
+        hedge_delay: Optional[float] = hedge_policy.delay() if on_segment is None else None
+        hedge_task: Optional[asyncio.Task] = None
+        answer: Optional[str] = None
+        waited: float = 0.0
+        hedge_policy.requests += 1
+        try:
+            if admitted is not None:
+                launch(admitted)
+            while answer is None and not sent:
+                if not pending and launch() is None:
+                    # 可用的 key 都在冷却中时等待最早冷却结束的 key，合计不超过 rate_limit_max_wait 秒
+                    wait: Optional[float] = api_keys.capacity_wait(reserved, exclude=tried)
+                    if wait is None or waited + wait > _key_max_wait:
+                        break
+                    # 探测中的 key 还没有返回结果时也会得到 0，稍等一下再检查
+                    wait = max(wait, 0.1)
+                    cooling: List[APIKey] = [k for k in tried if k.cooldown_until > time.monotonic()]
+                    logger.info(f'当前所有 api key 都在冷却中，等待 {wait:.1f} 秒后重试')
+                    with tracer.span('key.wait', seconds=round(wait, 3)):
+                        await asyncio.sleep(wait)
+                    waited += wait
+                    # 冷却结束的 key 可以再次尝试
+                    tried.difference_update(cooling)
+                    continue
+                timeout: Optional[float] = hedge_delay if hedge_task is None and len(pending) == 1 else None
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 对冲请求同样计入全局每分钟请求数，没有余量时不对冲，继续等待原来的请求
+                    if not rate_limiter.try_consume():
+                        hedge_policy.rate_limited += 1
+                        hedge_delay = None
+                        continue
+                    hedge_task = launch()
+                    if hedge_task is None:
+                        rate_limiter.refund()
+                        hedge_delay = None
+                        continue
+                    hedge_policy.hedged += 1
+                    hedge_policy.extra_prompt_tokens += context_builder.messages_tokens(messages)
+                    logger.debug(f'请求 {hedge_delay:.2f}s 内未返回，使用另一个 key 发出对冲请求')
+                    continue
+                for task in done:
+                    result: Optional[str] = task.result()
+                    if result is None:
+                        continue
+                    if answer is None:
+                        answer = result
+                        if task is hedge_task:
+                            hedge_policy.hedge_wins += 1
+                    else:
+                        # 两个请求同时成功，另一个回复的 token 也已经花掉了
+                        hedge_policy.extra_completion_tokens += context_builder.message_tokens(
+                            {'role': 'assistant', 'content': result})
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            if attempts:
+                metrics.request_attempts.observe(attempts)
+        if answer is not None:
+            if cache_key is not None:
+                response_cache.put(cache_key, answer)
+            if semantic_key is not None:
+                semantic_cache.put(*semantic_key, answer)
+            self.update(answer, 'assistant')
+            return answer
+        if sent:
+            # 已经发送了部分回复，换用下一个 key 会重复发送，直接结束
+            logger.warning(f'流式回复中断，已发送 {len(sent)} 段')
+            await on_segment('回复中断...请稍后重试')
+            return '回复中断...请稍后重试'
+        if not attempts:
+            logger.warning('当前没有可用的 api key，全部处于冷却或失效状态')
+            return '当前所有apikey都在冷却或已失效，请稍后再试'
         return '请求失败...请联系管理员查看错误日志和apikey信息'
 
+    async def stream_completion(
+            self,
+            aclient: AsyncOpenAI,
+            on_segment: Callable[[str], Awaitable[Any]],
+            temperature: float,
+            model: str,
+            max_tokens: int,
+            messages: List[Dict[str, str]] = None,
+    ) -> str:
+        """
+        流式请求，在段落、句子边界或超过字数、时间阈值时把回复分段传给 on_segment，返回完整回复
+        """
+        stream = await aclient.chat.completions.create(
+            model=model,
+            messages=messages if messages is not None else self.context_messages(model, max_tokens),
+            temperature=temperature,
+            max_tokens=max_tokens,
+            timeout=_timeout,
+            stream=True,
+        )
+        buffer: StreamBuffer = StreamBuffer(_stream_flush_chars, _stream_flush_interval)
+        async for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            for segment in buffer.feed(chunk.choices[0].delta.content):
+                await on_segment(segment)
+        rest: Optional[str] = buffer.close()
+        if rest:
+            await on_segment(rest)
+        if not buffer.text:
+            raise NoResponseError("未返回任何文本!")
+        return buffer.text
+
     def update(self, content: str, role: str = 'user') -> None:
-        self.history.append({'role': role, 'content': content})
-        while len(self.history) > self.history_max:
-            self.history.pop(0)
+        message: Message = Message(role, content)
+        # 超出 history_max 时环形缓冲自动淘汰预设之后最早的消息
+        self.history.append(message)
+        self._pending.append(message)
+        history_cache.resize(self)
         self.save()
+        if compactor is not None:
+            compactor.schedule(self)
+
+    def compact(self, summary: str, compacted: List[Message]) -> bool:
+        """
+        用摘要替换预设之后最早的 compacted 这几条消息，这几条消息已经不在原来的位置时（如被其他进程的内容替换）不做修改
+        """
+        history: History = self.history
+        current: List[Message] = history.oldest(len(compacted))
+        if len(current) < len(compacted) or any(a is not b for a, b in zip(current, compacted)):
+            return False
+        history.drop_oldest(len(compacted))
+        self.summary = summary
+        history_cache.resize(self)
+        self.save(rewrite=True)
+        return True
 
     def update_from_completion(self, completion: dict) -> None:
         role = completion.choices[0].message.role
@@ -288,27 +982,20 @@ class Session:
         self.update(content, role)
 
     @classmethod
-    def reload(cls, chat_log: List[Dict[str, str]], creator: int, group: str, name: str, creation_time: int,
-               chat_memory_max: int, dir_path: Path, history_max: int, users: List[int] = None,
-               basic_len: int = None) -> "Session":
-        session: "Session" = cls(chat_log, creator, group, name, chat_memory_max, dir_path, history_max, users, False,
-                                 basic_len)
+    def reload(cls, creator: int, group: str, name: str, creation_time: int, chat_memory_max: int,
+               history_max: int, chat_log: List[Dict[str, str]] = None, users: List[int] = None,
+               basic_len: int = None, session_id: str = None, summary: str = '', prefix: str = '') -> "Session":
+        session: "Session" = cls(chat_log, creator, group, name, chat_memory_max, history_max, users, False,
+                                 basic_len, session_id, summary, prefix)
         session.creation_time = creation_time
         return session
 
-    @classmethod
-    def reload_from_file(cls, file_path: Path) -> Optional["Session"]:
-        try:
-            with open(file_path, 'r', encoding='utf8') as f:
-                session: Session = cls.reload(dir_path=file_path.parent, **json.load(f))
-                logger.success(f'从文件 {file_path} 加载 Session 成功')
-                return session
-        except Exception as e:
-            logger.error(f'从文件 {file_path} 加载 Session 失败\n{type(e)}:{e}')
-
     def as_dict(self) -> dict:
+        return {'chat_log': self.history.as_dicts(), **self.meta_dict()}
+
+    def meta_dict(self) -> Dict[str, Any]:
         return {
-            'chat_log': self.history,
+            'session_id': self.session_id,
             'creator': self.creator,
             'users': list(self._users),
             'group': self.group,
@@ -317,15 +1004,44 @@ class Session:
             'chat_memory_max': self.chat_memory_max,
             'history_max': self.history_max,
             'basic_len': self.basic_len,
+            'summary': self.summary,
+            'prefix': self.prefix,
         }
 
     @property
-    def file_path(self) -> Path:
-        return self.dir_path / f'{self.group}_{self.name}_{self.creator}_{self.creation_time}.json'
+    def storage_name(self) -> str:
+        return f'{self.group}_{self.name}_{self.creator}_{self.creation_time}'
 
-    def save(self):
-        with open(self.file_path, 'w', encoding='utf8') as f:
-            json.dump(self.as_dict(), f, ensure_ascii=False)
+    def save(self, rewrite: bool = False):
+        self._rewrite = self._rewrite or rewrite
+        with tracer.span('session.save', standalone=False, write_behind=session_flusher.enabled):
+            session_flusher.mark_dirty(self)
+
+    def take_changes(self) -> SessionChanges:
+        """
+        取出自上次写入以来的修改，写入记录过多时由存储决定是否改为完整写入进行压缩
+        """
+        records: int = len(self._pending) + self._meta_dirty
+        # 已卸载的会话只有元信息修改（如加入、退出、重命名）时不为了判断压缩而重新读取历史记录
+        history_len: Optional[int] = len(self._history) if self._history is not None else self._history_len
+        if history_len is not None and session_store.needs_compaction(self._log_records + records, history_len):
+            self._rewrite = True
+        if self._rewrite:
+            # 完整写入时预设按哈希单独保存，只写入预设之后的消息
+            history: History = self.history
+            self.prefix = history.prefix.key
+            changes: SessionChanges = SessionChanges(self.session_id, self.storage_name, self.meta_dict(),
+                                                     [m.as_dict() for m in history.recent], True, True,
+                                                     history.preset)
+            self._log_records = len(history.recent) + 1
+        else:
+            changes = SessionChanges(self.session_id, self.storage_name, self.meta_dict(),
+                                     [m.as_dict() for m in self._pending], self._meta_dirty, False)
+            self._log_records += records
+        self._pending = []
+        self._meta_dirty = False
+        self._rewrite = False
+        return changes
 
     def dump2json_str(self) -> str:
         return json.dumps(self.chat_memory, ensure_ascii=False)
@@ -334,8 +1050,57 @@ class Session:
 _chat_memory_max = plugin_config.chat_memory_max if plugin_config.chat_memory_max > 2 else 2
 _history_max = plugin_config.history_max if plugin_config.history_max > _chat_memory_max else 100
 _timeout = int(plugin_config.timeout) if plugin_config.timeout and plugin_config.timeout > 0 else 10
-_key_load_balancing: bool = plugin_config.key_load_balancing
+_log_compact_ratio: float = max(plugin_config.log_compact_ratio, 1.0)
+# 所有 key 都在冷却时一次对话最多等待的秒数
+_key_max_wait: float = max(plugin_config.rate_limit_max_wait, 0.0)
+_lazy_load_history: bool = plugin_config.lazy_load_history
+_stream_flush_chars: int = max(plugin_config.stream_flush_chars, 1)
+_stream_flush_interval: float = plugin_config.stream_flush_interval
+_cache_any_temperature: bool = plugin_config.response_cache_any_temperature
+_compact_model: str = plugin_config.compact_model or plugin_config.model_name
 
+# 会话文件夹中不是会话的文件，读取与导入会话时跳过
+_auxiliary_files: List[Optional[Path]] = [plugin_config.history_save_path / 'group_auth_file.json',
+                                          plugin_config.response_cache_path]
+
+if plugin_config.session_store == 'sqlite':
+    session_store: SessionStore = SqliteStore(plugin_config.sqlite_path or
+                                              plugin_config.history_save_path / 'sessions.db')
+    logger.info("会话存储: sqlite")
+else:
+    session_store = JsonDirStore(plugin_config.history_save_path, _log_compact_ratio, exclude=_auxiliary_files)
+session_flusher: SessionFlusher = SessionFlusher(session_store, plugin_config.save_interval)
+history_cache: HistoryCache = HistoryCache(plugin_config.history_cache_max if _lazy_load_history else 0,
+                                           plugin_config.history_cache_max_bytes if _lazy_load_history else 0,
+                                           plugin_config.metrics)
+session_flusher.on_flushed = history_cache.shrink
+
+response_cache: Optional[ResponseCache] = ResponseCache(
+    plugin_config.response_cache_max, plugin_config.response_cache_ttl, plugin_config.response_cache_path
+) if plugin_config.response_cache else None
+_embedder: Optional[Embedder] = create_embedder(
+    plugin_config.semantic_cache_embedder, plugin_config.semantic_cache_model
+) if plugin_config.semantic_cache else None
+semantic_cache: Optional[SemanticCache] = SemanticCache(
+    _embedder, plugin_config.semantic_cache_threshold, plugin_config.semantic_cache_max
+) if _embedder is not None else None
+turn_scheduler: TurnScheduler = TurnScheduler(plugin_config.turn_batch_window)
+dispatcher: Dispatcher = Dispatcher(plugin_config.dispatch_concurrency, plugin_config.dispatch_lanes,
+                                    plugin_config.dispatch_queue_max)
+hedge_policy: HedgePolicy = HedgePolicy(plugin_config.hedge_requests and len(plugin_config.api_key) > 1,
+                                        plugin_config.hedge_percentile, plugin_config.hedge_min_delay, _timeout / 2)
+context_builder: ContextBuilder = ContextBuilder(create_tokenizer(plugin_config.tokenizer, plugin_config.model_name),
+                                                 plugin_config.context_windows)
+
+plugin_config.api_key.configure(plugin_config.key_load_balancing, plugin_config.key_cooldown,
+                                plugin_config.key_probe_interval)
+plugin_config.api_key.configure_limits(plugin_config.key_rpm, plugin_config.key_tpm)
+tracer.configure(plugin_config.tracing, plugin_config.trace_slowest)
+rate_limiter: RateLimiter = RateLimiter(plugin_config.api_key, plugin_config.global_rpm, plugin_config.rate_limit_max_wait,
+                                        plugin_config.user_max_pending, plugin_config.group_weights)
+
+state_backend: StateBackend = create_state_backend(plugin_config.state_backend, plugin_config.redis_url,
+                                                   plugin_config.redis_prefix, plugin_config.state_lock_ttl)
 session_container: SessionContainer = SessionContainer(
     dir_path=plugin_config.history_save_path,
     chat_memory_max=_chat_memory_max,
@@ -343,4 +1108,119 @@ session_container: SessionContainer = SessionContainer(
     base_url=plugin_config.openai_api_base,
     history_max=_history_max,
     default_only_admin=plugin_config.default_only_admin,
+    store=session_store,
+    state=state_backend,
 )
+
+
+async def complete_summary(messages: List[Dict[str, str]], max_tokens: int) -> str:
+    """
+    生成摘要的请求：不经过限流排队与缓存，依次尝试可用的 key，全部失败时抛出 NoResponseError
+    """
+    api_keys: APIKeyPool = plugin_config.api_key
+    reserved: int = context_builder.messages_tokens(messages) + max_tokens
+    tried: Set[APIKey] = set()
+    while True:
+        api_key: Optional[APIKey] = api_keys.acquire(exclude=tried, tokens=reserved)
+        if api_key is None:
+            raise NoResponseError('没有可用的 api key')
+        tried.add(api_key)
+        start: float = time.perf_counter()
+        used: int = 0
+        try:
+            completion = await client_pool.get(api_key.key, plugin_config.openai_api_base).chat.completions.create(
+                model=_compact_model, messages=messages, temperature=0.3, max_tokens=max_tokens, timeout=_timeout)
+            if not completion.choices or completion.choices[0].message is None:
+                raise NoResponseError('未返回任何文本!')
+            content: str = completion.choices[0].message.content or ''
+            if completion.usage is not None:
+                used = completion.usage.prompt_tokens + completion.usage.completion_tokens
+                metrics.prompt_tokens.inc(completion.usage.prompt_tokens, model=_compact_model, key=api_key.index)
+                metrics.completion_tokens.inc(completion.usage.completion_tokens, model=_compact_model,
+                                              key=api_key.index)
+        except asyncio.CancelledError:
+            api_keys.release(api_key)
+            raise
+        except RateLimitError as e:
+            api_keys.report_rate_limit(api_key, parse_retry_after(e.response.headers))
+            continue
+        except Exception as e:
+            logger.warning(f'生成摘要的请求失败，尝试使用下一个 key\n{type(e)}:{e}')
+            api_keys.report_error(api_key)
+            continue
+        finally:
+            api_keys.refund(api_key, reserved - used)
+        api_keys.report_success(api_key, time.perf_counter() - start)
+        return content
+
+
+compactor: Optional[Compactor] = Compactor(
+    create_summarizer(plugin_config.compact_summarizer, plugin_config.compact_max_tokens, complete_summary),
+    plugin_config.compact_threshold, session_container.apply_summary
+) if plugin_config.compact_threshold > 0 else None
+
+
+@metrics.on_collect
+def _collect_session_metrics() -> None:
+    metrics.sessions.set(session_container.session_count)
+    metrics.sessions_loaded.set(history_cache.loaded)
+    metrics.history_bytes.set(history_cache.total_bytes)
+
+
+metrics.register_stats('flusher', session_flusher.stats)
+metrics.register_stats('http', http_stats.stats)
+metrics.register_stats('client_pool', client_pool.stats)
+metrics.register_stats('turns', turn_scheduler.stats)
+if dispatcher.enabled:
+    metrics.register_stats('dispatch', dispatcher.stats, 'lane')
+# key 只按序号区分，不在指标中暴露 key 的内容
+metrics.register_stats('api_key', lambda: [{**s, 'key': i} for i, s in enumerate(plugin_config.api_key.stats())], 'key')
+metrics.register_stats('hedge', hedge_policy.stats)
+metrics.register_stats('rate_limit', rate_limiter.stats, 'group')
+if response_cache is not None:
+    metrics.register_stats('response_cache', response_cache.stats)
+if semantic_cache is not None:
+    metrics.register_stats('semantic_cache', semantic_cache.stats)
+if state_backend.shared:
+    metrics.register_stats('state', state_backend.stats)
+if compactor is not None:
+    metrics.register_stats('compactor', compactor.stats)
+if plugin_config.metrics:
+    metrics.mount(plugin_config.metrics_path)
+
+
+@get_driver().on_startup
+async def _start_session_flusher():
+    session_flusher.start()
+    if response_cache is not None:
+        response_cache.load()
+    session_container.start_loading(plugin_config.load_workers, plugin_config.load_with_processes)
+
+
+async def _shutdown_step(name: str, step: Callable[[], Any]) -> None:
+    """
+    执行关闭时的一步，失败只记录日志，不影响之后的步骤
+    """
+    try:
+        result = step()
+        if asyncio.iscoroutine(result):
+            await result
+    except Exception as e:
+        logger.error(f'关闭时{name}失败\n{type(e)}:{e}')
+
+
+@get_driver().on_shutdown
+async def _stop_session_flusher():
+    if compactor is not None:
+        await _shutdown_step('停止历史记录压缩', compactor.close)
+    await _shutdown_step('写入会话', session_flusher.stop)
+    await _shutdown_step('关闭状态后端', state_backend.close)
+    await _shutdown_step('关闭 HTTP 客户端', proxy_client.aclose)
+    if response_cache is not None:
+        await _shutdown_step('保存回复缓存', response_cache.save)
+        logger.info(f'回复缓存命中 {response_cache.hits} 次，未命中 {response_cache.misses} 次')
+    logger.info(f'共发出请求 {http_stats.requests} 次，连接复用率 {http_stats.reuse_rate:.1%}，'
+                f'平均首字节时间 {http_stats.avg_ttfb * 1000:.1f}ms')
+    if hedge_policy.enabled:
+        logger.info(f'共发出对冲请求 {hedge_policy.hedged} 次，其中 {hedge_policy.hedge_wins} 次先返回，额外花费约 '
+                    f'{hedge_policy.extra_prompt_tokens + hedge_policy.extra_completion_tokens} tokens')
@@ -0,0 +1,256 @@
+import json
+import time
+import uuid
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from nonebot.log import logger
+
+from .custom_errors import SessionStateError
+
+# 尝试引用 redis，非必须，只有 state_backend 为 redis 时需要
+try:
+    import redis.asyncio as redis
+except ModuleNotFoundError:
+    redis = None
+
+
+class GroupState(NamedTuple):
+    """
+    后端中一个群的状态：群权限（未设置时为 None）、用户所在的会话以及按创建顺序排列的会话版本号
+    epoch 为后端数据的标识，与启动时不同说明后端的数据已丢失（如 Redis 重启且没有持久化）
+    """
+    auth: Optional[bool]
+    usage: Dict[int, str]
+    versions: Dict[str, int]
+    epoch: str = ''
+
+
+class StateBackend:
+    """
+    会话状态后端，默认的进程内实现中状态只保存在本进程的 SessionContainer 里，以下方法均不需要做任何事
+    shared 为 True 的后端由多个 bot 进程共用：处理指令前按群同步，修改会话前获取会话锁，写入时比较版本号
+    """
+    name: str = 'memory'
+    shared: bool = False
+
+    async def close(self) -> None:
+        pass
+
+    async def load_group(self, gid: str) -> GroupState:
+        return GroupState(None, {}, {})
+
+    async def get_versions(self, keys: Iterable[Tuple[str, str]]) -> List[int]:
+        """
+        按 (群, 会话id) 查询会话的版本号，会话不存在时为 0
+        """
+        return [0 for _ in keys]
+
+    async def get_sessions(self, gid: str, session_ids: Iterable[str]) -> Dict[str, Tuple[int, Dict[str, Any]]]:
+        """
+        读取会话的版本号与内容（Session.as_dict 格式），已删除的会话不在结果中
+        """
+        return {}
+
+    async def put_session(self, gid: str, session_id: str, version: int, data: Dict[str, Any]) -> Optional[int]:
+        """
+        版本号与 version 一致时写入会话（version 为 0 表示新建），返回新的版本号，不一致时返回 None
+        """
+        return version + 1
+
+    async def delete_session(self, gid: str, session_id: str) -> None:
+        pass
+
+    async def set_usage(self, gid: str, uid: int, session_id: Optional[str]) -> None:
+        pass
+
+    async def set_group_auth(self, gid: str, auth: bool) -> None:
+        pass
+
+    async def seed(self, usage: Dict[str, Dict[int, str]], auth: Dict[str, bool]) -> str:
+        """
+        用本地读取的状态补全后端中没有的用户会话与群权限，不覆盖已有的值，返回后端数据的 epoch
+        """
+        return ''
+
+    @asynccontextmanager
+    async def lock(self, session_id: str) -> AsyncIterator[None]:
+        # 进程内同一会话的对话已经由 TurnScheduler 排队，不需要额外加锁
+        yield
+
+    def stats(self) -> Dict[str, float]:
+        return {}
+
+
+# 版本号一致时写入会话，新建时按群内的序号记录创建顺序
+_PUT_SCRIPT: str = """
+local current = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+if current ~= tonumber(ARGV[2]) then
+    return -1
+end
+if current == 0 then
+    redis.call('ZADD', KEYS[2], redis.call('INCR', KEYS[4]), ARGV[1])
+end
+redis.call('SET', KEYS[3], ARGV[3])
+redis.call('HSET', KEYS[1], ARGV[1], current + 1)
+return current + 1
+"""
+# 删除会话，并让所在的用户退出该会话
+_DELETE_SCRIPT: str = """
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('DEL', KEYS[3])
+local usage = redis.call('HGETALL', KEYS[4])
+for i = 1, #usage, 2 do
+    if usage[i + 1] == ARGV[1] then
+        redis.call('HDEL', KEYS[4], usage[i])
+    end
+end
+return 1
+"""
+# 只释放自己持有的锁
+_UNLOCK_SCRIPT: str = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisState(StateBackend):
+    """
+    基于 Redis 的共享状态，同一个群的键带有相同的 hash tag，可以用于 Redis Cluster
+    {prefix}auth                     群权限
+    {prefix}{群}:usage               用户 -> 所在会话
+    {prefix}{群}:order / versions    会话的创建顺序与版本号，seq 为创建顺序的计数
+    {prefix}{群}:session:<会话id>    会话内容，json 格式
+    {prefix}lock:<会话id>            会话锁，超过 lock_ttl 秒自动释放
+    """
+    name = 'redis'
+    shared = True
+
+    def __init__(self, url: str, prefix: str, lock_ttl: float):
+        self.prefix: str = prefix
+        self.lock_ttl: float = lock_ttl
+        self._redis = redis.from_url(url, decode_responses=True)
+        self._put = self._redis.register_script(_PUT_SCRIPT)
+        self._delete = self._redis.register_script(_DELETE_SCRIPT)
+        self._unlock = self._redis.register_script(_UNLOCK_SCRIPT)
+        self.syncs: int = 0
+        self.conflicts: int = 0
+        self.lock_waits: int = 0
+        self.lock_wait_time: float = 0.0
+
+    def _key(self, gid: str, name: str) -> str:
+        return f'{self.prefix}{{{gid}}}:{name}'
+
+    async def close(self) -> None:
+        await self._redis.aclose()
+
+    async def load_group(self, gid: str) -> GroupState:
+        self.syncs += 1
+        async with self._redis.pipeline(transaction=False) as pipe:
+            pipe.hget(f'{self.prefix}auth', gid)
+            pipe.hgetall(self._key(gid, 'usage'))
+            pipe.zrange(self._key(gid, 'order'), 0, -1)
+            pipe.hgetall(self._key(gid, 'versions'))
+            pipe.get(f'{self.prefix}epoch')
+            auth, usage, order, versions, epoch = await pipe.execute()
+        return GroupState(None if auth is None else auth == '1',
+                          {int(uid): sid for uid, sid in usage.items()},
+                          {sid: int(versions[sid]) for sid in order if sid in versions},
+                          epoch or '')
+
+    async def get_versions(self, keys: Iterable[Tuple[str, str]]) -> List[int]:
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for gid, session_id in keys:
+                pipe.hget(self._key(gid, 'versions'), session_id)
+            return [int(v or 0) for v in await pipe.execute()]
+
+    async def get_sessions(self, gid: str, session_ids: Iterable[str]) -> Dict[str, Tuple[int, Dict[str, Any]]]:
+        session_ids = list(session_ids)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.hgetall(self._key(gid, 'versions'))
+            for session_id in session_ids:
+                pipe.get(self._key(gid, f'session:{session_id}'))
+            versions, *values = await pipe.execute()
+        return {session_id: (int(versions[session_id]), json.loads(value))
+                for session_id, value in zip(session_ids, values)
+                if value is not None and session_id in versions}
+
+    async def put_session(self, gid: str, session_id: str, version: int, data: Dict[str, Any]) -> Optional[int]:
+        result: int = await self._put(
+            keys=[self._key(gid, 'versions'), self._key(gid, 'order'), self._key(gid, f'session:{session_id}'),
+                  self._key(gid, 'seq')],
+            args=[session_id, version, json.dumps(data, ensure_ascii=False)])
+        if result < 0:
+            self.conflicts += 1
+            return None
+        return result
+
+    async def delete_session(self, gid: str, session_id: str) -> None:
+        await self._delete(keys=[self._key(gid, 'versions'), self._key(gid, 'order'),
+                                 self._key(gid, f'session:{session_id}'), self._key(gid, 'usage')],
+                           args=[session_id])
+
+    async def set_usage(self, gid: str, uid: int, session_id: Optional[str]) -> None:
+        if session_id is None:
+            await self._redis.hdel(self._key(gid, 'usage'), str(uid))
+        else:
+            await self._redis.hset(self._key(gid, 'usage'), str(uid), session_id)
+
+    async def set_group_auth(self, gid: str, auth: bool) -> None:
+        await self._redis.hset(f'{self.prefix}auth', gid, '1' if auth else '0')
+
+    async def seed(self, usage: Dict[str, Dict[int, str]], auth: Dict[str, bool]) -> str:
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for gid, value in auth.items():
+                pipe.hsetnx(f'{self.prefix}auth', gid, '1' if value else '0')
+            for gid, group_usage in usage.items():
+                for uid, session_id in group_usage.items():
+                    pipe.hsetnx(self._key(gid, 'usage'), str(uid), session_id)
+            pipe.set(f'{self.prefix}epoch', uuid.uuid4().hex, nx=True)
+            pipe.get(f'{self.prefix}epoch')
+            *_, epoch = await pipe.execute()
+        return epoch
+
+    @asynccontextmanager
+    async def lock(self, session_id: str) -> AsyncIterator[None]:
+        key: str = f'{self.prefix}lock:{session_id}'
+        token: str = uuid.uuid4().hex
+        start: float = time.monotonic()
+        delay: float = 0.01
+        while not await self._redis.set(key, token, nx=True, px=int(self.lock_ttl * 1000)):
+            if time.monotonic() - start > self.lock_ttl:
+                raise SessionStateError('会话正在其他地方使用，请稍后再试')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.2)
+        waited: float = time.monotonic() - start
+        if delay > 0.01:
+            self.lock_waits += 1
+            self.lock_wait_time += waited
+        try:
+            yield
+        finally:
+            await self._unlock(keys=[key], args=[token])
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'syncs': self.syncs,
+            'conflicts': self.conflicts,
+            'lock_waits': self.lock_waits,
+            'lock_wait_seconds': self.lock_wait_time,
+        }
+
+
+def create_state_backend(name: str, url: str, prefix: str, lock_ttl: float) -> StateBackend:
+    if name == RedisState.name:
+        if redis is None:
+            logger.warning('共享状态需要安装 redis 模块 (pip install redis)，已使用进程内状态')
+            return StateBackend()
+        logger.info(f'会话状态后端: redis {url}')
+        return RedisState(url, prefix, lock_ttl)
+    if name != StateBackend.name:
+        logger.warning(f'未知的状态后端 {name}，已使用进程内状态')
+    return StateBackend()
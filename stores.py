@@ -0,0 +1,505 @@
+import os
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from functools import partial, lru_cache
+from json import JSONDecodeError
+from collections.abc import Mapping
+from concurrent.futures import Executor
+from typing import Dict, List, Tuple, Any, Iterable, Iterator, NamedTuple, Optional, Sequence, Set
+
+from nonebot.log import logger
+
+from .custom_errors import SessionWriteError
+
+
+class SessionChanges(NamedTuple):
+    """
+    会话自上次写入以来的修改
+    rewrite 为 True 时 messages 为完整历史记录，否则为新增的消息
+    meta 中的 prefix 不为空时，开头 basic_len 条预设按内容哈希 prefix 单独保存、多个会话共用，
+    messages 不含预设，完整写入时 prefix_messages 为预设的内容，存储中还没有这份预设时写入
+    """
+    session_id: str
+    name: str
+    meta: Dict[str, Any]
+    messages: List[Dict[str, str]]
+    meta_dirty: bool
+    rewrite: bool
+    prefix_messages: Sequence[Mapping] = ()
+
+
+class StoredSession(NamedTuple):
+    """
+    从存储中读取的会话，data 与 Session.as_dict 格式一致（只读取索引时不含 chat_log）
+    rewrite 表示需要以当前格式重新写入，records 为上次完整写入后已写入的记录数
+    """
+    data: Dict[str, Any]
+    rewrite: bool = False
+    records: int = 0
+
+
+def atomic_write(file_path: Path, text: str, encoding: str = 'utf8') -> int:
+    """
+    先写入临时文件再替换，保证文件不会因为中途退出而损坏，返回写入的字节数
+    """
+    tmp_path: Path = file_path.with_name(file_path.name + '.tmp')
+    data: bytes = text.encode(encoding)
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, file_path)
+    return len(data)
+
+
+def dump_records(records: List[Dict[str, Any]]) -> str:
+    return ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+
+
+def dump_prefix(messages: Sequence[Mapping]) -> str:
+    return json.dumps([{'role': m['role'], 'content': m['content']} for m in messages], ensure_ascii=False)
+
+
+@lru_cache(maxsize=1024)
+def read_prefix(file_path: Path) -> Tuple[Dict[str, str], ...]:
+    """
+    读取共用的预设，同一进程内读取同一份预设的会话共用结果
+    """
+    with open(file_path, 'r', encoding='utf8') as f:
+        return tuple(json.load(f))
+
+
+def dump_session_log(meta: Dict[str, Any], messages: List[Dict[str, str]]) -> str:
+    """
+    生成完整的会话日志，第一行为元信息，之后每行一条消息
+    """
+    return dump_records([{'meta': meta}] + [{'msg': m} for m in messages])
+
+
+def trim_history(messages: List[Dict[str, str]], basic_len: int, history_max: int) -> List[Dict[str, str]]:
+    """
+    与 Session 的历史记录一致：保留开头 basic_len 条预设，之后只保留最新的 history_max 条消息
+    """
+    if not history_max or len(messages) <= basic_len + history_max:
+        return messages
+    return messages[:basic_len] + messages[-history_max:]
+
+
+def load_session_log(file_path: Path, index_only: bool = False) -> Tuple[Dict[str, Any], int]:
+    """
+    重放会话日志，返回会话字典（与 Session.as_dict 格式一致）以及日志行数
+    后出现的 meta 记录覆盖之前的字段，预设之后的消息按 history_max 只保留最新部分
+    meta 中有 prefix 时日志中不含预设，从同一文件夹下的 prefixes 中读取拼接在开头
+    index_only 为 True 时只解析 meta 记录，返回的字典不含 chat_log
+    """
+    meta: Dict[str, Any] = {}
+    messages: List[Dict[str, str]] = []
+    lines: int = 0
+    with open(file_path, 'r', encoding='utf8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            if index_only and not line.startswith('{"meta"'):
+                lines += 1
+                continue
+            try:
+                record: Dict[str, Any] = json.loads(line)
+            except JSONDecodeError:
+                # 只可能是写入中途退出导致的最后一行不完整
+                logger.warning(f'会话日志 {file_path} 第 {lines + 1} 行不完整，已忽略')
+                continue
+            lines += 1
+            if 'msg' in record:
+                messages.append(record['msg'])
+            elif 'meta' in record:
+                meta.update(record['meta'])
+    if index_only:
+        return meta, lines
+    if meta.get('prefix'):
+        preset: Tuple[Dict[str, str], ...] = read_prefix(file_path.parent / PREFIX_DIR / f'{meta["prefix"]}.json')
+        meta['chat_log'] = list(preset) + trim_history(messages, 0, meta.get('history_max', 0))
+    else:
+        meta['chat_log'] = trim_history(messages, meta.get('basic_len', 0), meta.get('history_max', 0))
+    return meta, lines
+
+
+def read_session_file(file: Path, index_only: bool = False) -> Tuple[Dict[str, Any], int]:
+    """
+    读取 .jsonl 日志或旧版本的 .json 会话文件
+    """
+    if file.suffix == '.jsonl':
+        return load_session_log(file, index_only)
+    with open(file, 'r', encoding='utf8') as f:
+        data: Dict[str, Any] = json.load(f)
+    if index_only:
+        data.pop('chat_log', None)
+    return data, 0
+
+
+def _try_read_session_file(file: Path, index_only: bool) -> Tuple[Optional[Dict[str, Any]], int, str]:
+    # 在线程池或进程池中执行，异常以字符串形式返回给调用方记录
+    try:
+        data, records = read_session_file(file, index_only)
+        return data, records, ''
+    except Exception as e:
+        return None, 0, f'{type(e)}:{e}'
+
+
+class SessionStore:
+    """
+    会话存储后端
+    apply 在写入线程中调用，其余方法在事件循环线程中调用
+    """
+
+    def load(self, executor: Optional[Executor] = None) -> List[StoredSession]:
+        """
+        读取全部会话，executor 不为空时可以用于并行读取
+        """
+        raise NotImplementedError
+
+    def load_index(self, executor: Optional[Executor] = None) -> List[StoredSession]:
+        """
+        只读取会话的元信息，历史记录之后通过 load_history 按需读取
+        """
+        return [StoredSession({k: v for k, v in s.data.items() if k != 'chat_log'}, s.rewrite, s.records)
+                for s in self.load(executor)]
+
+    def load_history(self, session_id: str) -> List[Dict[str, str]]:
+        raise NotImplementedError
+
+    def apply(self, changes: List[SessionChanges], deleted: Iterable[str]) -> int:
+        """
+        写入一批修改并删除会话，返回写入的字节数
+        部分会话写入失败时抛出 SessionWriteError，其余异常表示整批都未能确认写入
+        """
+        raise NotImplementedError
+
+    def needs_compaction(self, records: int, history_len: int) -> bool:
+        """
+        自上次完整写入后已写入 records 条记录时，是否需要重写整个会话
+        """
+        return False
+
+    def close(self) -> None:
+        pass
+
+
+# JsonDirStore 中共用的预设所在的子文件夹
+PREFIX_DIR: str = 'prefixes'
+
+
+class JsonDirStore(SessionStore):
+    """
+    每个会话一个 .jsonl 日志文件的文件夹存储，兼容旧版本的单个 .json 文件
+    共用的预设按内容哈希保存在 prefixes 子文件夹中，每份只写入一次，读取时清理不再被引用的预设
+    """
+
+    def __init__(self, dir_path: Path, compact_ratio: float, exclude: Iterable[Optional[Path]] = ()):
+        self.dir_path: Path = dir_path
+        self.compact_ratio: float = compact_ratio
+        # 文件夹中不是会话的文件（群权限、回复缓存等），按解析后的绝对路径比较，未配置的路径为 None
+        self.exclude: Set[Path] = {Path(p).resolve() for p in exclude if p is not None}
+        # session_id -> 当前对应的文件名
+        self._files: Dict[str, str] = {}
+        # 已经写入的预设
+        self._prefixes: Set[str] = set()
+        self._lock: threading.Lock = threading.Lock()
+
+    @property
+    def prefix_path(self) -> Path:
+        return self.dir_path / PREFIX_DIR
+
+    def _load(self, index_only: bool, executor: Optional[Executor]) -> List[StoredSession]:
+        files: List[Path] = [f for f in list(self.dir_path.glob('*.json')) + list(self.dir_path.glob('*.jsonl'))
+                             if f.resolve() not in self.exclude]
+        read = partial(_try_read_session_file, index_only=index_only)
+        results: Iterator = executor.map(read, files, chunksize=64) if executor else map(read, files)
+        sessions: List[StoredSession] = []
+        failed: bool = False
+        step: int = max(len(files) // 10, 1000)
+        for num, (file, (data, records, error)) in enumerate(zip(files, results), 1):
+            if num % step == 0:
+                logger.info(f'已读取会话文件 {num}/{len(files)}')
+            if data is None:
+                logger.error(f'从文件 {file} 加载 Session 失败\n{error}')
+                failed = True
+                continue
+            data.setdefault('session_id', file.stem)
+            self._files[data['session_id']] = file.name
+            sessions.append(StoredSession(data, file.suffix != '.jsonl', records))
+        # 有会话读取失败时无法确定它引用的预设，不做清理
+        self._collect_prefixes({s.data.get('prefix') for s in sessions}, remove=not failed)
+        return sessions
+
+    def _collect_prefixes(self, referenced: Set[Optional[str]], remove: bool) -> None:
+        with self._lock:
+            for file in list(self.prefix_path.glob('*.json')):
+                if file.stem in referenced:
+                    self._prefixes.add(file.stem)
+                elif remove:
+                    file.unlink(missing_ok=True)
+
+    def load(self, executor: Optional[Executor] = None) -> List[StoredSession]:
+        return self._load(False, executor)
+
+    def load_index(self, executor: Optional[Executor] = None) -> List[StoredSession]:
+        return self._load(True, executor)
+
+    def load_history(self, session_id: str) -> List[Dict[str, str]]:
+        with self._lock:
+            data, _ = read_session_file(self.dir_path / self._files[session_id])
+        return data['chat_log']
+
+    def apply(self, changes: List[SessionChanges], deleted: Iterable[str]) -> int:
+        size: int = 0
+        failed: List[str] = []
+        with self._lock:
+            for session_id in deleted:
+                file_name: Optional[str] = self._files.get(session_id)
+                if file_name:
+                    (self.dir_path / file_name).unlink(missing_ok=True)
+                    self._files.pop(session_id, None)
+            for change in changes:
+                try:
+                    size += self._apply_one(change)
+                except OSError as e:
+                    logger.error(f'写入会话 {change.name} 失败\n{type(e)}:{e}')
+                    failed.append(change.session_id)
+        if failed:
+            raise SessionWriteError(f'{len(failed)} 个会话写入失败', failed)
+        return size
+
+    def _apply_one(self, change: SessionChanges) -> int:
+        file_path: Path = self.dir_path / f'{change.name}.jsonl'
+        old_name: Optional[str] = self._files.get(change.session_id)
+        rewrite: bool = change.rewrite
+        if old_name and old_name != file_path.name:
+            old_path: Path = self.dir_path / old_name
+            if not rewrite and old_path.suffix == '.jsonl' and old_path.exists():
+                os.replace(old_path, file_path)
+            else:
+                old_path.unlink(missing_ok=True)
+                rewrite = True
+        self._files[change.session_id] = file_path.name
+        if rewrite:
+            return self._write_prefix(change) + atomic_write(file_path, dump_session_log(change.meta, change.messages))
+        records: List[Dict[str, Any]] = [{'msg': m} for m in change.messages]
+        if change.meta_dirty:
+            records.insert(0, {'meta': change.meta})
+        if not records:
+            return 0
+        text: str = dump_records(records)
+        with open(file_path, 'a', encoding='utf8') as f:
+            f.write(text)
+        return len(text.encode('utf8'))
+
+    def _write_prefix(self, change: SessionChanges) -> int:
+        key: str = change.meta.get('prefix') or ''
+        if not key or key in self._prefixes:
+            return 0
+        file_path: Path = self.prefix_path / f'{key}.json'
+        size: int = 0
+        if not file_path.exists():
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            size = atomic_write(file_path, dump_prefix(change.prefix_messages))
+        self._prefixes.add(key)
+        return size
+
+    def needs_compaction(self, records: int, history_len: int) -> bool:
+        return records > max(history_len, 1) * self.compact_ratio
+
+
+class SqliteStore(SessionStore):
+    """
+    SQLite（WAL 模式）存储，会话、会话用户与消息分表保存，每批修改在一个事务中写入
+    共用的预设按内容哈希保存在 prefixes 表中，会话的 prefix 列不为空时 messages 表中不含预设
+    """
+
+    SCHEMA: str = '''
+    CREATE TABLE IF NOT EXISTS sessions (
+        session_id TEXT PRIMARY KEY,
+        group_id TEXT NOT NULL,
+        name TEXT NOT NULL,
+        creator INTEGER NOT NULL,
+        creation_time INTEGER NOT NULL,
+        chat_memory_max INTEGER NOT NULL,
+        history_max INTEGER NOT NULL,
+        basic_len INTEGER NOT NULL,
+        summary TEXT NOT NULL DEFAULT '',
+        prefix TEXT NOT NULL DEFAULT ''
+    );
+    CREATE INDEX IF NOT EXISTS idx_sessions_group ON sessions (group_id, creation_time);
+    CREATE TABLE IF NOT EXISTS session_users (
+        session_id TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        PRIMARY KEY (session_id, user_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS messages (
+        session_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        PRIMARY KEY (session_id, seq)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS prefixes (
+        key TEXT PRIMARY KEY,
+        messages TEXT NOT NULL
+    ) WITHOUT ROWID;
+    '''
+    META_FIELDS: Tuple[str, ...] = ('group', 'name', 'creator', 'creation_time', 'chat_memory_max', 'history_max',
+                                    'basic_len', 'summary', 'prefix')
+
+    def __init__(self, db_path: Path):
+        self.db_path: Path = db_path
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn: sqlite3.Connection = sqlite3.connect(str(db_path), check_same_thread=False,
+                                                         isolation_level=None)
+        self._lock: threading.Lock = threading.Lock()
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(self.SCHEMA)
+        # 旧版本创建的数据库没有 summary 与 prefix 列
+        columns: List[str] = [row[1] for row in self._conn.execute('PRAGMA table_info(sessions)')]
+        for column in ('summary', 'prefix'):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE sessions ADD COLUMN {column} TEXT NOT NULL DEFAULT ''")
+        # session_id -> 下一条消息的序号
+        self._next_seq: Dict[str, int] = {}
+        # 已经写入的预设
+        self._prefixes: Set[str] = set()
+
+    def _load(self, index_only: bool) -> List[StoredSession]:
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT session_id, group_id, name, creator, creation_time, chat_memory_max, history_max, basic_len, '
+                'summary, prefix FROM sessions ORDER BY creation_time, rowid').fetchall()
+            self._conn.execute('DELETE FROM prefixes WHERE key NOT IN (SELECT prefix FROM sessions)')
+            prefixes: Dict[str, List[Dict[str, str]]] = {}
+            for key, text in self._conn.execute('SELECT key, messages FROM prefixes'):
+                self._prefixes.add(key)
+                if not index_only:
+                    prefixes[key] = json.loads(text)
+            users: Dict[str, List[int]] = {}
+            for session_id, user_id in self._conn.execute('SELECT session_id, user_id FROM session_users'):
+                users.setdefault(session_id, []).append(user_id)
+            messages: Dict[str, List[Dict[str, str]]] = {}
+            if index_only:
+                for session_id, seq in self._conn.execute(
+                        'SELECT session_id, MAX(seq) FROM messages GROUP BY session_id'):
+                    self._next_seq[session_id] = seq + 1
+            else:
+                for session_id, seq, role, content in self._conn.execute(
+                        'SELECT session_id, seq, role, content FROM messages ORDER BY session_id, seq'):
+                    messages.setdefault(session_id, []).append({'role': role, 'content': content})
+                    self._next_seq[session_id] = seq + 1
+        sessions: List[StoredSession] = []
+        for session_id, *meta in rows:
+            data: Dict[str, Any] = dict(zip(self.META_FIELDS, meta))
+            data.update(session_id=session_id, users=users.get(session_id, []))
+            if not index_only:
+                data['chat_log'] = prefixes.get(data['prefix'], []) + messages.get(session_id, [])
+            sessions.append(StoredSession(data))
+        return sessions
+
+    def load(self, executor: Optional[Executor] = None) -> List[StoredSession]:
+        return self._load(index_only=False)
+
+    def load_index(self, executor: Optional[Executor] = None) -> List[StoredSession]:
+        return self._load(index_only=True)
+
+    def load_history(self, session_id: str) -> List[Dict[str, str]]:
+        with self._lock:
+            row = self._conn.execute('SELECT p.messages FROM sessions s JOIN prefixes p ON p.key = s.prefix '
+                                     'WHERE s.session_id = ?', (session_id,)).fetchone()
+            return (json.loads(row[0]) if row else []) + [
+                {'role': role, 'content': content} for role, content in self._conn.execute(
+                    'SELECT role, content FROM messages WHERE session_id = ? ORDER BY seq', (session_id,))]
+
+    def contains(self, session_id: str) -> bool:
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM sessions WHERE session_id = ?', (session_id,)).fetchone() \
+                is not None
+
+    def apply(self, changes: List[SessionChanges], deleted: Iterable[str]) -> int:
+        size: int = 0
+        with self._lock:
+            cur: sqlite3.Cursor = self._conn.cursor()
+            next_seq: Dict[str, int] = dict(self._next_seq)
+            cur.execute('BEGIN')
+            try:
+                for session_id in deleted:
+                    for table in ('sessions', 'session_users', 'messages'):
+                        cur.execute(f'DELETE FROM {table} WHERE session_id = ?', (session_id,))
+                    self._next_seq.pop(session_id, None)
+                for change in changes:
+                    size += self._apply_one(cur, change)
+                cur.execute('COMMIT')
+            except Exception:
+                cur.execute('ROLLBACK')
+                # 回滚后本批写入的预设不一定存在，消息序号也恢复到写入前
+                self._prefixes.clear()
+                self._next_seq = next_seq
+                raise
+        return size
+
+    def _apply_one(self, cur: sqlite3.Cursor, change: SessionChanges) -> int:
+        session_id: str = change.session_id
+        size: int = 0
+        key: str = change.meta['prefix']
+        if change.rewrite and key and key not in self._prefixes:
+            text: str = dump_prefix(change.prefix_messages)
+            cur.execute('INSERT OR IGNORE INTO prefixes VALUES (?, ?)', (key, text))
+            self._prefixes.add(key)
+            size += len(text.encode('utf8'))
+        if change.rewrite or change.meta_dirty:
+            cur.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (session_id, *(change.meta[k] for k in self.META_FIELDS)))
+            cur.execute('DELETE FROM session_users WHERE session_id = ?', (session_id,))
+            cur.executemany('INSERT INTO session_users VALUES (?, ?)',
+                            [(session_id, user) for user in change.meta['users']])
+        if change.rewrite:
+            cur.execute('DELETE FROM messages WHERE session_id = ?', (session_id,))
+            self._next_seq[session_id] = 0
+        start: int = self._next_seq.get(session_id, 0)
+        cur.executemany('INSERT INTO messages VALUES (?, ?, ?, ?)',
+                        [(session_id, start + i, m['role'], m['content']) for i, m in enumerate(change.messages)])
+        self._next_seq[session_id] = start + len(change.messages)
+        # 与 Session 的历史记录一致，完整写入时序号从 0 开始，开头 basic_len 条预设（单独保存预设时没有）之后只保留最新的
+        # history_max 条消息
+        cur.execute('DELETE FROM messages WHERE session_id = ? AND seq >= ? AND seq < ?',
+                    (session_id, 0 if key else change.meta['basic_len'],
+                     self._next_seq[session_id] - change.meta['history_max']))
+        return size + sum(len(m['content'].encode('utf8')) for m in change.messages)
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def migrate_sessions(source: SessionStore, target: SqliteStore) -> List[StoredSession]:
+    """
+    将 source 中 target 尚不存在的会话完整写入 target，返回迁移的会话，重复执行不会产生重复会话
+    """
+    migrated: List[StoredSession] = []
+    changes: List[SessionChanges] = []
+    for stored in source.load():
+        data: Dict[str, Any] = stored.data
+        if target.contains(data['session_id']):
+            continue
+        meta: Dict[str, Any] = {k: v for k, v in data.items() if k != 'chat_log'}
+        meta.setdefault('basic_len', len(data['chat_log']))
+        meta.setdefault('summary', '')
+        meta.setdefault('prefix', '')
+        history_max: int = meta.get('history_max') or len(data['chat_log'])
+        meta['history_max'] = history_max
+        if meta['prefix']:
+            basic_len: int = meta['basic_len']
+            changes.append(SessionChanges(data['session_id'], '', meta,
+                                          trim_history(data['chat_log'][basic_len:], 0, history_max), True, True,
+                                          data['chat_log'][:basic_len]))
+        else:
+            changes.append(SessionChanges(data['session_id'], '', meta,
+                                          trim_history(data['chat_log'], meta['basic_len'], history_max), True, True))
+        migrated.append(StoredSession(data))
+    target.apply(changes, ())
+    return migrated
@@ -0,0 +1,63 @@
+import re
+import time
+from typing import List, Optional, Pattern
+
+# 句子结束的位置：中文标点、换行，以及后面跟空白的英文句号
+SENTENCE_END: Pattern = re.compile(r'[。！？!?；;\n]|\.(?=\s)')
+PARAGRAPH_END: str = '\n\n'
+
+
+class StreamBuffer:
+    """
+    流式回复的分段缓冲
+    遇到段落结束时立即输出一段；缓冲超过 flush_chars 个字或距离上次输出超过 flush_interval 秒时，
+    在最后一个句子结束处切分输出，没有句子结束时输出全部缓冲
+    """
+
+    def __init__(self, flush_chars: int, flush_interval: float):
+        self.flush_chars: int = flush_chars
+        self.flush_interval: float = flush_interval
+        self._parts: List[str] = []
+        self._buffer: str = ''
+        self._last_flush: float = time.monotonic()
+
+    @property
+    def text(self) -> str:
+        """
+        目前为止收到的完整回复
+        """
+        return ''.join(self._parts)
+
+    def feed(self, delta: str) -> List[str]:
+        """
+        写入新收到的文本，返回可以发送的分段
+        """
+        self._parts.append(delta)
+        self._buffer += delta
+        segments: List[str] = []
+        while PARAGRAPH_END in self._buffer:
+            paragraph, self._buffer = self._buffer.split(PARAGRAPH_END, 1)
+            self._emit(paragraph, segments)
+        if self._buffer.strip() and (len(self._buffer) >= self.flush_chars or
+                                     time.monotonic() - self._last_flush >= self.flush_interval):
+            cut: int = 0
+            for match in SENTENCE_END.finditer(self._buffer):
+                cut = match.end()
+            if not cut:
+                cut = len(self._buffer)
+            segment, self._buffer = self._buffer[:cut], self._buffer[cut:]
+            self._emit(segment, segments)
+        return segments
+
+    def close(self) -> Optional[str]:
+        """
+        回复结束，返回剩余未发送的文本
+        """
+        segment, self._buffer = self._buffer.strip(), ''
+        return segment or None
+
+    def _emit(self, segment: str, segments: List[str]) -> None:
+        segment = segment.strip()
+        if segment:
+            segments.append(segment)
+            self._last_flush = time.monotonic()
@@ -0,0 +1,158 @@
+import re
+from functools import lru_cache
+from itertools import islice
+from typing import Dict, Iterable, List, Mapping, Reversible, Sequence, Type, Callable, Pattern
+
+from nonebot.log import logger
+
+# 尝试引用 tiktoken，非必须，不存在时使用估算的分词器
+try:
+    import tiktoken
+except ModuleNotFoundError:
+    tiktoken = None
+
+# 每条消息的格式开销，以及回复开头的固定开销，参考 OpenAI 的计算方式
+MESSAGE_OVERHEAD: int = 4
+REPLY_OVERHEAD: int = 3
+
+# 按模型名前缀匹配的上下文长度，取最长的匹配前缀
+CONTEXT_WINDOWS: Dict[str, int] = {
+    'gpt-3.5-turbo': 16385,
+    'gpt-3.5-turbo-0613': 4096,
+    'gpt-3.5-turbo-0301': 4096,
+    'gpt-3.5-turbo-16k': 16385,
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+    'gpt-4-turbo': 128000,
+    'gpt-4-1106': 128000,
+    'gpt-4-0125': 128000,
+    'gpt-4o': 128000,
+}
+DEFAULT_CONTEXT_WINDOW: int = 4096
+
+CJK: Pattern = re.compile(r'[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+
+class Tokenizer:
+    """
+    本地分词器，只用来估算请求的 token 数量
+    """
+    name: str = ''
+
+    def __init__(self, model: str):
+        self.model: str = model
+
+    def count(self, text: str) -> int:
+        raise NotImplementedError
+
+
+class HeuristicTokenizer(Tokenizer):
+    """
+    不依赖任何模块的估算：中日韩字符每个算一个 token，其余字符每 4 个算一个 token
+    """
+    name = 'heuristic'
+
+    def count(self, text: str) -> int:
+        cjk: int = len(CJK.findall(text))
+        return cjk + (len(text) - cjk + 3) // 4
+
+
+class TiktokenTokenizer(Tokenizer):
+    """
+    使用 tiktoken 精确计算，需要 tiktoken 依赖
+    """
+    name = 'tiktoken'
+
+    def __init__(self, model: str):
+        super().__init__(model)
+        try:
+            self._encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            self._encoding = tiktoken.get_encoding('cl100k_base')
+
+    def count(self, text: str) -> int:
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+
+TOKENIZERS: Dict[str, Type[Tokenizer]] = {
+    HeuristicTokenizer.name: HeuristicTokenizer,
+    TiktokenTokenizer.name: TiktokenTokenizer,
+}
+
+
+def register_tokenizer(tokenizer: Type[Tokenizer]) -> Type[Tokenizer]:
+    """
+    注册自定义分词器，之后可以在配置 tokenizer 中使用它的 name
+    """
+    TOKENIZERS[tokenizer.name] = tokenizer
+    return tokenizer
+
+
+def create_tokenizer(name: str, model: str) -> Tokenizer:
+    if name == 'auto':
+        name = TiktokenTokenizer.name if tiktoken is not None else HeuristicTokenizer.name
+    if name == TiktokenTokenizer.name and tiktoken is None:
+        logger.warning('需要安装 tiktoken 模块，已使用估算的分词器')
+        name = HeuristicTokenizer.name
+    if name not in TOKENIZERS:
+        logger.warning(f'未知的分词器 {name}，已使用估算的分词器')
+        name = HeuristicTokenizer.name
+    try:
+        return TOKENIZERS[name](model)
+    except Exception as e:
+        # tiktoken 第一次使用时需要下载编码文件，离线时会失败
+        logger.warning(f'分词器 {name} 初始化失败，已使用估算的分词器\n{type(e)}:{e}')
+        return HeuristicTokenizer(model)
+
+
+class ContextBuilder:
+    """
+    按 token 预算组装请求的上下文：完整保留预设，再从最新的消息往前尽可能多地加入历史记录
+    消息的 token 数量按内容缓存，同一条消息只计算一次
+    """
+
+    def __init__(self, tokenizer: Tokenizer, context_windows: Dict[str, int] = None, cache_size: int = 16384):
+        self.tokenizer: Tokenizer = tokenizer
+        self.context_windows: Dict[str, int] = {**CONTEXT_WINDOWS, **(context_windows or {})}
+        self._count: Callable[[str], int] = lru_cache(maxsize=cache_size)(tokenizer.count)
+
+    def message_tokens(self, message: Mapping) -> int:
+        return MESSAGE_OVERHEAD + self._count(message.get('content') or '')
+
+    def messages_tokens(self, messages: Iterable[Mapping]) -> int:
+        return REPLY_OVERHEAD + sum(self.message_tokens(m) for m in messages)
+
+    def context_window(self, model: str) -> int:
+        prefixes: List[str] = [p for p in self.context_windows if model.startswith(p)]
+        if not prefixes:
+            return DEFAULT_CONTEXT_WINDOW
+        return self.context_windows[max(prefixes, key=len)]
+
+    def budget(self, model: str, max_tokens: int) -> int:
+        """
+        请求的 prompt 最多可用的 token 数量，为回复预留 max_tokens
+        """
+        return self.context_window(model) - max_tokens
+
+    def build(self, preset: Sequence[Mapping], recent: Reversible[Mapping], max_count: int, budget: int,
+              pinned: Sequence[Mapping] = ()) -> List[Mapping]:
+        """
+        预设 preset 与 pinned（如压缩后的摘要）总是保留，之后 recent 中最多 max_count 条最新的消息在 budget 内尽量保留，
+        最新的一条消息总是保留；recent 从后往前遍历，不复制整个历史记录
+        """
+        head: List[Mapping] = [*preset, *pinned]
+        used: int = self.messages_tokens(head)
+        tail: List[Mapping] = []
+        for message in islice(reversed(recent), max_count):
+            tokens: int = self.message_tokens(message)
+            if used + tokens > budget and tail:
+                break
+            used += tokens
+            tail.append(message)
+        if used > budget:
+            logger.warning(f'上下文约 {used} tokens，超过了预算 {budget} tokens')
+        tail.reverse()
+        return head + tail
+
+    def cache_info(self):
+        return self._count.cache_info()
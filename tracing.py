@@ -0,0 +1,216 @@
+import os
+import time
+import heapq
+import asyncio
+import itertools
+from datetime import datetime
+from contextvars import ContextVar
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from nonebot.log import logger
+
+STATUS_UNSET: str = 'UNSET'
+STATUS_ERROR: str = 'ERROR'
+
+
+class Span:
+    """
+    一段耗时，字段与 OpenTelemetry 的 span 一致：trace_id 16 字节、span_id 8 字节（十六进制），时间为 unix 纳秒
+    """
+    __slots__ = ('trace', 'span_id', 'parent_span_id', 'name', 'start_time_unix_nano', 'end_time_unix_nano',
+                 'attributes', 'status', 'status_message')
+
+    def __init__(self, trace: "Trace", name: str, parent_span_id: Optional[str], start_ns: int,
+                 attributes: Dict[str, Any]):
+        self.trace: "Trace" = trace
+        self.span_id: str = os.urandom(8).hex()
+        self.parent_span_id: Optional[str] = parent_span_id
+        self.name: str = name
+        self.start_time_unix_nano: int = start_ns
+        self.end_time_unix_nano: Optional[int] = None
+        self.attributes: Dict[str, Any] = attributes
+        self.status: str = STATUS_UNSET
+        self.status_message: str = ''
+
+    @property
+    def trace_id(self) -> str:
+        return self.trace.trace_id
+
+    @property
+    def duration(self) -> float:
+        end: int = self.end_time_unix_nano if self.end_time_unix_nano is not None else time.time_ns()
+        return (end - self.start_time_unix_nano) / 1e9
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def set_status(self, status: str, message: str = '') -> None:
+        self.status = status
+        self.status_message = message
+
+    def end(self, end_ns: Optional[int] = None) -> None:
+        if self.end_time_unix_nano is None:
+            self.end_time_unix_nano = end_ns if end_ns is not None else time.time_ns()
+
+
+class Trace:
+    """
+    一次请求的全部 span，第一个 span 为根，超过 max_spans 个后不再记录
+    background 为 True 时是后台任务（如压缩、定时写入）的 trace，不计入最慢的请求
+    """
+
+    def __init__(self, max_spans: int, background: bool = False):
+        self.trace_id: str = os.urandom(16).hex()
+        self.background: bool = background
+        self.spans: List[Span] = []
+        self.max_spans: int = max_spans
+        self.dropped: int = 0
+
+    @property
+    def root(self) -> Span:
+        return self.spans[0]
+
+    @property
+    def duration(self) -> float:
+        return self.root.duration
+
+    def add(self, span: Span) -> None:
+        if len(self.spans) < self.max_spans:
+            self.spans.append(span)
+        else:
+            self.dropped += 1
+
+    def summary(self) -> str:
+        started: str = datetime.fromtimestamp(self.root.start_time_unix_nano / 1e9).strftime('%m-%d %H:%M:%S')
+        attributes: str = ' '.join(f'{k}={v}' for k, v in self.root.attributes.items())
+        return f'{self.duration:.2f}s {self.root.name} {started} {attributes}'.rstrip()
+
+    def format(self) -> str:
+        """
+        按父子关系缩进显示每个 span 相对根的开始时间与耗时
+        """
+        children: Dict[Optional[str], List[Span]] = {}
+        for span in self.spans:
+            children.setdefault(span.parent_span_id, []).append(span)
+        start: int = self.root.start_time_unix_nano
+        lines: List[str] = []
+
+        def walk(span: Span, depth: int) -> None:
+            attributes: str = ' '.join(f'{k}={v}' for k, v in span.attributes.items())
+            status: str = f' [{span.status_message or span.status}]' if span.status == STATUS_ERROR else ''
+            lines.append(f'{"  " * depth}{span.name} +{(span.start_time_unix_nano - start) / 1e6:.1f}ms '
+                         f'{span.duration * 1000:.1f}ms{status} {attributes}'.rstrip())
+            for child in sorted(children.get(span.span_id, ()), key=lambda s: s.start_time_unix_nano):
+                walk(child, depth + 1)
+
+        walk(self.root, 0)
+        if self.dropped:
+            lines.append(f'另有 {self.dropped} 个 span 未记录')
+        return '\n'.join(lines)
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar('chatgpt_current_span', default=None)
+
+
+class Tracer:
+    """
+    进程内的轻量追踪，span 通过 contextvars 传递父子关系，asyncio 任务创建时继承当前 span
+    根 span 结束时整条 trace 完成，只保留耗时最长的 slowest 条
+    """
+
+    def __init__(self, enabled: bool = False, slowest: int = 10, max_spans: int = 256):
+        self.enabled: bool = enabled
+        self.slowest: int = slowest
+        self.max_spans: int = max_spans
+        self._slowest: List[Tuple[float, int, Trace]] = []
+        self._seq: Iterator[int] = itertools.count()
+        self.traces: int = 0
+        self.background_traces: int = 0
+
+    def configure(self, enabled: bool, slowest: int) -> None:
+        self.enabled = enabled
+        self.slowest = max(slowest, 1)
+
+    @property
+    def current_span(self) -> Optional[Span]:
+        return _current_span.get()
+
+    def _start(self, name: str, start_ns: Optional[int], attributes: Dict[str, Any], background: bool = False) -> Span:
+        parent: Optional[Span] = _current_span.get()
+        trace: Trace = parent.trace if parent is not None else Trace(self.max_spans, background)
+        span: Span = Span(trace, name, parent.span_id if parent is not None else None,
+                          start_ns if start_ns is not None else time.time_ns(), attributes)
+        trace.add(span)
+        return span
+
+    def _end(self, span: Span, end_ns: Optional[int] = None) -> None:
+        span.end(end_ns)
+        if span.parent_span_id is None:
+            self._finish(span.trace)
+
+    def _finish(self, trace: Trace) -> None:
+        if trace.background:
+            self.background_traces += 1
+            return
+        self.traces += 1
+        entry: Tuple[float, int, Trace] = (trace.duration, next(self._seq), trace)
+        if len(self._slowest) < self.slowest:
+            heapq.heappush(self._slowest, entry)
+        elif entry[0] > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    @contextmanager
+    def span(self, name: str, start_ns: Optional[int] = None, standalone: bool = True, background: bool = False,
+             **attributes) -> Iterator[Optional[Span]]:
+        """
+        记录一个 span，没有父 span 时开始一条新的 trace，standalone 为 False 时则不记录；未开启或不记录时返回 None
+        start_ns 可以指定更早的开始时间，如收到事件的时间；background 为 True 且开始新的 trace 时该 trace 不计入最慢的请求
+        """
+        if not self.enabled or (not standalone and _current_span.get() is None):
+            yield None
+            return
+        span: Span = self._start(name, start_ns, attributes, background)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except asyncio.CancelledError:
+            span.set_status(STATUS_ERROR, 'cancelled')
+            raise
+        except Exception as e:
+            span.set_status(STATUS_ERROR, type(e).__name__)
+            raise
+        finally:
+            _current_span.reset(token)
+            self._end(span)
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        """
+        给当前 span 添加属性，没有当前 span 时忽略
+        """
+        span: Optional[Span] = _current_span.get()
+        if span is not None:
+            span.set_attribute(key, value)
+
+    def set_error(self, message: str) -> None:
+        span: Optional[Span] = _current_span.get()
+        if span is not None:
+            span.set_status(STATUS_ERROR, message)
+
+    def record(self, name: str, start_ns: int, end_ns: Optional[int] = None, **attributes) -> None:
+        """
+        在当前 span 下补记一个已经结束的 span，如排队等待的时间
+        """
+        if not self.enabled or _current_span.get() is None:
+            return
+        self._end(self._start(name, start_ns, attributes), end_ns)
+
+    def slowest_traces(self) -> List[Trace]:
+        return [entry[2] for entry in sorted(self._slowest, key=lambda e: e[0], reverse=True)]
+
+    def clear(self) -> None:
+        self._slowest = []
+        logger.info('已清空记录的 trace')
+
+
+tracer: Tracer = Tracer()